@@ -0,0 +1,51 @@
+#!/bin/bash
+# 
+# Runs the command of a pipeline job in the container of the submission (frame meant to be
+# used by spark_setup.py, the wrapper being written once per submission and run by the jobs
+# of spark_jobs_manager.py, which only give it their Singularity options)
+# 
+# Usage:
+#     job_wrapper.bash [--stage INPUT...] -- IMAGE COMMAND [ARGS...]
+# The inputs to stage are first copied to the storage local to the node, and bound onto their
+# original paths in the container. With warm instances, the jobs without staged inputs run in
+# the instance of their pilot worker (see spark_instance.py).
+# 
+# Last revision: October, 2026
+# Maintainer: Obai Bin Ka'b Ali @aliobaibk
+# License: In the app folder or check GNU GPL-3.0.
+
+
+
+VAR_INS ### THIS SHOULD BE THE FIRST COMMAND, DO NOT EDIT
+
+
+
+############## Main
+inputs=()
+if [[ $1 == "--stage" ]]; then
+    shift
+    while [[ $# -gt 0 ]] && [[ $1 != "--" ]]; do
+        inputs+=("$1")
+        shift
+    done
+fi
+if [[ $1 == "--" ]]; then
+    shift
+fi
+
+if [[ ${#inputs[@]} -gt 0 ]]; then
+    stage_binds="$(python3 "$app_dir"/spark_stage.py "$stage_dir" "${inputs[@]}")"
+    # The staged copies are in use until the job ends (shared locks inherited by the container,
+    # the copies being evicted only when unlocked, see spark_stage.py)
+    if command -v flock >/dev/null 2>&1; then
+        IFS=',' read -r -a binds <<< "$stage_binds"
+        for bind in "${binds[@]}"; do
+            exec {fd}<"${bind%%:*}.use" && flock -s $fd
+        done
+    fi
+    exec singularity exec -B "$sing_binds${stage_binds:+,$stage_binds}" -H "$sing_home":"$sing_home" "$@"
+elif [[ $warm_instances -gt 0 ]]; then
+    exec python3 "$app_dir"/spark_instance.py exec "$warm_instances" "$1" "$sing_binds" "$sing_home" -- "${@:2}"
+else
+    exec singularity exec -B "$sing_binds" -H "$sing_home":"$sing_home" "$@"
+fi
@@ -0,0 +1,70 @@
+# 
+# Manages the jobs submitted to the scheduler (frame meant to be used by spark_setup.py)
+# 
+# Last revision: October, 2026
+# Maintainer: Obai Bin Ka'b Ali @aliobaibk
+# License: In the app folder or check GNU GPL-3.0.
+
+
+
+############## Cleaning function
+clean () {
+    echo -e "\n\n\n     ***** Doing some cleaning, PLEASE WAIT"
+    
+    # Jobs manager (terminated with the local worker and its jobs, if any, then killed)
+    kill $manager_id >/dev/null 2>&1
+    for i in {1..20}; do
+        kill -0 $manager_id >/dev/null 2>&1 || break
+        sleep 0.5
+    done
+    kill -9 $manager_id >/dev/null 2>&1
+    
+    # Submitted jobs (those not known to be finished, one bulk query, then bulk cancellations of
+    # the jobs/job arrays still alive)
+    #echo -e "\n     - Deleting submitted jobs..."
+    python3 "$app_dir"/spark_jobs_manager.py clean \
+        --scheduler "$scheduler" \
+        --jobs-store "$jobs_store" \
+        --events-dir "$events_dir" \
+        >>"$tmp_dir"/jobs_manager.log 2>&1
+    
+    # Timing of the jobs (queue wait, run time, critical path)
+    python3 "$app_dir"/spark_report.py "$events_dir" \
+        >"$tmp_dir"/report.txt 2>>"$tmp_dir"/jobs_manager.log
+    
+    # Temporary directory
+    #echo -e "\n     - Deleting temporary files..."
+    #rm -rf "$tmp_dir" >/dev/null 2>&1
+    rm -rf "$tmp_dir"/fifo* >/dev/null 2>&1
+    rm -rf "$tmp_dir"/pilot* >/dev/null 2>&1
+    
+    echo -e "\n     - All cleanings done, the program will close"
+    echo -e "\n     BYE\n"
+}
+
+
+
+############## Jobs manager: reads the job requests from the FIFO and submits them (or runs
+############## them on the local machine, with the local executor)
+if [[ -n $fifo ]]; then
+    trap clean EXIT
+    python3 "$app_dir"/spark_jobs_manager.py serve \
+        --scheduler "$scheduler" \
+        --tmp-dir "$tmp_dir" \
+        --fifo "$fifo" \
+        --jobs-store "$jobs_store" \
+        --job-wrapper "$job_wrapper" \
+        --jobs-array-window "$jobs_array_window" \
+        --jobs-spec-steps "$jobs_spec_steps" \
+        --stage-dir "$stage_dir" \
+        --stage-tables "$stage_tables" \
+        --events-dir "$events_dir" \
+        --pilot-workers "$pilot_workers" \
+        --pilot-spec "$pilot_spec" \
+        --min-queued-jobs "${queued_jobs[0]}" \
+        --max-queued-jobs "${queued_jobs[1]}" \
+        --init-queued-jobs "${queued_jobs[2]}" \
+        --submit-rate "$submit_rate" \
+        >>"$tmp_dir"/jobs_manager.log 2>&1 &
+    manager_id=$!
+fi
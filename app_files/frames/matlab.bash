@@ -2,10 +2,20 @@
 # 
 # Runs SPARK MATLAB version (frame meant to be used by spark_setup.py)
 # 
-# Last revision: August, 2019
+# Last revision: October, 2026
 # Maintainer: Obai Bin Ka'b Ali @aliobaibk
 # License: In the app folder or check GNU GPL-3.0.
 
 
 
-VAR_INS ### THIS SHOULD BE THE FIRST COMMAND, DO NOT EDIT
\ No newline at end of file
+VAR_INS ### THIS SHOULD BE THE FIRST COMMAND, DO NOT EDIT
+
+
+
+JOBS_INS ### THE JOBS MANAGER, DO NOT EDIT
+
+
+
+############## Main
+# The jobs are handed to the jobs manager by psom_run_script.m
+export SPARK_JOBS_FIFO="$fifo"
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Discovers the fMRI data of a BIDS dataset, with an index of the directories cached between
+# submissions (meant to be used by spark_setup.py)
+#
+# Last revision: October, 2026
+# Maintainer: Obai Bin Ka'b Ali @aliobaibk
+# License: In the app folder or check GNU GPL-3.0.
+
+
+
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import re
+from sys import stderr
+
+
+
+# Number of threads used for scanning the directories
+NB_WORKERS = 16
+
+# Version of the index, to be increased whenever the content of an entry changes
+INDEX_VERSION = 1
+
+# Directories walked: the subjects at the root, then their sessions and functional data
+SUB_DIR = 'sub-'
+SES_DIR = 'ses-'
+FUNC_DIR = 'func'
+
+# Functional data files (uncompressed, as expected by SPARK)
+FUNC_FILE = re.compile(r'^sub-[a-zA-Z0-9]+(_[a-zA-Z0-9]+-[a-zA-Z0-9]+)*_bold\.(nii|mnc)$')
+ENTITY = re.compile(r'([a-zA-Z0-9]+)-([a-zA-Z0-9]+)')
+
+
+
+def scan_dir(dir_path, entry):
+    """Lists the relevant entries of a directory (subdirectories to walk and functional data
+    files), unless the directory did not change since it was indexed (same modification time).
+    Returns the entry of the directory in the index, or None if it does not exist anymore.
+    """
+
+    try:
+        mtime_ns = os.stat(dir_path).st_mtime_ns
+    except OSError:
+        return None
+    if entry is not None and entry['mtime_ns'] == mtime_ns:
+        return entry
+
+    entry = {'mtime_ns': mtime_ns, 'dirs': [], 'files': []}
+    try:
+        with os.scandir(dir_path) as it:
+            for x in it:
+                if (x.name.startswith(SUB_DIR) or x.name.startswith(SES_DIR) or x.name == FUNC_DIR) and x.is_dir():
+                    entry['dirs'].append(x.name)
+                elif FUNC_FILE.match(x.name):
+                    entry['files'].append(x.name)
+    except OSError as e:
+        print('Failed to scan the directory:\n' + dir_path + '\n' + str(e), file=stderr)
+        return None
+
+    return entry
+
+
+
+def walk(root, index, subjects, sessions):
+    """Walks the BIDS tree level by level (subjects, sessions, functional data), scanning the
+    directories of a level in parallel. Only the directories that changed are listed again.
+    Returns the paths of the functional data files.
+    """
+
+    def keep(level, name):
+        if level == 0:
+            return name.startswith(SUB_DIR) and (not subjects or name[len(SUB_DIR):] in subjects)
+        elif name.startswith(SES_DIR):
+            return level == 1 and (not sessions or name[len(SES_DIR):] in sessions)
+        else:
+            return name == FUNC_DIR
+
+    files = []
+    level_dirs = [root]
+    with ThreadPoolExecutor(max_workers=NB_WORKERS) as pool:
+        for level in range(4):
+            entries = pool.map(lambda x: scan_dir(x, index.get(x)), level_dirs)
+            next_dirs = []
+            for (dir_path, entry) in zip(level_dirs, entries):
+                if entry is None:
+                    index.pop(dir_path, None)
+                    continue
+                index[dir_path] = entry
+                if os.path.basename(dir_path) == FUNC_DIR:
+                    files += [os.sep.join([dir_path, x]) for x in entry['files']]
+                next_dirs += [os.sep.join([dir_path, x]) for x in entry['dirs'] if keep(level, x)]
+            level_dirs = next_dirs
+
+    return files
+
+
+
+def load_index(cache_dir):
+    """Loads the index of the directories of a BIDS dataset (path -> modification time and
+    relevant entries)
+    """
+
+    try:
+        with open(os.sep.join([cache_dir, 'bids.json']), 'r') as file:
+            index = json.load(file)
+        if index.get('version') == INDEX_VERSION:
+            return index
+    except (OSError, ValueError):
+        pass
+
+    return {'version': INDEX_VERSION, 'roots': dict()}
+
+
+
+def save_index(cache_dir, index):
+    """Saves the index of the directories (atomically, as for the headers index)
+    """
+
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = os.sep.join([cache_dir, 'bids.json.' + str(os.getpid())])
+        with open(tmp_path, 'w') as file:
+            json.dump(index, file)
+        os.replace(tmp_path, os.sep.join([cache_dir, 'bids.json']))
+    except OSError as e:
+        print('Failed to save the index of the BIDS dataset in the cache directory:\n' + cache_dir + '\n' + str(e), file=stderr)
+
+
+
+def setup_data(path):
+    """Maps the BIDS entities of a functional data file onto a subject/session/run triplet:
+    sub-01_ses-02_task-rest_run-1_bold.nii -> sub01 ses02 taskrestrun1 (the session being
+    'ses1' when there is none, and the run gathering all the entities but the subject and
+    the session)
+    """
+
+    entities = ENTITY.findall(os.path.basename(path))
+    subject = [v for (k, v) in entities if k == 'sub'][0]
+    session = ([v for (k, v) in entities if k == 'ses'] + ['1'])[0]
+    run = ''.join([k + v for (k, v) in entities if k not in ('sub', 'ses')])
+
+    return ['sub' + subject, 'ses' + session, run or 'run1', path]
+
+
+
+def discover(root, subjects, sessions, tasks, cache_dir):
+    """Discovers the functional data (*_bold.nii, *_bold.mnc) of a BIDS dataset, filtered by
+    subject, session and task labels (all if empty). Returns the list of the fMRI data as
+    [subject, session, run, path], sorted.
+    """
+
+    index = load_index(cache_dir) if cache_dir else {'version': INDEX_VERSION, 'roots': dict()}
+    root_index = index['roots'].setdefault(root, dict())
+
+    fmri_data = []
+    for path in walk(root, root_index, set(subjects), set(sessions)):
+        if tasks and not any(('_task-' + x + '_') in os.path.basename(path) for x in tasks):
+            continue
+        fmri_data.append(setup_data(path))
+
+    if cache_dir:
+        save_index(cache_dir, index)
+
+    return sorted(fmri_data)
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Records the timing of the pipeline jobs as JSON lines events (meant to be used by
+# spark_jobs_manager.py, and by the scripts of the jobs on the compute nodes):
+# - submit: the job is requested by the pipeline controller (PSOM)
+# - queued: the job is accepted by the scheduler (with its ID)
+# - rejected: the submission of the job failed
+# - start: the job starts on a compute node
+# - end: the job ends (with its exit code and peak memory)
+#
+# Last revision: October, 2026
+# Maintainer: Obai Bin Ka'b Ali @aliobaibk
+# License: In the app folder or check GNU GPL-3.0.
+
+
+
+import json
+import os
+from resource import RUSAGE_CHILDREN, getrusage
+from socket import gethostname
+import subprocess
+from sys import argv, stderr
+from sys import exit as sys_exit
+from time import time
+
+
+
+def write_events(events_dir, source, events):
+    """Appends events to the file of a source (a compute node or the jobs manager), with a
+    single write: the jobs of a node share its file, the nodes never share a file (appends
+    are not atomic across the nodes on network filesystems)
+    """
+
+    data = ''.join([json.dumps(x, separators=(',', ':')) + '\n' for x in events]).encode()
+    try:
+        fd = os.open(os.sep.join([events_dir, source + '.jsonl']), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, data)
+        finally:
+            os.close(fd)
+    except OSError as e:
+        print('Failed to record the events of the jobs:\n' + events_dir + '\n' + str(e), file=stderr)
+
+
+
+def read_events(events_dir):
+    """Reads the events of all the sources, sorted by time
+    """
+
+    events = []
+    try:
+        sources = sorted(x for x in os.listdir(events_dir) if x.endswith('.jsonl'))
+    except OSError as e:
+        print('Failed to read the events of the jobs:\n' + events_dir + '\n' + str(e), file=stderr)
+        return events
+
+    for source in sources:
+        with open(os.sep.join([events_dir, source]), 'r', newline='\n') as file:
+            for line in file:
+                try:
+                    events.append(json.loads(line))
+                except ValueError:
+                    continue # Truncated by a killed job
+
+    return sorted(events, key=lambda x: x.get('time', 0))
+
+
+
+def run(events_dir, job, cmd):
+    """Runs the command of a job, surrounded by its start and end events.
+    The peak memory is the largest resident set size among the processes of the job.
+    """
+
+    node = gethostname()
+    write_events(events_dir, node, [{'event': 'start', 'job': job, 'node': node, 'time': time()}])
+
+    try:
+        status = subprocess.call(cmd)
+        status = status if status >= 0 else 128 - status # Killed by a signal, as reported by bash
+    except OSError as e:
+        print('Failed to run the job:\n' + ' '.join(cmd) + '\n' + str(e), file=stderr)
+        status = 127
+
+    write_events(events_dir, node, [{
+        'event': 'end', 'job': job, 'node': node, 'time': time(), 'exit': status,
+        'max_rss': getrusage(RUSAGE_CHILDREN).ru_maxrss * 1024}])
+
+    return status
+
+
+
+def main(iargs):
+    """Main function: spark_events.py run EVENTS_DIR JOB_NAME -- COMMAND [ARGS...]
+    """
+
+    if len(iargs) < 5 or iargs[0] != 'run' or iargs[3] != '--':
+        print('Usage: spark_events.py run EVENTS_DIR JOB_NAME -- COMMAND [ARGS...]', file=stderr)
+        sys_exit(2)
+
+    sys_exit(run(iargs[1], iargs[2], iargs[4:]))
+
+
+
+############## Main
+if __name__ == "__main__":
+    main(argv[1:])
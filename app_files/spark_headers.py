@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Reads the headers of the NIfTI/MINC files, with an index cached between submissions
+# (meant to be used by spark_setup.py)
+#
+# Last revision: October, 2026
+# Maintainer: Obai Bin Ka'b Ali @aliobaibk
+# License: In the app folder or check GNU GPL-3.0.
+
+
+
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import struct
+from sys import byteorder, stderr
+
+
+
+# Number of threads used for the file system operations (stat/scandir/header reads)
+NB_WORKERS = 16
+
+# Version of the index, to be increased whenever the content of a header changes
+INDEX_VERSION = 1
+
+# netCDF classic format (MINC1): tags and size of the types
+NC_DIMENSION = 10
+NC_VARIABLE = 11
+NC_ATTRIBUTE = 12
+NC_TYPES = {1: ('b', 1), 2: ('c', 1), 3: ('h', 2), 4: ('i', 4), 5: ('f', 4), 6: ('d', 8)}
+
+# NIfTI data types: array type codes (the types that can hold a mask)
+NIFTI_TYPES = {2: 'B', 4: 'h', 8: 'i', 16: 'f', 64: 'd', 256: 'b', 512: 'H', 768: 'I'}
+
+
+
+def scan_dir(dir_path, names):
+    """Stats the wanted files of a directory with a single scan of the directory.
+    Returns a dictionary: path -> (modification time in ns, size), or None if the path
+    is not an existing regular file.
+    """
+
+    stats = dict.fromkeys([os.sep.join([dir_path, x]) for x in names])
+    try:
+        with os.scandir(dir_path) as it:
+            for entry in it:
+                if entry.name in names and entry.is_file():
+                    st = entry.stat()
+                    stats[entry.path] = (st.st_mtime_ns, st.st_size)
+    except OSError:
+        pass
+
+    return stats
+
+
+
+def scan_files(paths):
+    """Stats files in parallel, grouping them by directory (one scan per directory)
+    """
+
+    dirs = dict()
+    for path in paths:
+        (dir_path, name) = os.path.split(path)
+        dirs.setdefault(dir_path, set()).add(name)
+
+    stats = dict()
+    with ThreadPoolExecutor(max_workers=NB_WORKERS) as pool:
+        for dir_stats in pool.map(lambda x: scan_dir(*x), dirs.items()):
+            stats.update(dir_stats)
+
+    return stats
+
+
+
+def read_nifti_header(data):
+    """Reads the header of a NIfTI-1/NIfTI-2 file (single file, .nii)
+    """
+
+    for endian in ['<', '>']:
+        sizeof_hdr = struct.unpack_from(endian + 'i', data, 0)[0]
+        if sizeof_hdr == 348:
+            dims = struct.unpack_from(endian + '8h', data, 40)
+            (datatype, bitpix) = struct.unpack_from(endian + '2h', data, 70)
+            pixdim = struct.unpack_from(endian + '8f', data, 76)
+            vox_offset = struct.unpack_from(endian + 'f', data, 108)[0]
+            (scl_slope, scl_inter) = struct.unpack_from(endian + '2f', data, 112)
+            xyzt_units = struct.unpack_from(endian + 'B', data, 123)[0]
+            fmt = 'nifti1'
+            break
+        elif sizeof_hdr == 540:
+            (datatype, bitpix) = struct.unpack_from(endian + '2h', data, 12)
+            dims = struct.unpack_from(endian + '8q', data, 16)
+            pixdim = struct.unpack_from(endian + '8d', data, 104)
+            vox_offset = struct.unpack_from(endian + 'q', data, 168)[0]
+            (scl_slope, scl_inter) = struct.unpack_from(endian + '2d', data, 176)
+            xyzt_units = struct.unpack_from(endian + 'i', data, 500)[0]
+            fmt = 'nifti2'
+            break
+    else:
+        return None
+
+    nb_dims = max(0, min(int(dims[0]), 7))
+    shape = [int(x) for x in dims[1:nb_dims + 1]] + [1] * max(0, 4 - nb_dims)
+
+    # Time units: seconds (8), milliseconds (16) or microseconds (24)
+    tr = float(pixdim[4]) * {16: 1e-3, 24: 1e-6}.get(xyzt_units & 0x38, 1.0)
+
+    return {
+        'format': fmt,
+        'dims': shape[:3],
+        'nb_timepoints': shape[3],
+        'voxel_size': [round(abs(float(x)), 6) for x in pixdim[1:4]],
+        'tr': round(tr, 6),
+        'datatype': int(datatype),
+        'bitpix': int(bitpix),
+        'endian': endian,
+        'vox_offset': int(vox_offset),
+        'scl_slope': float(scl_slope),
+        'scl_inter': float(scl_inter)}
+
+
+
+def read_minc1_header(data):
+    """Reads the dimensions of a MINC1 file (netCDF classic format)
+    """
+
+    offset_size = 8 if data[3] == 2 else 4
+    pos = [8] # After the magic number and the number of records
+
+    def read(fmt):
+        value = struct.unpack_from('>' + fmt, data, pos[0])
+        pos[0] += struct.calcsize('>' + fmt)
+        return value[0] if len(value) == 1 else value
+
+    def read_name():
+        n = read('i')
+        name = data[pos[0]:pos[0] + n].decode(errors='replace')
+        pos[0] += (n + 3) // 4 * 4
+        return name
+
+    def read_atts():
+        atts = dict()
+        (tag, n) = read('2i')
+        for _ in range(n if tag == NC_ATTRIBUTE else 0):
+            name = read_name()
+            (nc_type, nelems) = read('2i')
+            (code, size) = NC_TYPES[nc_type]
+            if code == 'c':
+                atts[name] = data[pos[0]:pos[0] + nelems].decode(errors='replace')
+            else:
+                atts[name] = struct.unpack_from('>' + str(nelems) + code, data, pos[0])
+            pos[0] += (nelems * size + 3) // 4 * 4
+        return atts
+
+    dims = []
+    (tag, n) = read('2i')
+    for _ in range(n if tag == NC_DIMENSION else 0):
+        dims.append((read_name(), read('i')))
+    read_atts() # Global attributes
+
+    steps = dict()
+    (tag, n) = read('2i')
+    for _ in range(n if tag == NC_VARIABLE else 0):
+        name = read_name()
+        nb_dimids = read('i')
+        pos[0] += 4 * nb_dimids # Dimension IDs
+        atts = read_atts()
+        pos[0] += 8 + offset_size # Type, size and begin
+        if 'step' in atts and not isinstance(atts['step'], str):
+            steps[name] = float(atts['step'][0])
+
+    lengths = dict(dims)
+    if not all(x in lengths for x in ['xspace', 'yspace', 'zspace']):
+        return None
+
+    return {
+        'format': 'minc1',
+        'dims': [lengths['xspace'], lengths['yspace'], lengths['zspace']],
+        'nb_timepoints': lengths.get('time', 1),
+        'voxel_size': [round(abs(steps.get(x, 0.0)), 6) for x in ['xspace', 'yspace', 'zspace']],
+        'tr': round(steps.get('time', 0.0), 6)}
+
+
+
+def read_header(path):
+    """Reads the header of a NIfTI/MINC file, only the beginning of the file is read.
+    Returns None if the header could not be read (e.g. MINC2, which is HDF5 based).
+    """
+
+    size = 2**16
+    while True:
+        try:
+            with open(path, 'rb') as file:
+                data = file.read(size)
+        except OSError:
+            return None
+
+        try:
+            if data[:3] == b'CDF':
+                return read_minc1_header(data)
+            elif path.endswith('.nii') and len(data) >= 348:
+                return read_nifti_header(data)
+            else:
+                return None
+        except (struct.error, KeyError, IndexError):
+            # Truncated header (e.g. long MINC history), read more of the file
+            if len(data) < size or size >= 2**24:
+                return None
+            size *= 4
+
+
+
+def count_voxels(path, header):
+    """Number of non-zero voxels of a 3D volume (e.g. the voxels inside a mask).
+    Only the data of NIfTI files is read, otherwise the number of voxels of the grid
+    (an upper bound) is returned.
+    """
+
+    nb_voxels = header['dims'][0] * header['dims'][1] * header['dims'][2]
+    if not header['format'].startswith('nifti') or header['datatype'] not in NIFTI_TYPES:
+        return nb_voxels
+
+    data = array(NIFTI_TYPES[header['datatype']])
+    try:
+        with open(path, 'rb') as file:
+            file.seek(header['vox_offset'])
+            data.frombytes(file.read(nb_voxels * data.itemsize))
+    except (OSError, ValueError):
+        return nb_voxels
+    if len(data) < nb_voxels:
+        return nb_voxels
+
+    # The byte order does not matter for the zeros, except for the signed zeros (-0.0)
+    if data.typecode in 'fd' and header['endian'] != {'little': '<', 'big': '>'}[byteorder]:
+        data.byteswap()
+
+    return len(data) - data.count(0)
+
+
+
+def load_index(cache_dir):
+    """Loads the index of the headers (path -> modification time, size and header)
+    """
+
+    try:
+        with open(os.sep.join([cache_dir, 'headers.json']), 'r') as file:
+            index = json.load(file)
+        if index.get('version') == INDEX_VERSION:
+            return index
+    except (OSError, ValueError):
+        pass
+
+    return {'version': INDEX_VERSION, 'files': dict()}
+
+
+
+def save_index(cache_dir, index):
+    """Saves the index of the headers (atomically, concurrent submissions may share it)
+    """
+
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = os.sep.join([cache_dir, 'headers.json.' + str(os.getpid())])
+        with open(tmp_path, 'w') as file:
+            json.dump(index, file)
+        os.replace(tmp_path, os.sep.join([cache_dir, 'headers.json']))
+    except OSError as e:
+        print('Failed to save the index of the headers in the cache directory:\n' + cache_dir + '\n' + str(e), file=stderr)
+
+
+
+def get_headers(paths, cache_dir):
+    """Stats the files and reads their headers in parallel, the headers of the files that did
+    not change (same modification time and size) since the last call are taken from the index.
+    Returns two dictionaries: path -> (modification time in ns, size) or None if the file does
+    not exist, and path -> header or None if the header could not be read. The files that no
+    longer exist are dropped from the index.
+    """
+
+    stats = scan_files(paths)
+
+    index = load_index(cache_dir) if cache_dir else {'version': INDEX_VERSION, 'files': dict()}
+    headers = dict()
+    to_read = []
+    pruned = False
+    for (path, st) in stats.items():
+        entry = index['files'].get(path)
+        if st is None:
+            headers[path] = None
+            pruned = pruned or index['files'].pop(path, None) is not None
+        elif entry is not None and entry['mtime_ns'] == st[0] and entry['size'] == st[1]:
+            headers[path] = entry['header']
+        else:
+            to_read.append(path)
+
+    if to_read:
+        with ThreadPoolExecutor(max_workers=NB_WORKERS) as pool:
+            for (path, header) in zip(to_read, pool.map(read_header, to_read)):
+                headers[path] = header
+                index['files'][path] = {'mtime_ns': stats[path][0], 'size': stats[path][1], 'header': header}
+    if cache_dir and (to_read or pruned):
+        save_index(cache_dir, index)
+
+    return (stats, headers)
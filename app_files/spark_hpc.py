@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Application entrypoint: spark-hpc run [SPARK OPTIONS]
+# Checks the requirements, sets up the run (see spark_setup.py) and starts the main job,
+# directly or through the scheduler, in a single process (spark_run.bash being a shim)
+#
+# Last revision: October, 2026
+# Maintainer: Obai Bin Ka'b Ali @aliobaibk
+# License: In the app folder or check GNU GPL-3.0.
+
+
+
+import os
+from sys import argv, stderr, stdout, version_info
+from sys import exit as sys_exit
+
+
+
+# Minimum version of Python (asyncio.run, used by the jobs manager)
+MIN_PYTHON = (3, 7)
+
+# Files of the application, relative to its folder
+APP_FILES = [
+    'spark_setup.py',
+    'frames/matlab.bash',
+    'frames/sing.bash',
+    'frames/jobs.bash',
+    'frames/job_wrapper.bash',
+    'spark_jobs_manager.py',
+    'spark_jobs_store.py',
+    'spark_bids.py',
+    'spark_events.py',
+    'spark_headers.py',
+    'spark_instance.py',
+    'spark_pilot.py',
+    'spark_plan.py',
+    'spark_report.py',
+    'spark_resources.py',
+    'spark_stage.py',
+    'spark_steps.py',
+    'spark_resampling.py',
+    'spark_tseries.py']
+
+# Commands starting the main job as an interactive job (the main job itself submits the
+# pipeline jobs)
+INTERACTIVE_CMD = {
+    'SLURM': 'srun',
+    'SGE': 'qrsh',
+    'TORQUE': 'qrsh'}
+
+
+
+def check_requirements():
+    """Checks the version of Python and the presence of the application files
+    """
+
+    if version_info[:2] < MIN_PYTHON:
+        print('\n\n\n     ***** Python ' + '.'.join([str(x) for x in MIN_PYTHON]) + '+ is required' +
+              '\nFound:\n' + '.'.join([str(x) for x in version_info[:3]]) +
+              '\n\n     Closing the program\n', file=stderr)
+        sys_exit(1)
+
+    app_dir = os.path.dirname(os.path.abspath(__file__))
+    for name in APP_FILES:
+        if not os.path.isfile(os.sep.join([app_dir, name])):
+            print('\n     - The file ' + os.path.basename(name) + ' is missing' +
+                  '\n\n     Please make sure you have the complete application' +
+                  '\n\n     For help, please check (or report a bug at):\nhttps://github.com/multifunkim/spark-hpc', file=stderr)
+            sys_exit(1)
+
+
+
+def entrypoint_cmd(entrypoint):
+    """Command starting the main job: through the scheduler for an interactive run, directly
+    otherwise
+    """
+
+    if entrypoint['interactive'] and entrypoint['scheduler'] in INTERACTIVE_CMD:
+        return [INTERACTIVE_CMD[entrypoint['scheduler']]] + entrypoint['jobs_ctrl_spec'].split() + [entrypoint['main_job']]
+
+    return [entrypoint['main_job']]
+
+
+
+def run(iargs):
+    """Sets up the run, then replaces the current process by the main job (nothing is run
+    for a dry run, for help, or when all the steps are up to date)
+    """
+
+    check_requirements()
+
+    # Imported once the application files are known to be present
+    from spark_setup import setup
+    try:
+        entrypoint = setup(iargs)
+    except SystemExit as e:
+        if e.code:
+            print('\n\n\n     ***** Something went wrong' +
+                  '\n\n     Closing the program\n', file=stderr)
+        raise
+
+    if entrypoint is None:
+        return 0
+
+    os.chmod(entrypoint['main_job'], os.stat(entrypoint['main_job']).st_mode | 0o100)
+    cmd = entrypoint_cmd(entrypoint)
+    stdout.flush()
+    stderr.flush()
+    try:
+        os.execvp(cmd[0], cmd)
+    except OSError as e:
+        print('Failed to start the main job:\n' + ' '.join(cmd) + '\n' + str(e), file=stderr)
+        return 1
+
+
+
+def main(iargs):
+    """Main function: spark-hpc run [SPARK OPTIONS] (see spark-hpc run --help)
+    """
+
+    if not iargs or iargs[0] != 'run':
+        print('Usage: spark-hpc run [SPARK OPTIONS]\n' +
+              'For the options, see: spark-hpc run --help', file=stderr)
+        sys_exit(2)
+
+    sys_exit(run(iargs[1:]))
+
+
+
+############## Main
+if __name__ == "__main__":
+    main(argv[1:])
@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Runs the command of a pipeline job in a Singularity instance kept warm by the pilot worker
+# running the job (meant to be run by the wrapper of the jobs, see frames/job_wrapper.bash):
+# the first job of a worker starts a named instance of the image, with the bindings and home
+# of the submission, the next jobs of the worker run their command in it (no mount of the
+# image nor setup of the namespaces per job), and the instance is stopped once idle, or when
+# the worker leaves (see spark_pilot.py).
+# The instance belongs to the allocation of the worker, not to the job that started it: a job
+# submitted on its own would take its instance down when it ends (the scheduler killing all
+# the processes of its control group), hence the instances being only used by pilot workers.
+#
+# Usage:
+#     spark_instance.py exec IDLE IMAGE BINDS HOME -- COMMAND [ARGS...]
+#     spark_instance.py reap IDLE NAME (started by the job that starts the instance)
+# A job whose instance cannot be started (or was lost), or not run by a pilot worker, runs in
+# its own container, as without instances.
+#
+# Last revision: October, 2026
+# Maintainer: Obai Bin Ka'b Ali @aliobaibk
+# License: In the app folder or check GNU GPL-3.0.
+
+
+
+import fcntl
+from getpass import getuser
+import hashlib
+import os
+import subprocess
+from sys import argv, executable, stderr
+from sys import exit as sys_exit
+from time import sleep, time
+
+
+
+# Directory local to the compute node where the jobs of the node register (shared by the
+# jobs of the node)
+STATE_ROOT = '/tmp'
+
+# Maximum interval between two checks of the idleness of an instance (seconds)
+REAP_INTERVAL = 30
+
+# Exit code of Singularity when it fails (as opposed to the command it runs)
+SING_ERROR = 255
+
+# Variable holding the ID of the pilot worker running the job (set by spark_pilot.py)
+OWNER_VAR = 'SPARK_PILOT_WORKER'
+
+
+
+def owner_key(owner):
+    """Suffix of the names of the instances of a pilot worker
+    """
+
+    return hashlib.sha1(owner.encode()).hexdigest()[:8]
+
+
+
+def instance_name(image, binds, home, owner):
+    """Name of the instance of a submission in a pilot worker: the jobs of the worker with the
+    same image, bindings and home share its instance
+    """
+
+    return 'spark-' + hashlib.sha1('\n'.join([os.path.realpath(image), binds, home]).encode()).hexdigest()[:12] + \
+        '-' + owner_key(owner)
+
+
+
+def state_dir(name):
+    """Directory of an instance where its jobs register (one file per job, named after its
+    process ID), with its lock and the time of its last activity
+    """
+
+    return os.sep.join([STATE_ROOT, 'spark-instances-' + getuser(), name])
+
+
+
+def list_instances(name=''):
+    """Names of the instances of the user running on the node (all, or those of a given name)
+    """
+
+    try:
+        output = subprocess.run(['singularity', 'instance', 'list'] + ([name] if name else []), stdout=subprocess.PIPE,
+                                stderr=subprocess.DEVNULL, universal_newlines=True).stdout
+    except OSError:
+        return []
+
+    return [x.split()[0] for x in output.splitlines() if x.split() and x.split()[0] != 'INSTANCE']
+
+
+
+def is_running(name):
+    """Whether the instance is running (on the node)
+    """
+
+    return name in list_instances(name)
+
+
+
+def stop_instances(owner):
+    """Stops the instances of a pilot worker (when it leaves)
+    """
+
+    for name in list_instances():
+        if name.startswith('spark-') and name.endswith('-' + owner_key(owner)):
+            subprocess.call(['singularity', 'instance', 'stop', name], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+
+def is_alive(pid):
+    """Whether a process exists
+    """
+
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+
+    return True
+
+
+
+def start_instance(name, idle, image, binds, home):
+    """Starts the instance, and the process stopping it once idle.
+    Returns True if the instance is running.
+    """
+
+    try:
+        subprocess.call(['singularity', 'instance', 'start', '-B', binds, '-H', home + ':' + home, image, name],
+                        stdout=subprocess.DEVNULL)
+    except OSError as e:
+        print('Failed to start the Singularity instance:\n' + name + '\n' + str(e), file=stderr)
+        return False
+
+    if not is_running(name):
+        print('Failed to start the Singularity instance:\n' + name, file=stderr)
+        return False
+
+    # In a session of its own, the reaper outlives the job that started it (in the allocation of
+    # the pilot worker, until the worker leaves)
+    subprocess.Popen([executable, os.path.abspath(__file__), 'reap', str(idle), name], start_new_session=True,
+                     stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    return True
+
+
+
+def register(name, idle, image, binds, home):
+    """Registers the job with the instance of its node, starting the instance if needed.
+    Returns True if the instance is running.
+    """
+
+    state = state_dir(name)
+    try:
+        os.makedirs(state, exist_ok=True)
+        with open(os.sep.join([state, 'lock']), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            running = is_running(name) or start_instance(name, idle, image, binds, home)
+            if running:
+                open(os.sep.join([state, str(os.getpid())]), 'w').close()
+    except OSError as e:
+        print('Failed to register the job with the Singularity instance:\n' + state + '\n' + str(e), file=stderr)
+        running = False
+
+    return running
+
+
+
+def unregister(name):
+    """Unregisters the job, and records the time of the last activity of the instance
+    """
+
+    state = state_dir(name)
+    try:
+        os.remove(os.sep.join([state, str(os.getpid())]))
+        with open(os.sep.join([state, 'last']), 'w'):
+            pass
+    except OSError:
+        pass
+
+
+
+def reap(idle, name):
+    """Stops the instance once no job is registered with it since IDLE seconds (the jobs that
+    were killed being unregistered), or leaves once the instance is gone
+    """
+
+    state = state_dir(name)
+    while True:
+        sleep(min(idle, REAP_INTERVAL))
+        with open(os.sep.join([state, 'lock']), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if not is_running(name):
+                return 0
+
+            jobs = [x for x in os.listdir(state) if x.isdigit()]
+            for job in [x for x in jobs if not is_alive(int(x))]:
+                os.remove(os.sep.join([state, job]))
+                jobs.remove(job)
+            try:
+                last = os.path.getmtime(os.sep.join([state, 'last']))
+            except OSError:
+                last = os.path.getmtime(state)
+
+            if not jobs and time() - last >= idle:
+                subprocess.call(['singularity', 'instance', 'stop', name],
+                                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                return 0
+
+
+
+def run(idle, image, binds, home, cmd):
+    """Runs the command of a job in the instance of its pilot worker, or in its own container if
+    the instance is not available (or if the job is not run by a pilot worker)
+    """
+
+    owner = os.environ.get(OWNER_VAR, '')
+    name = instance_name(image, binds, home, owner) if owner else ''
+    running = bool(owner) and register(name, idle, image, binds, home)
+    try:
+        status = SING_ERROR
+        if running:
+            status = subprocess.call(['singularity', 'exec', 'instance://' + name] + cmd)
+        if not running or (status == SING_ERROR and not is_running(name)):
+            status = subprocess.call(['singularity', 'exec', '-B', binds, '-H', home + ':' + home, image] + cmd)
+    except OSError as e:
+        print('Failed to run the job:\n' + ' '.join(cmd) + '\n' + str(e), file=stderr)
+        status = 127
+    finally:
+        if running:
+            unregister(name)
+
+    return status if status >= 0 else 128 - status # Killed by a signal, as reported by bash
+
+
+
+def main(iargs):
+    """Main function: spark_instance.py exec IDLE IMAGE BINDS HOME -- COMMAND [ARGS...]
+    or spark_instance.py reap IDLE NAME
+    """
+
+    if len(iargs) >= 7 and iargs[0] == 'exec' and iargs[1].isdigit() and iargs[5] == '--':
+        sys_exit(run(int(iargs[1]), iargs[2], iargs[3], iargs[4], iargs[6:]))
+    elif len(iargs) == 3 and iargs[0] == 'reap' and iargs[1].isdigit():
+        sys_exit(reap(int(iargs[1]), iargs[2]))
+
+    print('Usage: spark_instance.py exec IDLE IMAGE BINDS HOME -- COMMAND [ARGS...]\n' +
+          '       spark_instance.py reap IDLE NAME', file=stderr)
+    sys_exit(2)
+
+
+
+############## Main
+if __name__ == "__main__":
+    main(argv[1:])
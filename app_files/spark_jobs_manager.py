@@ -0,0 +1,1143 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Submits the pipeline jobs to the scheduler, or runs them on the local machine (daemon meant
+# to be started by the main job)
+#
+# Last revision: October, 2026
+# Maintainer: Obai Bin Ka'b Ali @aliobaibk
+# License: In the app folder or check GNU GPL-3.0.
+
+
+
+from argparse import ArgumentParser
+import asyncio
+from collections import deque
+from getpass import getuser
+import json
+import os
+import re
+import secrets
+import shlex
+import signal
+from socket import gethostname
+import sqlite3
+import subprocess
+from sys import argv, stderr
+from tempfile import mkstemp
+from time import monotonic, strftime, time
+
+from spark_events import write_events
+from spark_jobs_store import ALIVE_STATES, add_jobs, alive_jobids, append_log, cancel_jobids, import_events, load_subjects, \
+    log_path, open_store, read_log, subject_of
+from spark_report import step_of
+from spark_resources import job_step, spec_memory, strip_spec
+
+
+
+# Maximum number of jobs in a job array
+ARRAY_MAX_SIZE = 1000
+
+# Submission commands (reading the script of the job from their standard input), '{name}' and
+# '{size}' are replaced by the job name and the array size
+SUBMIT_CMD = {
+    'SLURM': ['sbatch', '--job-name={name}'],
+    'SGE': ['qsub', '-N', '{name}'],
+    'TORQUE': ['qsub', '-N', '{name}']}
+ARRAY_OPT = {
+    'SLURM': ['--array=1-{size}'],
+    'SGE': ['-t', '1-{size}'],
+    'TORQUE': ['-t', '1-{size}']}
+TASK_SEP = {
+    'SLURM': '_',
+    'SGE': '.',
+    'TORQUE': '.'}
+TASK_ID = '${SLURM_ARRAY_TASK_ID:-${SGE_TASK_ID:-$PBS_ARRAYID}}'
+
+# Bulk query of the jobs of a user (one line per array task with TORQUE, whose arrays are
+# otherwise summed up as '123[]'), position of the job state in the output, and position of
+# the first column after the submission date with SGE (queue if running, slots, then the
+# tasks of an array, e.g. '1-50:1')
+QUERY_CMD = {
+    'SLURM': ['squeue', '-h', '-o', '%i %t', '-u', '{user}'],
+    'SGE': ['qstat', '-u', '{user}'],
+    'TORQUE': ['qstat', '-t', '-u', '{user}']}
+QUERY_STATE_COL = {
+    'SLURM': 1,
+    'SGE': 4,
+    'TORQUE': 9}
+SGE_SLOTS_COL = 7
+PENDING_STATES = {'PD', 'CF', 'qw', 'hqw', 'Q', 'H', 'W'}
+RUNNING_STATES = {'R', 'CG', 'r', 't', 'Rr', 'Rt', 'E'}
+
+# Bulk cancellation, the job IDs are appended by chunks (a whole job array being cancelled by
+# its ID, or by '123[]' with TORQUE)
+CANCEL_CMD = {
+    'SLURM': ['scancel'],
+    'SGE': ['qdel'],
+    'TORQUE': ['qdel']}
+CANCEL_CHUNK_SIZE = 500
+
+# Account limits on the number of jobs of the user (pending or running), and pattern of the
+# limit in the output ('0' meaning no limit for SGE)
+LIMITS_CMD = {
+    'SLURM': ['sacctmgr', '-n', '-P', 'show', 'assoc', 'user={user}', 'format=MaxSubmitJobs'],
+    'SGE': ['qconf', '-sconf', 'global'],
+    'TORQUE': ['qmgr', '-c', 'list server']}
+LIMITS_PATTERN = {
+    'SLURM': r'^\s*([0-9]+)\s*$',
+    'SGE': r'^\s*max_u_jobs\s+([0-9]+)',
+    'TORQUE': r'^\s*max_user_queuable\s*=\s*([0-9]+)'}
+
+# Adaptive throttling: period (seconds) of the bulk queries of the jobs and of the account
+# limits, fraction of the limits used (the user may submit other jobs meanwhile), number of
+# submissions allowed in a burst, and attempts before a job is tagged as failed
+THROTTLE_INTERVAL = 15
+LIMITS_INTERVAL = 600
+LIMITS_USAGE = 0.95
+SUBMIT_BURST = 10
+SUBMIT_ATTEMPTS = 3
+
+# Pilot workers: period (seconds) of the long polls of the workers, and time after which an
+# idle worker leaves
+PILOT_POLL = 5
+PILOT_IDLE = 120
+
+# Fields of a batch holding one value per job
+JOB_FIELDS = ['cmds', 'failed_tags', 'names', 'times']
+
+
+
+def log(msg):
+    """Prints a timestamped message (the main job redirects it to the log of the jobs manager)
+    """
+
+    print(strftime('[%Y-%m-%d %H:%M:%S] ') + msg, file=stderr, flush=True)
+
+
+
+def touch(path):
+    """Creates an empty file (or updates its modification time)
+    """
+
+    try:
+        with open(path, 'a'):
+            pass
+    except OSError as e:
+        log('Failed to create the file:\n' + path + '\n' + str(e))
+
+
+
+def new_file(tmp_dir, prefix, suffix, content):
+    """Creates a new file with a unique name in the temporary directory
+    """
+
+    (fd, path) = mkstemp(prefix=prefix, suffix=suffix, dir=tmp_dir)
+    with os.fdopen(fd, 'w', newline='\n') as file:
+        file.write(content)
+
+    return path
+
+
+
+def base_jobid(jobid):
+    """ID of the job (or of the job array) from the ID of a job (or of an array task)
+    """
+
+    match = re.match('[0-9]+', jobid.strip())
+    return match.group(0) if match else ''
+
+
+
+def count_range(tasks):
+    """Number of tasks of a range of array tasks as printed by the schedulers (e.g. '4-10%2'
+    holds 7 tasks, '1-50:2' 25, '3,5,7' 3)
+    """
+
+    count = 0
+    for item in tasks.split('%')[0].split(','):
+        (bounds, _, step) = item.partition(':')
+        bounds = bounds.split('-')
+        step = int(step) if step.isdigit() and int(step) > 0 else 1
+        if len(bounds) == 2 and all(x.isdigit() for x in bounds):
+            count += max(0, (int(bounds[1]) - int(bounds[0])) // step + 1)
+        else:
+            count += 1
+
+    return count
+
+
+
+def count_tasks(scheduler, cols):
+    """Number of jobs behind a line of the bulk query (see QUERY_CMD): the tasks in the brackets
+    of the ID (e.g. '123_[4-10%2]' holds 7 tasks), or in the last column with SGE (e.g.
+    '1-50:1' holds 50 tasks)
+    """
+
+    if scheduler == 'SGE':
+        rest = cols[SGE_SLOTS_COL:]
+        if rest and not rest[0].isdigit():
+            rest = rest[1:] # Queue of a running job
+        return count_range(rest[1]) if len(rest) > 1 else 1
+
+    match = re.search(r'\[([0-9,\-:%]+)\]', cols[0])
+
+    return count_range(match.group(1)) if match else 1
+
+
+
+def query_jobs(scheduler):
+    """Queries the state of all the jobs of the user with a single call to the scheduler.
+    Returns a list of (job ID, state, number of tasks), the state being
+    'PENDING', 'RUNNING' or 'OTHER', or None if the query failed.
+    """
+
+    cmd = [x.format(user=getuser()) for x in QUERY_CMD[scheduler]]
+    try:
+        out = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                             universal_newlines=True, check=True).stdout
+    except (OSError, subprocess.CalledProcessError) as e:
+        log('Failed to query the jobs state:\n' + ' '.join(cmd) + '\n' + str(e))
+        return None
+
+    jobs = []
+    for line in out.splitlines():
+        cols = line.split()
+        if not cols or not base_jobid(cols[0]):
+            continue # Headers
+        state = cols[QUERY_STATE_COL[scheduler]] if len(cols) > QUERY_STATE_COL[scheduler] else ''
+        if state in PENDING_STATES:
+            state = 'PENDING'
+        elif state in RUNNING_STATES:
+            state = 'RUNNING'
+        else:
+            state = 'OTHER'
+        jobs.append((cols[0], state, count_tasks(scheduler, cols)))
+
+    return jobs
+
+
+
+def cancel_jobs(scheduler, jobids, arrays=None):
+    """Cancels jobs (or whole job arrays) with one call to the scheduler per chunk of IDs.
+    With TORQUE, the job arrays among the IDs are cancelled as such ('123[]'), each ID being
+    cancelled in both forms if they are unknown (arrays is None).
+    """
+
+    jobids = sorted(jobids, key=int)
+    if scheduler == 'TORQUE':
+        jobids = [y for x in jobids for y in ([x] if arrays is None or x not in arrays else []) +
+                  ([x + '[]'] if arrays is None or x in arrays else [])]
+    for i in range(0, len(jobids), CANCEL_CHUNK_SIZE):
+        cmd = CANCEL_CMD[scheduler] + jobids[i:i + CANCEL_CHUNK_SIZE]
+        try:
+            subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        except OSError as e:
+            log('Failed to cancel the jobs:\n' + ' '.join(cmd) + '\n' + str(e))
+
+
+
+def query_limit(scheduler):
+    """Queries the account limit on the number of jobs of the user (pending or running).
+    Returns the lowest limit found, or None if there is none or if the query failed.
+    """
+
+    cmd = [x.format(user=getuser()) for x in LIMITS_CMD[scheduler]]
+    try:
+        out = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                             universal_newlines=True, check=True).stdout
+    except (OSError, subprocess.CalledProcessError) as e:
+        log('Failed to query the account limits:\n' + ' '.join(cmd) + '\n' + str(e))
+        return None
+
+    limits = [int(x) for x in re.findall(LIMITS_PATTERN[scheduler], out, re.MULTILINE) if int(x) > 0]
+    return min(limits) if limits else None
+
+
+
+def clean(spec):
+    """Cancels the submitted jobs that are still pending or running.
+    The jobs known to be finished (from their events) are left out, the others are found
+    with one bulk query. The cost is then one call per chunk of jobs (or of job arrays),
+    whatever the number of jobs. The flat log of the jobs is read if the store fails.
+    """
+
+    try:
+        store = open_store(spec['jobs_store'])
+        if spec['events_dir']:
+            import_events(store, spec['events_dir'])
+        submitted = alive_jobids(store)
+    except sqlite3.Error as e:
+        log('Failed to read the store of the jobs, reading the flat log instead:\n' + spec['jobs_store'] + '\n' + str(e))
+        store = None
+        try:
+            submitted = set(x['base'] for x in read_log(log_path(spec['jobs_store']), spec['events_dir'])
+                            if x['state'] in ALIVE_STATES and x['base'])
+        except OSError as e:
+            log('Failed to read the flat log of the jobs:\n' + log_path(spec['jobs_store']) + '\n' + str(e))
+            return
+
+    if not submitted or spec['scheduler'] == 'NONE':
+        return
+
+    jobs = query_jobs(spec['scheduler'])
+    if jobs is None:
+        (alive, arrays) = (submitted, None) # Better try to cancel everything than nothing
+    else:
+        alive = submitted & set(base_jobid(x[0]) for x in jobs if x[1] != 'OTHER')
+        arrays = set(base_jobid(x[0]) for x in jobs if '[' in x[0])
+
+    cancel_jobs(spec['scheduler'], alive, arrays)
+    try:
+        if store is not None:
+            cancel_jobids(store, submitted)
+    except sqlite3.Error as e:
+        log('Failed to record the cancellation of the jobs:\n' + spec['jobs_store'] + '\n' + str(e))
+    log('Cancelled ' + str(len(alive)) + ' job(s) (or job arrays)')
+
+
+
+def load_steps_options(jobs_spec_steps):
+    """Reads the specifications of the jobs of each step (see spark_resources.py), by step
+    """
+
+    steps_options = dict()
+    if not jobs_spec_steps:
+        return steps_options
+
+    try:
+        with open(jobs_spec_steps, 'r', newline='\n') as file:
+            for line in file:
+                fields = line.split()
+                if fields:
+                    steps_options[fields[0]] = tuple(fields[1:])
+    except OSError as e:
+        log('Failed to read the jobs specifications file:\n' + jobs_spec_steps + '\n' + str(e))
+
+    return steps_options
+
+
+
+def load_stage_tables(spec):
+    """(Re)loads the tables of the inputs of the jobs written by the pipeline controllers
+    (job name, then the input files, tab separated), once they changed
+    """
+
+    try:
+        with os.scandir(spec['stage_tables']) as it:
+            tables = sorted((x.path, x.stat().st_mtime_ns) for x in it if x.name.endswith('.tsv'))
+    except OSError:
+        return
+    if tables == spec['stage_tables_state']:
+        return
+
+    stage_inputs = dict()
+    for (table, _) in tables:
+        try:
+            with open(table, 'r', newline='\n') as file:
+                for line in file:
+                    fields = line.rstrip('\n').split('\t')
+                    if len(fields) > 1:
+                        stage_inputs[fields[0]] = fields[1:]
+        except OSError as e:
+            log('Failed to read the table of the inputs of the jobs:\n' + table + '\n' + str(e))
+    spec['stage_inputs'] = stage_inputs
+    spec['stage_tables_state'] = tables
+
+
+
+def job_inputs(cmd, spec):
+    """Input files of a job to stage, the job being found from the files named after it
+    in its command (e.g. its script)
+    """
+
+    names = [os.path.splitext(os.path.basename(x))[0] for x in re.findall('[^\\s"\']+', cmd)]
+    for reload in [False, True]:
+        if reload:
+            load_stage_tables(spec)
+        for name in names:
+            if name in spec['stage_inputs']:
+                return spec['stage_inputs'][name]
+
+    return []
+
+
+
+def parse_request(line, spec):
+    """Parses a job request read from the FIFO, formatted as:
+    qsub_options -N NAME [OPTIONS] SPLIT_LINE KIND COMMAND [SPLIT_LINE failed_tag PATH]
+    where KIND is 'singularity_exec_options' (written by PSOM in the Singularity version)
+    or 'shell_exec_options' (written by psom_run_script.m in the MATLAB version).
+    The full name of the job is found from the files named after it in its command (the
+    scheduler name NAME being shortened by PSOM).
+    The specifications of the step of the job (if any) are added to its options, in place of
+    their memory and wall time (see strip_spec).
+    In the Singularity version, the command runs the wrapper of the submission with the
+    Singularity options of the job (see frames/job_wrapper.bash), preceded by the inputs of the
+    job to stage, if any.
+    Returns None if the request is invalid.
+    """
+
+    fields = line.split('SPLIT_LINE ')
+    qsub_options = fields[0].split()
+    if len(qsub_options) < 3 or qsub_options[0] != 'qsub_options':
+        return None
+
+    step_options = spec['steps_options'].get(job_step(qsub_options[2]), ())
+    request = {
+        'name': qsub_options[2],
+        'job': qsub_options[2],
+        'time': time(),
+        'options': (strip_spec(spec['scheduler'], qsub_options[3:]) if step_options else tuple(qsub_options[3:])) + step_options,
+        'cmd': '',
+        'failed_tag': ''}
+    for field in fields[1:]:
+        (kind, _, value) = field.strip().partition(' ')
+        if kind == 'singularity_exec_options':
+            value = ' '.join(value.split())
+            inputs = job_inputs(value, spec) if spec['stage_dir'] else []
+            stage = '--stage ' + ' '.join([shlex.quote(x) for x in inputs]) + ' ' if inputs else ''
+            request['cmd'] = '"' + spec['job_wrapper'] + '" ' + stage + '-- ' + value
+        elif kind == 'shell_exec_options':
+            request['cmd'] = value
+        elif kind == 'failed_tag':
+            request['failed_tag'] = value
+
+    if not request['cmd']:
+        return None
+
+    names = [os.path.splitext(os.path.basename(x))[0] for x in re.findall('[^\\s"\';]+', request['cmd'])]
+    request['job'] = next((x for x in names if x.startswith(request['name'])), request['name'])
+
+    return request
+
+
+
+def record_jobs(spec, names, times, ids, state):
+    """Records submissions of jobs in the flat log and in the store (one transaction), with the
+    step and the subject of each job. The store is left aside once it fails, the flat log
+    being enough for the cleaning.
+    """
+
+    queued = time()
+    jobs = [{'name': x, 'step': step_of(x), 'subject': subject_of(x, spec['subjects']), 'jobid': i,
+             'base': base_jobid(i), 'submit': t, 'queued': queued, 'state': state}
+            for (x, t, i) in zip(names, times, ids)]
+    try:
+        append_log(log_path(spec['jobs_store']), jobs)
+    except OSError as e:
+        log('Failed to record the jobs in the flat log:\n' + log_path(spec['jobs_store']) + '\n' + str(e))
+    if spec['store'] is None:
+        return
+    try:
+        add_jobs(spec['store'], jobs)
+    except sqlite3.Error as e:
+        log('Failed to record the jobs in the store, only in the flat log from now on:\n' + spec['jobs_store'] + '\n' + str(e))
+        spec['store'] = None
+
+
+
+def job_command(cmd, name, spec):
+    """Command of a single job, run by spark_events.py with the events directory
+    """
+
+    if not spec['events_dir']:
+        return cmd
+
+    return 'python3 "' + os.path.dirname(os.path.abspath(__file__)) + '/spark_events.py" run "' + \
+        spec['events_dir'] + '" ' + shlex.quote(name) + ' -- bash -c ' + shlex.quote(cmd)
+
+
+
+def job_script(batch, spec):
+    """Script of a job, or of a job array whose tasks pick their command by their index, given
+    to the submission command on its standard input (no file per job on the shared file
+    system, the Singularity options being handled by the wrapper of the submission).
+    With the events directory, the command is run by spark_events.py, which records its timing.
+    """
+
+    (cmds, names) = (batch['cmds'], batch['names'])
+    if len(cmds) == 1:
+        return '#!/bin/bash\n' + job_command(cmds[0], names[0], spec) + '\n'
+
+    return '#!/bin/bash\n' + 'case "' + TASK_ID + '" in\n' + \
+        ''.join(['    ' + str(i) + ')\n        ' + job_command(x, y, spec) + '\n        ;;\n'
+                 for (i, (x, y)) in enumerate(zip(cmds, names), 1)]) + \
+        'esac\n'
+
+
+
+async def submit_batch(batch, spec):
+    """Submits a batch of compatible jobs, as a single job or as a job array,
+    and records the submitted jobs in the store (or tags them as failed).
+    With the adaptive throttling, a failed submission is retried a few times, and lowers the
+    cap of the jobs in flight (see adapt_cap).
+    """
+
+    size = len(batch['cmds'])
+    job = job_script(batch, spec)
+
+    cmd = [x.format(name=batch['name']) for x in SUBMIT_CMD[spec['scheduler']]] + list(batch['options'])
+    if size > 1:
+        cmd += [x.format(size=size) for x in ARRAY_OPT[spec['scheduler']]]
+
+    async with spec['semaphore']:
+        try:
+            proc = await asyncio.create_subprocess_exec(
+                *cmd, stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT)
+            out = (await proc.communicate(job.encode()))[0].decode(errors='replace')
+            status = proc.returncode
+        except OSError as e:
+            out = str(e)
+            status = 1
+
+    throttle = spec['throttle']
+    throttle['submitting'] -= size
+
+    jobid = re.search('[0-9]+', out)
+    if status != 0 or jobid is None:
+        log('Failed to submit the job(s) ' + batch['name'] + ':\n' + ' '.join(cmd) + '\n' + out)
+        throttle['failures'] += 1
+        batch['attempts'] = batch.get('attempts', 1) + 1
+        if throttle['adaptive'] and batch['attempts'] <= SUBMIT_ATTEMPTS:
+            throttle['retries'].append(batch) # Retried after the next bulk query (see regulate)
+            return
+        for tag in batch['failed_tags']:
+            if tag:
+                touch(tag)
+        record_jobs(spec, batch['names'], batch['times'], [''] * size, 'rejected')
+        if spec['events_dir']:
+            write_events(spec['events_dir'], 'manager', [
+                {'event': 'rejected', 'job': x, 'time': time()} for x in batch['names']])
+        return
+
+    if throttle['adaptive']:
+        throttle['submitted'][jobid.group(0)] = size
+        throttle['in_flight'] += size
+
+    if size == 1:
+        ids = [jobid.group(0)]
+    else:
+        ids = [jobid.group(0) + TASK_SEP[spec['scheduler']] + str(i) for i in range(1, size + 1)]
+    record_jobs(spec, batch['names'], batch['times'], ids, 'queued')
+
+    if spec['events_dir']:
+        queued = time()
+        write_events(spec['events_dir'], 'manager',
+            [{'event': 'submit', 'job': x, 'time': t} for (x, t) in zip(batch['names'], batch['times'])] +
+            [{'event': 'queued', 'job': x, 'id': i, 'time': queued} for (x, i) in zip(batch['names'], ids)])
+
+    log('Submitted ' + str(size) + ' job(s) ' + batch['name'] + ': ' + ids[0])
+
+
+
+def adapt_cap(throttle, jobs, limit):
+    """Adapts the cap of the jobs in flight (submitted and still pending or running) from the
+    state of all the jobs of the user, within the configured bounds:
+    - lowered by a quarter if submissions failed, or if more of our jobs are pending than
+      running (busy cluster, more jobs would only wait in the queue)
+    - raised by a quarter if the cap is reached while few of our jobs are pending (idle
+      cluster, the queue runs dry)
+    The effective cap is further kept below the account limit, minus the other jobs of the user.
+    """
+
+    ours = [x for x in jobs if x[1] != 'OTHER' and base_jobid(x[0]) in throttle['submitted']]
+    pending = sum(x[2] for x in ours if x[1] == 'PENDING')
+    running = sum(x[2] for x in ours if x[1] == 'RUNNING')
+    others = sum(x[2] for x in jobs if x[1] != 'OTHER') - pending - running
+
+    # The jobs being submitted are not known by the scheduler yet
+    throttle['in_flight'] = pending + running
+    (low, high) = throttle['bounds']
+    cap = throttle['cap']
+    if throttle['failures'] or pending > running:
+        cap = max(low, cap - max(1, cap // 4))
+    elif throttle['in_flight'] + throttle['submitting'] >= throttle['effective'] and 4 * pending <= running + low:
+        cap = min(high, cap + max(1, cap // 4))
+    throttle['failures'] = 0
+
+    effective = cap
+    if limit is not None:
+        effective = max(0, min(cap, int(LIMITS_USAGE * limit) - others))
+
+    if effective != throttle['effective']:
+        log('Cap of the jobs in flight: ' + str(effective) + ' (pending: ' + str(pending) + ', running: ' +
+            str(running) + ', other jobs: ' + str(others) + ', limit: ' + str(limit) + ')')
+    (throttle['cap'], throttle['effective']) = (cap, effective)
+
+    # Only the IDs of the jobs still alive are kept
+    alive = set(base_jobid(x[0]) for x in ours)
+    throttle['submitted'] = dict((k, v) for (k, v) in throttle['submitted'].items() if k in alive)
+
+
+
+async def regulate(spec):
+    """Periodically adapts the cap of the jobs in flight, with one bulk query of the jobs of
+    the user (and, less often, of the account limits)
+    """
+
+    loop = asyncio.get_running_loop()
+    throttle = spec['throttle']
+    (limit, limit_stamp) = (None, None)
+    while True:
+        await asyncio.sleep(THROTTLE_INTERVAL)
+
+        if limit_stamp is None or monotonic() - limit_stamp >= LIMITS_INTERVAL:
+            limit = await loop.run_in_executor(None, query_limit, spec['scheduler'])
+            limit_stamp = monotonic()
+
+        # The jobs submitted during the query are counted as in flight until the next one
+        submitted = set(throttle['submitted'])
+        jobs = await loop.run_in_executor(None, query_jobs, spec['scheduler'])
+        if jobs is not None:
+            recent = dict((k, v) for (k, v) in throttle['submitted'].items() if k not in submitted)
+            adapt_cap(throttle, jobs, limit)
+            throttle['submitted'].update(recent)
+            throttle['in_flight'] += sum(recent.values())
+
+        spec['ready'].extendleft(reversed(throttle['retries']))
+        throttle['retries'] = []
+        spec['wake'].set()
+
+
+
+async def take_token(throttle):
+    """Waits for a token of the bucket limiting the rate of the submissions (refilled at the
+    configured rate, up to SUBMIT_BURST tokens)
+    """
+
+    if not throttle['rate']:
+        return
+
+    while True:
+        now = monotonic()
+        throttle['tokens'] = min(SUBMIT_BURST, throttle['tokens'] + (now - throttle['stamp']) * throttle['rate'])
+        throttle['stamp'] = now
+        if throttle['tokens'] >= 1:
+            throttle['tokens'] -= 1
+            return
+        await asyncio.sleep((1 - throttle['tokens']) / throttle['rate'])
+
+
+
+async def dispatch(spec):
+    """Submits the ready batches in order, within the cap of the jobs in flight (a batch
+    is split into smaller job arrays when the room is short) and the rate of the submissions
+    """
+
+    loop = asyncio.get_running_loop()
+    (ready, wake, throttle) = (spec['ready'], spec['wake'], spec['throttle'])
+    tasks = set()
+
+    while True:
+        if not ready:
+            wake.clear()
+            await wake.wait()
+            continue
+
+        room = len(ready[0]['cmds'])
+        if throttle['adaptive']:
+            room = min(room, throttle['effective'] - throttle['in_flight'] - throttle['submitting'])
+        if room <= 0:
+            wake.clear() # Until the next bulk query
+            await wake.wait()
+            continue
+
+        await take_token(throttle)
+
+        # The room may have changed while waiting
+        if not ready:
+            continue
+        batch = ready[0]
+        if throttle['adaptive']:
+            room = min(room, throttle['effective'] - throttle['in_flight'] - throttle['submitting'])
+            if room <= 0:
+                continue
+        if room >= len(batch['cmds']):
+            ready.popleft()
+        else:
+            (batch, ready[0]) = (dict(batch, **dict([(x, batch[x][:room]) for x in JOB_FIELDS])),
+                                 dict(batch, **dict([(x, batch[x][room:]) for x in JOB_FIELDS])))
+
+        throttle['submitting'] += len(batch['cmds'])
+        task = loop.create_task(submit_batch(batch, spec))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+
+
+def pick_jobs(queue, msg):
+    """Takes from the queue the first jobs fitting in the free cores and memory of a worker
+    (its memory being unknown, or the memory of a job being unknown, only the cores count).
+    A job larger than the memory of the worker is given to it once it runs no job, so that it
+    is not held forever.
+    """
+
+    (slots, memory) = (msg['slots'], msg['memory'])
+    (jobs, skipped) = ([], [])
+    while queue and slots > 0 and len(skipped) < ARRAY_MAX_SIZE:
+        job = queue.popleft()
+        if memory is None or job['memory'] <= memory or (not msg['running'] and not jobs):
+            jobs.append(job)
+            slots -= 1
+            memory = None if memory is None else max(0, memory - job['memory'])
+        else:
+            skipped.append(job)
+    queue.extendleft(reversed(skipped))
+
+    return jobs
+
+
+
+async def take_jobs(pilot, msg):
+    """Long poll of a worker: waits for jobs, for at most PILOT_POLL seconds (or none if jobs wait
+    but do not fit in the worker, which then waits for one of its jobs to end)
+    """
+
+    deadline = monotonic() + PILOT_POLL
+    while True:
+        jobs = pick_jobs(pilot['queue'], msg)
+        if jobs or pilot['queue'] or monotonic() >= deadline:
+            return jobs
+
+        pilot['wake'].clear()
+        try:
+            await asyncio.wait_for(pilot['wake'].wait(), deadline - monotonic())
+        except asyncio.TimeoutError:
+            pass
+
+
+
+def requeue(jobs, spec):
+    """Puts back in the queue the jobs of a lost worker (e.g. killed at its wall time), or tags
+    them as failed after SUBMIT_ATTEMPTS attempts
+    """
+
+    pilot = spec['pilot']
+    failed = []
+    for job in sorted(jobs, key=lambda x: x['time'], reverse=True):
+        job['attempts'] += 1
+        if job['attempts'] <= SUBMIT_ATTEMPTS:
+            pilot['queue'].appendleft(job)
+            continue
+        failed.append(job)
+        if job['failed_tag']:
+            touch(job['failed_tag'])
+
+    if jobs:
+        log('Lost ' + str(len(jobs)) + ' job(s) with their worker, ' + str(len(failed)) + ' tagged as failed')
+        pilot['wake'].set()
+    if failed:
+        record_jobs(spec, [x['job'] for x in failed], [x['time'] for x in failed], [''] * len(failed), 'rejected')
+    if failed and spec['events_dir']:
+        write_events(spec['events_dir'], 'manager', [{'event': 'rejected', 'job': x['job'], 'time': time()} for x in failed])
+
+
+
+async def serve_worker(reader, writer, spec):
+    """Serves the long polls of a pilot worker (see spark_pilot.py): each request reports the
+    jobs the worker finished and its free cores and memory, each answer gives it new jobs.
+    The jobs of a worker lost before it finished them are requeued.
+    """
+
+    pilot = spec['pilot']
+    pilot['connections'].add(asyncio.current_task())
+    assigned = dict()
+    worker = ''
+    try:
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            msg = json.loads(line.decode())
+            if not secrets.compare_digest(str(msg.get('token')), pilot['token']):
+                log('Ignoring a connection with an invalid token')
+                break
+            if not worker:
+                worker = msg['worker']
+                pilot['connected'].add(worker)
+                log('Worker connected: ' + worker)
+            for name in msg['done']:
+                assigned.pop(name, None)
+
+            jobs = await take_jobs(pilot, msg)
+            for job in jobs:
+                assigned[job['job']] = job
+            if jobs:
+                record_jobs(spec, [x['job'] for x in jobs], [x['time'] for x in jobs], [worker] * len(jobs), 'queued')
+            writer.write((json.dumps({'jobs': [dict((k, x[k]) for k in ['job', 'cmd', 'memory']) for x in jobs],
+                                      'queued': len(pilot['queue'])}) + '\n').encode())
+            await writer.drain()
+
+            if jobs and spec['events_dir']:
+                queued = time()
+                write_events(spec['events_dir'], 'manager',
+                    [{'event': 'submit', 'job': x['job'], 'time': x['time']} for x in jobs] +
+                    [{'event': 'queued', 'job': x['job'], 'id': worker, 'time': queued} for x in jobs])
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        log('Lost the connection to the worker ' + worker + ':\n' + str(e))
+    except asyncio.CancelledError:
+        pass # The jobs manager stops
+    finally:
+        writer.close()
+        pilot['connections'].discard(asyncio.current_task())
+        pilot['connected'].discard(worker)
+        requeue(list(assigned.values()), spec)
+        if worker:
+            log('Worker disconnected: ' + worker)
+
+
+
+async def submit_workers(count, spec):
+    """Submits pilot workers, as a single job or as a job array, with the specifications of
+    the workers, and records them in the store
+    """
+
+    pilot = spec['pilot']
+    cmd = [x.format(name='spark_pilot') for x in SUBMIT_CMD[spec['scheduler']]] + spec['pilot_spec'].split()
+    if count > 1:
+        cmd += [x.format(size=count) for x in ARRAY_OPT[spec['scheduler']]]
+    cmd += [pilot['script']]
+
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            *cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT)
+        out = (await proc.communicate())[0].decode(errors='replace')
+        status = proc.returncode
+    except OSError as e:
+        out = str(e)
+        status = 1
+
+    jobid = re.search('[0-9]+', out)
+    if status != 0 or jobid is None:
+        log('Failed to submit the pilot workers:\n' + ' '.join(cmd) + '\n' + out)
+        return False
+
+    pilot['workers'][jobid.group(0)] = count
+    if count == 1:
+        ids = [jobid.group(0)]
+    else:
+        ids = [jobid.group(0) + TASK_SEP[spec['scheduler']] + str(i) for i in range(1, count + 1)]
+    record_jobs(spec, ['spark_pilot'] * count, [time()] * count, ids, 'queued')
+    log('Submitted ' + str(count) + ' pilot worker(s): ' + jobid.group(0))
+
+    return True
+
+
+
+async def provision(spec):
+    """Keeps enough pilot workers alive for the jobs in the queue, up to the configured number
+    of workers: the workers alive are counted from one bulk query of the jobs of the user
+    (at most every THROTTLE_INTERVAL seconds), those submitted but not connected yet being
+    expected to take jobs
+    """
+
+    loop = asyncio.get_running_loop()
+    pilot = spec['pilot']
+    stamp = None
+    while True:
+        await asyncio.sleep(PILOT_POLL)
+        if not pilot['queue']:
+            continue
+
+        if stamp is None or monotonic() - stamp >= THROTTLE_INTERVAL:
+            jobs = await loop.run_in_executor(None, query_jobs, spec['scheduler'])
+            stamp = monotonic()
+            if jobs is not None:
+                alive = dict()
+                for x in jobs:
+                    if x[1] != 'OTHER' and base_jobid(x[0]) in pilot['workers']:
+                        alive[base_jobid(x[0])] = alive.get(base_jobid(x[0]), 0) + x[2]
+                pilot['workers'] = alive
+
+        workers = sum(pilot['workers'].values())
+        waiting = max(0, workers - len(pilot['connected']))
+        count = min(spec['pilot_workers'] - workers, len(pilot['queue']) - waiting)
+        if count > 0 and not await submit_workers(count, spec):
+            stamp = None
+
+
+
+async def run_local(spec):
+    """Runs the jobs on the local machine (no scheduler), with a pilot worker started whenever
+    jobs wait and no worker is running (the worker leaving once idle).
+    The worker runs in a process group of its own, terminated with its jobs when the jobs
+    manager stops (see main).
+    """
+
+    pilot = spec['pilot']
+    while True:
+        if not pilot['queue']:
+            pilot['wake'].clear()
+            try:
+                await asyncio.wait_for(pilot['wake'].wait(), PILOT_POLL)
+            except asyncio.TimeoutError:
+                pass
+            continue
+
+        try:
+            proc = await asyncio.create_subprocess_exec('bash', pilot['script'], stdin=asyncio.subprocess.DEVNULL,
+                                                        start_new_session=True)
+        except OSError as e:
+            log('Failed to start the local worker:\n' + pilot['script'] + '\n' + str(e))
+            await asyncio.sleep(PILOT_POLL)
+            continue
+
+        try:
+            await proc.wait()
+        finally:
+            if proc.returncode is None:
+                try:
+                    os.killpg(proc.pid, signal.SIGTERM)
+                except ProcessLookupError:
+                    pass
+
+
+
+async def feed(spec):
+    """Moves the ready batches to the queue of the pilot workers, job by job (the memory of a
+    job being taken from the specifications of its step, if any)
+    """
+
+    (ready, wake, pilot) = (spec['ready'], spec['wake'], spec['pilot'])
+    while True:
+        if not ready:
+            wake.clear()
+            await wake.wait()
+            continue
+
+        batch = ready.popleft()
+        memory = spec_memory(batch['options'])
+        for (cmd, tag, name, t) in zip(batch['cmds'], batch['failed_tags'], batch['names'], batch['times']):
+            pilot['queue'].append({'job': name, 'cmd': job_command(cmd, name, spec), 'failed_tag': tag,
+                                   'time': t, 'memory': memory, 'attempts': 1})
+        pilot['wake'].set()
+
+
+
+async def setup_pilot(spec):
+    """Starts the server of the pilot workers (on all the IPv4 interfaces, the workers running
+    on the compute nodes, or on the loopback interface only for the local executor), and writes
+    its address with the token of the submission in the temporary directory (readable by the
+    user only), and the script of the workers
+    """
+
+    pilot = {
+        'queue': deque(),
+        'wake': asyncio.Event(),
+        'workers': dict(),
+        'connected': set(),
+        'connections': set(),
+        'token': secrets.token_hex(16)}
+    spec['pilot'] = pilot
+
+    # A single socket (with both families, the ports of the sockets would differ)
+    host = '127.0.0.1' if spec['scheduler'] == 'NONE' else '0.0.0.0'
+    server = await asyncio.start_server(lambda r, w: serve_worker(r, w, spec), host=host, port=0, limit=2**20)
+    port = server.sockets[0].getsockname()[1]
+    host = host if spec['scheduler'] == 'NONE' else gethostname()
+
+    address = os.sep.join([spec['tmp_dir'], 'pilot.addr'])
+    tmp_address = address + '.' + str(os.getpid())
+    with open(os.open(tmp_address, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as file:
+        file.write(host + ' ' + str(port) + ' ' + pilot['token'] + '\n')
+    os.replace(tmp_address, address)
+
+    pilot['script'] = new_file(spec['tmp_dir'], 'pilot-', '.bash', '#!/bin/bash\n' +
+        'python3 "' + os.path.dirname(os.path.abspath(__file__)) + '/spark_pilot.py" "' + address + '" ' +
+        str(PILOT_IDLE) + '\n')
+    os.chmod(pilot['script'], 0o744)
+
+    log('Serving the pilot workers on ' + host + ':' + str(port))
+
+    return server
+
+
+
+async def serve(spec):
+    """Reads the job requests from the FIFO and submits them concurrently.
+    The requests read within the same time window and with the same submission options
+    are grouped into job arrays, then handed to the dispatcher (see dispatch), or, with pilot
+    workers or without scheduler (local executor), to the queue of the workers (see feed).
+    A rejected request is answered through the 'failed' tag of its job, read by PSOM.
+    """
+
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader(limit=2**20)
+
+    # Opened read-write: never blocks nor reaches EOF when the writers come and go
+    fifo = open(os.open(spec['fifo'], os.O_RDWR), 'rb', buffering=0)
+    await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), fifo)
+
+    batches = dict()
+    window = spec['jobs_array_window']
+
+    server = None
+    if spec['scheduler'] == 'NONE':
+        server = await setup_pilot(spec)
+        tasks = [loop.create_task(feed(spec)), loop.create_task(run_local(spec))]
+    elif spec['pilot_workers']:
+        server = await setup_pilot(spec)
+        tasks = [loop.create_task(feed(spec)), loop.create_task(provision(spec))]
+    else:
+        tasks = [loop.create_task(dispatch(spec))]
+        if spec['throttle']['adaptive']:
+            tasks.append(loop.create_task(regulate(spec)))
+
+    def flush(keys):
+        for key in keys:
+            spec['ready'].append(batches.pop(key))
+        spec['wake'].set()
+
+    log('Listening to the FIFO:\n' + spec['fifo'])
+    try:
+        while True:
+            if batches:
+                timeout = max(0, min(x['deadline'] for x in batches.values()) - monotonic())
+            else:
+                timeout = None
+
+            try:
+                line = await asyncio.wait_for(reader.readline(), timeout)
+            except asyncio.TimeoutError:
+                flush([k for (k, x) in batches.items() if x['deadline'] <= monotonic()])
+                continue
+
+            line = line.decode(errors='replace').strip()
+            if not line:
+                continue
+
+            request = parse_request(line, spec)
+            if request is None:
+                log('Ignoring a value read from the FIFO:\n' + line)
+                continue
+
+            # Jobs are compatible when they share the submission options (job name aside) and their
+            # step (the accounting of a job array being matched to a step by its name)
+            key = (job_step(request['job']),) + request['options']
+            if key not in batches:
+                batches[key] = {
+                    'name': request['name'],
+                    'options': request['options'],
+                    'cmds': [],
+                    'failed_tags': [],
+                    'names': [],
+                    'times': [],
+                    'deadline': monotonic() + window}
+            batches[key]['cmds'].append(request['cmd'])
+            batches[key]['failed_tags'].append(request['failed_tag'])
+            batches[key]['names'].append(request['job'])
+            batches[key]['times'].append(request['time'])
+
+            if window <= 0 or len(batches[key]['cmds']) >= ARRAY_MAX_SIZE:
+                flush([key])
+    finally:
+        # Stopped by the main job: no new workers, the connected ones being let go
+        if server is not None:
+            server.close()
+            for task in list(spec['pilot']['connections']):
+                task.cancel()
+            await server.wait_closed()
+
+
+
+def setup_throttle(spec):
+    """State of the throttling of the submissions: cap of the jobs in flight (adaptive if
+    bounds are given) and token bucket of the submissions (if a rate is given)
+    """
+
+    low = max(1, spec['min_queued_jobs'])
+    high = max(low, spec['max_queued_jobs'])
+    cap = min(high, max(low, spec['init_queued_jobs']))
+
+    return {
+        'adaptive': spec['min_queued_jobs'] > 0,
+        'bounds': (low, high),
+        'cap': cap,
+        'effective': cap,
+        'in_flight': 0,
+        'submitting': 0,
+        'submitted': dict(),
+        'failures': 0,
+        'retries': [],
+        'rate': max(0, spec['submit_rate']),
+        'tokens': SUBMIT_BURST,
+        'stamp': monotonic()}
+
+
+
+def check_iargs_parser(iargs):
+    """Defines the possible arguments of the program, generates help and usage messages,
+    and issues errors in case of invalid arguments.
+    """
+
+    parser = ArgumentParser(
+        prog='spark_jobs_manager.py',
+        description='Submits the pipeline jobs to the scheduler (started by the main job).')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    serve_parser = subparsers.add_parser('serve', help='Reads the job requests from a FIFO and submits them.')
+    serve_parser.add_argument('--scheduler', required=True, choices=['NONE', 'SGE', 'SLURM', 'TORQUE'])
+    serve_parser.add_argument('--tmp-dir', required=True, dest='tmp_dir')
+    serve_parser.add_argument('--fifo', required=True)
+    serve_parser.add_argument('--jobs-store', required=True, dest='jobs_store')
+    serve_parser.add_argument('--job-wrapper', default='', dest='job_wrapper')
+    serve_parser.add_argument('--jobs-array-window', type=int, default=0, dest='jobs_array_window')
+    serve_parser.add_argument('--jobs-spec-steps', default='', dest='jobs_spec_steps')
+    serve_parser.add_argument('--stage-dir', default='', dest='stage_dir')
+    serve_parser.add_argument('--stage-tables', default='', dest='stage_tables')
+    serve_parser.add_argument('--events-dir', default='', dest='events_dir')
+    serve_parser.add_argument('--pilot-workers', type=int, default=0, dest='pilot_workers')
+    serve_parser.add_argument('--pilot-spec', default='', dest='pilot_spec')
+    serve_parser.add_argument('--max-concurrent-submissions', type=int, default=8, dest='max_concurrent_submissions')
+    serve_parser.add_argument('--min-queued-jobs', type=int, default=0, dest='min_queued_jobs')
+    serve_parser.add_argument('--max-queued-jobs', type=int, default=0, dest='max_queued_jobs')
+    serve_parser.add_argument('--init-queued-jobs', type=int, default=0, dest='init_queued_jobs')
+    serve_parser.add_argument('--submit-rate', type=float, default=0, dest='submit_rate')
+
+    clean_parser = subparsers.add_parser('clean', help='Cancels the submitted jobs that are still pending or running.')
+    clean_parser.add_argument('--scheduler', required=True, choices=['NONE', 'SGE', 'SLURM', 'TORQUE'])
+    clean_parser.add_argument('--jobs-store', required=True, dest='jobs_store')
+    clean_parser.add_argument('--events-dir', default='', dest='events_dir')
+
+    return vars(parser.parse_args(iargs))
+
+
+
+def main(iargs):
+    """Main function, runs the requested command
+    """
+
+    spec = check_iargs_parser(iargs)
+
+    if spec['command'] == 'serve':
+        spec['steps_options'] = load_steps_options(spec['jobs_spec_steps'])
+        spec['stage_inputs'] = dict()
+        spec['stage_tables_state'] = None
+        spec['throttle'] = setup_throttle(spec)
+        try:
+            spec['store'] = open_store(spec['jobs_store'])
+            spec['subjects'] = load_subjects(spec['store'])
+        except sqlite3.Error as e:
+            log('Failed to open the store of the jobs, only the flat log is written:\n' + spec['jobs_store'] + '\n' + str(e))
+            (spec['store'], spec['subjects']) = (None, set())
+        async def run():
+            spec['semaphore'] = asyncio.Semaphore(max(1, spec['max_concurrent_submissions']))
+            spec['ready'] = deque()
+            spec['wake'] = asyncio.Event()
+            # Stopped by the main job (SIGTERM): the tasks are cancelled, the local worker terminated
+            asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+            await serve(spec)
+        try:
+            asyncio.run(run())
+        except asyncio.CancelledError:
+            log('Stopped')
+    elif spec['command'] == 'clean':
+        clean(spec)
+
+
+
+############## Main
+if __name__ == "__main__":
+    main(argv[1:])
@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Store of the pipeline jobs of a submission (SQLite database in the temporary directory):
+# one row per submission of a job, with its scheduler ID, PSOM job name, step, subject, times
+# (submitted, queued, started, ended) and state, indexed for the cleaning, the status and the
+# reports (meant to be used by spark_setup.py and spark_jobs_manager.py).
+# The output directory is usually on a shared file system, where SQLite in WAL mode is not
+# safe (its shared memory index needs all the processes on one node): the database is in
+# rollback journal mode, only written by the jobs manager, the compute nodes recording their
+# events apart (see spark_events.py). The submissions are also appended to a flat log beside
+# the database (jobs.db, jobs.log), read instead of the database when it fails.
+#
+# Usage:
+#     spark_jobs_store.py STORE status [--events-dir EVENTS_DIR]
+#     spark_jobs_store.py STORE failed [--events-dir EVENTS_DIR]
+# status: number of jobs per step and state; failed: the jobs whose last submission failed.
+# With the events directory, the start and end of the jobs are imported first. The flat log is
+# read if the store cannot be queried.
+#
+# Last revision: October, 2026
+# Maintainer: Obai Bin Ka'b Ali @aliobaibk
+# License: In the app folder or check GNU GPL-3.0.
+
+
+
+from argparse import ArgumentParser
+from collections import Counter
+from operator import itemgetter
+import os
+import sqlite3
+from sys import argv, stderr
+from sys import exit as sys_exit
+
+from spark_events import read_events
+
+
+
+# Waiting time (seconds) for the lock of the database held by another process
+BUSY_TIMEOUT = 30
+
+# States of a job: queued (pending or running for the scheduler), running (started on a
+# compute node), done, failed, rejected (submission failed) or cancelled
+ALIVE_STATES = ['queued', 'running']
+
+# Fields of a submission, in the store and in the flat log
+FIELDS = ['name', 'step', 'subject', 'jobid', 'base', 'submit', 'queued', 'state']
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS subjects (
+    subject TEXT PRIMARY KEY);
+CREATE TABLE IF NOT EXISTS jobs (
+    name TEXT NOT NULL,
+    step TEXT,
+    subject TEXT,
+    jobid TEXT,
+    base TEXT,
+    submit REAL,
+    queued REAL,
+    start REAL,
+    end REAL,
+    state TEXT NOT NULL,
+    exit INTEGER);
+CREATE INDEX IF NOT EXISTS jobs_name ON jobs (name);
+CREATE INDEX IF NOT EXISTS jobs_base ON jobs (base);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, step);
+'''
+
+
+
+def open_store(path):
+    """Opens the store (in rollback journal mode, safe on a shared file system: the readers wait
+    for the jobs manager to commit, BUSY_TIMEOUT at most)
+    """
+
+    store = sqlite3.connect(path, timeout=BUSY_TIMEOUT)
+    store.execute('PRAGMA journal_mode=DELETE')
+    store.execute('PRAGMA synchronous=NORMAL')
+
+    return store
+
+
+
+def create_store(path, subjects):
+    """Creates an empty store (replacing the one of a previous submission), with the IDs of the
+    subjects (to tell the subject of a job from its name)
+    """
+
+    for suffix in ['', '-journal', '-wal', '-shm']:
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+    store = open_store(path)
+    with store:
+        store.executescript(SCHEMA)
+        store.executemany('INSERT OR IGNORE INTO subjects VALUES (?)', [(x,) for x in subjects])
+    store.close()
+
+
+
+def load_subjects(store):
+    """IDs of the subjects
+    """
+
+    return set(x[0] for x in store.execute('SELECT subject FROM subjects'))
+
+
+
+def subject_of(name, subjects):
+    """Subject of a job, from its name (PSOM names the jobs after the data they process),
+    '' if none
+    """
+
+    return next((x for x in name.split('_') if x in subjects), '')
+
+
+
+def add_jobs(store, jobs):
+    """Records submissions of jobs with one transaction, as dictionaries of: name, step,
+    subject, jobid, base, submit, queued, state (the missing fields being NULL)
+    """
+
+    with store:
+        store.executemany('INSERT INTO jobs (' + ', '.join(FIELDS) + ') VALUES (' + ', '.join(['?'] * len(FIELDS)) + ')',
+                          [tuple(x.get(k) for k in FIELDS) for x in jobs])
+
+
+
+def log_path(path):
+    """Flat log of the submissions kept beside the store (jobs.db: jobs.log)
+    """
+
+    return os.path.splitext(path)[0] + '.log'
+
+
+
+def append_log(path, jobs):
+    """Appends submissions of jobs to the flat log, one tab-separated line of the fields each
+    (as given to add_jobs)
+    """
+
+    with open(path, 'a', newline='\n') as file:
+        file.write(''.join('\t'.join('' if x.get(k) is None else str(x.get(k)) for k in FIELDS) + '\n' for x in jobs))
+
+
+
+def read_log(path, events_dir=''):
+    """Reads the submissions of the flat log (the fallback of the store), as dictionaries of the
+    fields plus the exit code, the start and the end of the jobs imported from their events
+    into their last submission
+    """
+
+    jobs = []
+    last = dict()
+    with open(path, 'r', newline='\n') as file:
+        for line in file:
+            values = line.rstrip('\n').split('\t')
+            if len(values) == len(FIELDS):
+                last[values[0]] = len(jobs)
+                jobs.append(dict(zip(FIELDS, values), exit=None))
+
+    for x in read_events(events_dir) if events_dir else []:
+        if x.get('job') not in last:
+            continue
+        job = jobs[last[x['job']]]
+        if x.get('event') == 'start' and job['state'] == 'queued':
+            job['state'] = 'running'
+        elif x.get('event') == 'end':
+            (job['state'], job['exit']) = ('done' if x['exit'] == 0 else 'failed', x['exit'])
+
+    return jobs
+
+
+
+def import_events(store, events_dir):
+    """Imports the start and the end of the jobs from their events, into their last submission
+    """
+
+    last = '(SELECT max(rowid) FROM jobs WHERE name = ?)'
+    events = read_events(events_dir)
+    with store:
+        store.executemany('UPDATE jobs SET start = ?, state = \'running\' WHERE rowid = ' + last + ' AND state = \'queued\'',
+                          [(x['time'], x['job']) for x in events if x.get('event') == 'start'])
+        store.executemany('UPDATE jobs SET end = ?, exit = ?, state = ? WHERE rowid = ' + last,
+                          [(x['time'], x['exit'], 'done' if x['exit'] == 0 else 'failed', x['job'])
+                           for x in events if x.get('event') == 'end'])
+
+
+
+def alive_jobids(store):
+    """IDs of the jobs (or job arrays) that may still be pending or running
+    """
+
+    return set(x[0] for x in store.execute(
+        'SELECT DISTINCT base FROM jobs WHERE state IN (' + ', '.join(['?'] * len(ALIVE_STATES)) + ') AND base != \'\'',
+        ALIVE_STATES))
+
+
+
+def all_jobids(store):
+    """IDs of all the jobs (or job arrays) submitted
+    """
+
+    return set(x[0] for x in store.execute('SELECT DISTINCT base FROM jobs WHERE base != \'\''))
+
+
+
+def cancel_jobids(store, jobids):
+    """Records the cancellation of the jobs still alive among the given IDs
+    """
+
+    with store:
+        store.executemany('UPDATE jobs SET state = \'cancelled\' WHERE base = ? AND state IN (' +
+                          ', '.join(['?'] * len(ALIVE_STATES)) + ')', [(x,) + tuple(ALIVE_STATES) for x in jobids])
+
+
+
+def status(store):
+    """Number of jobs per step and state (of their last submission)
+    """
+
+    return store.execute(
+        'SELECT step, state, count(*) FROM jobs WHERE rowid IN (SELECT max(rowid) FROM jobs GROUP BY name) '
+        'GROUP BY step, state ORDER BY step, state').fetchall()
+
+
+
+def failed_jobs(store):
+    """Jobs whose last submission failed or was rejected: name, subject, scheduler ID, exit code
+    """
+
+    return store.execute(
+        'SELECT name, subject, jobid, exit FROM jobs WHERE rowid IN (SELECT max(rowid) FROM jobs GROUP BY name) '
+        'AND state IN (\'failed\', \'rejected\') ORDER BY name').fetchall()
+
+
+
+def log_status(jobs):
+    """Number of jobs per step and state (of their last submission), from the flat log
+    """
+
+    last = dict((x['name'], x) for x in jobs)
+    counts = Counter((x['step'], x['state']) for x in last.values())
+
+    return [k + (counts[k],) for k in sorted(counts)]
+
+
+
+def log_failed_jobs(jobs):
+    """Jobs whose last submission failed or was rejected, from the flat log
+    """
+
+    last = dict((x['name'], x) for x in jobs)
+
+    return [(x['name'], x['subject'], x['jobid'], x['exit']) for x in sorted(last.values(), key=itemgetter('name'))
+            if x['state'] in ['failed', 'rejected']]
+
+
+
+def check_iargs_parser(iargs):
+    """Defines the possible arguments of the program, generates help and usage messages,
+    and issues errors in case of invalid arguments.
+    """
+
+    parser = ArgumentParser(
+        prog='spark_jobs_store.py',
+        description='Queries the store of the pipeline jobs of a submission (\'tmp/jobs.db\' of the output directory).')
+    parser.add_argument('store', help='Store of the jobs.')
+    parser.add_argument('command', choices=['status', 'failed'],
+                        help='status: number of jobs per step and state; failed: the jobs whose last submission failed.')
+    parser.add_argument('--events-dir', default='', dest='events_dir',
+                        help='Directory of the events of the jobs, imported first (\'tmp/events\' of the output directory).')
+
+    return vars(parser.parse_args(iargs))
+
+
+
+def main(iargs):
+    """Main function, prints the result of the query
+    """
+
+    oargs = check_iargs_parser(iargs)
+
+    try:
+        if not os.path.isfile(oargs['store']):
+            raise sqlite3.OperationalError('Nonexistent file')
+        store = open_store(oargs['store'])
+        if oargs['events_dir']:
+            import_events(store, oargs['events_dir'])
+        rows = status(store) if oargs['command'] == 'status' else failed_jobs(store)
+    except sqlite3.Error as e:
+        print('Failed to query the store of the jobs, reading the flat log instead:\n' + oargs['store'] + '\n' + str(e),
+              file=stderr)
+        try:
+            jobs = read_log(log_path(oargs['store']), oargs['events_dir'])
+        except OSError as e:
+            print('Failed to read the flat log of the jobs:\n' + log_path(oargs['store']) + '\n' + str(e), file=stderr)
+            sys_exit(1)
+        rows = log_status(jobs) if oargs['command'] == 'status' else log_failed_jobs(jobs)
+
+    if oargs['command'] == 'status':
+        for (step, state, count) in rows:
+            print('%-30s %-10s %8d' % (step, state, count))
+    else:
+        for (name, subject, jobid, code) in rows:
+            print('%-60s %-20s %-20s %s' % (name, subject, jobid, '' if code is None else code))
+
+
+
+############## Main
+if __name__ == "__main__":
+    main(argv[1:])
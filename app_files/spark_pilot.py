@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Pilot worker: runs many pipeline jobs inside a single scheduler allocation, or on the local
+# machine (meant to be started by spark_jobs_manager.py, see --pilot-workers and
+# --local-executor).
+# The worker connects to the jobs manager, pulls the pipeline jobs from its queue and runs
+# several of them at once within the cores and the memory of the allocation, then leaves
+# once the queue stays empty.
+#
+# Usage:
+#     spark_pilot.py ADDRESS_FILE IDLE
+# where ADDRESS_FILE holds the address of the jobs manager and the token of the submission
+# (host port token), and IDLE is the time (seconds) after which an idle worker leaves.
+#
+# Last revision: October, 2026
+# Maintainer: Obai Bin Ka'b Ali @aliobaibk
+# License: In the app folder or check GNU GPL-3.0.
+
+
+
+import asyncio
+import json
+import os
+import re
+from socket import gethostname
+from sys import argv, stderr
+from sys import exit as sys_exit
+from time import monotonic, strftime
+
+from spark_instance import OWNER_VAR, stop_instances
+
+
+
+# Variables holding the number of cores of the allocation, by scheduler
+CORES_VARS = ['SLURM_CPUS_ON_NODE', 'NSLOTS', 'PBS_NUM_PPN']
+
+# Variables holding the ID of the allocation, by scheduler
+JOBID_VARS = ['SLURM_JOB_ID', 'JOB_ID', 'PBS_JOBID']
+
+# Variables setting the number of threads of the BLAS/LAPACK libraries (and of OpenMP)
+THREADS_VARS = ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS']
+
+# Memory limits of the control groups (v2 then v1)
+CGROUP_LIMITS = ['/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory/memory.limit_in_bytes']
+
+
+
+def log(msg):
+    """Prints a timestamped message (to the output of the allocation)
+    """
+
+    print(strftime('[%Y-%m-%d %H:%M:%S] ') + msg, file=stderr, flush=True)
+
+
+
+def detect_cores():
+    """Number of cores of the allocation (or usable by the process)
+    """
+
+    for var in CORES_VARS:
+        if os.environ.get(var, '').isdigit() and int(os.environ[var]) > 0:
+            return int(os.environ[var])
+
+    return len(os.sched_getaffinity(0))
+
+
+
+def detect_memory():
+    """Memory (bytes) usable by the jobs: the available memory of the node, within the limit
+    of the allocation (SLURM_MEM_PER_NODE, or the limit of its control group)
+    """
+
+    memory = []
+    try:
+        with open('/proc/meminfo', 'r') as file:
+            match = re.search(r'^MemAvailable:\s+([0-9]+) kB', file.read(), re.MULTILINE)
+        if match:
+            memory.append(int(match.group(1)) * 2**10)
+    except OSError:
+        pass
+
+    if os.environ.get('SLURM_MEM_PER_NODE', '').isdigit():
+        memory.append(int(os.environ['SLURM_MEM_PER_NODE']) * 2**20)
+    for path in CGROUP_LIMITS:
+        try:
+            with open(path, 'r') as file:
+                value = file.read().strip()
+            if value.isdigit():
+                memory.append(int(value))
+        except OSError:
+            continue
+
+    return min(memory) if memory else 0
+
+
+
+def read_address(address_file):
+    """Host, port and token of the jobs manager
+    """
+
+    with open(address_file, 'r') as file:
+        (host, port, token) = file.read().split()
+
+    return (host, int(port), token)
+
+
+
+async def run_job(job, worker):
+    """Runs the command of a pipeline job, its BLAS/LAPACK libraries being limited to a single
+    thread (the worker running one job per core, instead of one thread per core for every job),
+    with the ID of the worker (owner of the warm instances, see spark_instance.py).
+    Returns the job and its exit code.
+    """
+
+    env = dict(os.environ, **dict((x, '1') for x in THREADS_VARS), **{OWNER_VAR: worker})
+    try:
+        proc = await asyncio.create_subprocess_exec('bash', '-c', job['cmd'], stdin=asyncio.subprocess.DEVNULL, env=env)
+        status = await proc.wait()
+    except OSError as e:
+        log('Failed to run the job ' + job['job'] + ':\n' + str(e))
+        status = 127
+
+    return (job, status)
+
+
+
+async def work(address_file, idle):
+    """Pulls the jobs from the jobs manager and runs them, as long as the cores and the memory
+    left allow (see pick_jobs in spark_jobs_manager.py), one job per core.
+    Leaves once no job was received for IDLE seconds, or when the jobs manager is gone (the
+    jobs running being left to finish), stopping its warm instances (if any).
+    """
+
+    (host, port, token) = read_address(address_file)
+    worker = next((os.environ[x] for x in JOBID_VARS if os.environ.get(x)), gethostname()) + '.' + str(os.getpid())
+    (cores, memory) = (detect_cores(), detect_memory())
+    log('Worker ' + worker + ' on ' + gethostname() + ': ' + str(cores) + ' core(s), ' +
+        '%.1f GB' % (memory / 2**30) + ', jobs manager ' + host + ':' + str(port))
+
+    (reader, writer) = await asyncio.open_connection(host, port, limit=2**24)
+    running = dict()
+    done = []
+    last = monotonic()
+    try:
+        while True:
+            if len(running) >= cores:
+                finished = (await asyncio.wait(list(running), return_when=asyncio.FIRST_COMPLETED))[0]
+            else:
+                finished = [x for x in running if x.done()]
+            for task in finished:
+                (job, status) = task.result()
+                del running[task]
+                done.append(job['job'])
+                log('Job ' + job['job'] + ' ended (exit code ' + str(status) + ')')
+
+            used = sum(x['memory'] for x in running.values())
+            writer.write((json.dumps({
+                'token': token, 'worker': worker, 'done': done, 'running': len(running),
+                'slots': cores - len(running), 'memory': max(0, memory - used) if memory else None}) + '\n').encode())
+            await writer.drain()
+            done = []
+
+            line = await reader.readline()
+            if not line:
+                log('The jobs manager is gone')
+                break
+
+            answer = json.loads(line.decode())
+            jobs = answer['jobs']
+            for job in jobs:
+                running[asyncio.get_running_loop().create_task(run_job(job, worker))] = job
+            if not jobs and answer['queued'] and running:
+                # The jobs waiting do not fit until one of ours ends
+                await asyncio.wait(list(running), return_when=asyncio.FIRST_COMPLETED)
+            if jobs or running:
+                last = monotonic()
+            elif monotonic() - last >= idle:
+                log('No job for ' + str(idle) + ' seconds, leaving')
+                break
+    except (OSError, ValueError, KeyError) as e:
+        log('Lost the connection to the jobs manager:\n' + str(e))
+    finally:
+        writer.close()
+
+    if running:
+        await asyncio.wait(list(running))
+    stop_instances(worker)
+
+    return 0
+
+
+
+def main(iargs):
+    """Main function: spark_pilot.py ADDRESS_FILE IDLE
+    """
+
+    if len(iargs) != 2 or not iargs[1].isdigit():
+        print('Usage: spark_pilot.py ADDRESS_FILE IDLE', file=stderr)
+        sys_exit(2)
+
+    try:
+        sys_exit(asyncio.run(work(iargs[0], int(iargs[1]))))
+    except (OSError, ValueError) as e:
+        log('Failed to reach the jobs manager:\n' + iargs[0] + '\n' + str(e))
+        sys_exit(1)
+
+
+
+############## Main
+if __name__ == "__main__":
+    main(argv[1:])
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Plans the jobs of the pipeline without submitting anything (dry run): job graph, number of
+# jobs per step, estimated core-hours and storage, and scheduler submissions
+# (meant to be used by spark_setup.py)
+#
+# Last revision: October, 2026
+# Maintainer: Obai Bin Ka'b Ali @aliobaibk
+# License: In the app folder or check GNU GPL-3.0.
+
+
+
+from spark_headers import count_voxels
+from spark_resources import STEPS, UNITS, count_jobs, estimate_storage, estimate_usage, load_resources
+
+
+
+# Names of the steps of the pipeline
+STEP_NAMES = ['bootstrap resampling', 'sparse dictionary learning', 'spatial clustering', 'k-hubness maps']
+
+
+
+def read_pipe_opt(pipe_opt):
+    """Reads the options of a pipeline controller (as written by setup_pipe_opt)
+    """
+
+    opt = dict()
+    with open(pipe_opt, 'r', newline='\n') as file:
+        for line in file:
+            (k, _, v) = line.rstrip('\n').partition(' ')
+            opt[k] = v
+
+    return opt
+
+
+
+def read_fmri_data(fmri_data):
+    """Reads the fMRI data of a pipeline controller, one run per row (as written by
+    setup_pipe_opt)
+    """
+
+    with open(fmri_data, 'r', newline='\n') as file:
+        return [line.rstrip('\n').split('\t') for line in file if line.strip()]
+
+
+
+def format_size(value):
+    """Human readable size
+    """
+
+    for unit in ['B', 'KB', 'MB', 'GB', 'TB']:
+        if value < 1024 or unit == 'TB':
+            return ('%d ' if unit == 'B' else '%.1f ') % value + unit
+        value /= 1024
+
+
+
+def plan_controller(opt, headers, nb_voxels, factors):
+    """Plans the jobs of the steps run by a pipeline controller.
+    Returns, for each of its steps: the number of jobs, the number of jobs the job of the step
+    with the most inputs depends on (fan-in), the estimated memory of its largest job (bytes),
+    the estimated core-hours (the sum over its jobs, see UNITS) and storage (bytes), or None for
+    the estimates if the headers of the data could not be read.
+    """
+
+    fmri_data = read_fmri_data(opt['fmri_data'])
+    nb_resamplings = int(opt['nb_resamplings'])
+    network_scales = [int(x) for x in opt['network_scales'].split(' ')]
+    scales = list(range(network_scales[0], network_scales[2] + 1, max(1, network_scales[1])))
+
+    sessions = dict()
+    for data in fmri_data:
+        sessions[(data[0], data[1])] = sessions.get((data[0], data[1]), 0) + 1
+    units = {'runs': len(fmri_data), 'resamplings': nb_resamplings, 'scales': len(scales), 'sessions': len(sessions)}
+    runs_per_session = max(sessions.values())
+
+    # Per run, grouped by number of time points
+    timepoints = dict()
+    for data in fmri_data:
+        header = headers.get(data[-1])
+        nb = header['nb_timepoints'] if header is not None else 0
+        timepoints[nb] = timepoints.get(nb, 0) + 1
+
+    # The jobs of the runs of a group, at a network scale (the jobs per session being shared
+    # among the groups in proportion of their runs)
+    usage = dict([(x, [0, 0]) for x in STEPS])
+    storage = dict([(x, 0) for x in STEPS])
+    for (nb, count) in timepoints.items():
+        if not nb or not nb_voxels:
+            usage = None
+            break
+        group = dict(units, runs=count, scales=1, sessions=units['sessions'] * count / units['runs'])
+        for scale in scales:
+            estimates = estimate_usage(nb_voxels, nb, nb_resamplings, scale, int(opt['nb_iterations']),
+                                       opt['sparse_coding_method'], factors, runs_per_session)
+            for x in STEPS:
+                nb_jobs = count_jobs(x, group) / (1 if 'scales' in UNITS[x] else len(scales))
+                usage[x] = [max(usage[x][0], estimates[x][0]), usage[x][1] + nb_jobs * estimates[x][1]]
+        # The outputs of the steps per session are written once per session, not per run
+        sizes = estimate_storage(nb_voxels, nb, nb_resamplings, network_scales)
+        for x in STEPS:
+            storage[x] += (group['sessions'] if 'sessions' in UNITS[x] else count) * sizes[x]
+
+    fan_in = {
+        'tseries_': 0,
+        'kmdl': 1,
+        'global_d': nb_resamplings * runs_per_session,
+        'kmap': nb_resamplings * runs_per_session + 1}
+
+    plan = dict()
+    for step in [int(x) for x in opt['steps'].split(' ') if x]:
+        x = STEPS[step - 1]
+        nb_jobs = count_jobs(x, units)
+        plan[step] = [nb_jobs, fan_in[x]] + \
+            ([usage[x][0], usage[x][1] / 3600, storage[x]] if usage is not None else [None, None, None])
+
+    return plan
+
+
+
+def read_max_queued(pipe_opt):
+    """Maximum number of jobs queued at once by a pipeline controller (from its PSOM
+    configuration file, next to its pipeline options)
+    """
+
+    try:
+        with open(pipe_opt[:-len('pipe.opt')] + 'psom-gb/psom_gb_vars_local.m', 'r') as file:
+            for line in file:
+                if line.startswith('gb_psom_max_queued = '):
+                    return line.split('=')[1].strip(' ;\n')
+    except OSError:
+        pass
+
+    return None
+
+
+
+def setup_plan(iargs, controllers):
+    """Report of the dry run: the planned job graph of each pipeline controller (stages run
+    one after the other, controllers of a stage in parallel), the total number of jobs,
+    core-hours and storage, and the number of submissions to the scheduler
+    """
+
+    mask = iargs['headers'][iargs['mask']]
+    nb_voxels = count_voxels(iargs['mask'], mask) if mask is not None else 0
+    factors = load_resources(iargs['cache_dir'])['factors']
+
+    lines = ['Dry run: nothing was submitted, the pipeline options and the PSOM configuration',
+             'files are in:', iargs['out_dir'], '']
+    totals = [0, 0, 0]
+    waves = 0
+    unknown = False
+    for (i, stage) in enumerate(controllers):
+        for pipe_opt in stage:
+            opt = read_pipe_opt(pipe_opt)
+            plan = plan_controller(opt, iargs['headers'], nb_voxels, factors)
+            max_parallel_jobs = int(read_max_queued(pipe_opt) or iargs['max_parallel_jobs'])
+            lines += ['Stage ' + str(i + 1) + ', controller ' + (opt['controller'] or 'pipeline') + ':',
+                      '    ' + pipe_opt,
+                      '    %-30s %10s %8s %12s %12s %12s' % ('step', 'jobs', 'fan-in', 'memory/job', 'core-hours', 'storage')]
+            for (step, (nb_jobs, fan_in, memory, core_hours, storage)) in sorted(plan.items()):
+                lines.append('    %-30s %10d %8d %12s %12s %12s' % (
+                    str(step) + '. ' + STEP_NAMES[step - 1], nb_jobs, fan_in,
+                    format_size(memory) if memory is not None else '?',
+                    '%.1f' % core_hours if core_hours is not None else '?',
+                    format_size(storage) if storage is not None else '?'))
+                totals[0] += nb_jobs
+                totals[1] += core_hours or 0
+                totals[2] += storage or 0
+                unknown = unknown or core_hours is None
+                # PSOM keeps at most max_parallel_jobs jobs in the queue, refilled as they finish
+                waves += -(-nb_jobs // max_parallel_jobs)
+            lines.append('')
+
+    lines += ['Total: ' + str(totals[0]) + ' jobs, ' + '%.1f' % totals[1] + ' core-hours, ' + format_size(totals[2]) +
+              (' (unknown for the data whose header could not be read)' if unknown else '')]
+    if iargs['max_queued_jobs']:
+        queued = 'from ' + str(iargs['max_queued_jobs'][0]) + ' to ' + str(iargs['max_queued_jobs'][1]) + \
+            ' jobs queued at once (adapted to the queue)'
+    else:
+        queued = 'at most ' + str(iargs['max_parallel_jobs']) + ' jobs queued at once'
+    if iargs['pilot_workers']:
+        lines.append('Scheduler: submissions of pilot workers (at most ' + str(iargs['pilot_workers']) + ' alive at once, ' +
+                     'submitted as job arrays while jobs wait), running the ' + str(totals[0]) + ' jobs')
+    elif iargs['scheduler'] == 'NONE' and iargs['local_executor']:
+        lines.append('Scheduler: none, the jobs run on the local machine, as many at once as its cores and memory allow')
+    elif iargs['scheduler'] == 'NONE':
+        lines.append('Scheduler: none, the jobs run on the local machine')
+    elif iargs['jobs_array_window'] > 0:
+        lines.append('Scheduler: from ' + str(waves) + ' (job arrays of the queued jobs) to ' + str(totals[0]) +
+                     ' submissions, ' + queued)
+    else:
+        lines.append('Scheduler: ' + str(totals[0]) + ' submissions (one per job), ' + queued)
+
+    return '\n'.join(lines)
@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Reports where the time of a submission went, from the events of its jobs (see
+# spark_events.py): queue wait versus compute time per pipeline step, critical path,
+# stragglers, and metrics for the textfile collector of the Prometheus node exporter
+#
+# Last revision: October, 2026
+# Maintainer: Obai Bin Ka'b Ali @aliobaibk
+# License: In the app folder or check GNU GPL-3.0.
+
+
+
+from argparse import ArgumentParser
+from bisect import bisect_right
+import os
+from sys import argv, stderr
+from sys import exit as sys_exit
+
+from spark_events import read_events
+from spark_plan import STEP_NAMES
+from spark_resources import STEPS, job_step
+
+
+
+# A job is a straggler when its run time exceeds this factor times the median of its step
+STRAGGLER_FACTOR = 2
+
+# Maximum number of stragglers listed
+MAX_STRAGGLERS = 20
+
+
+
+def median(values):
+    """Median of a non-empty list
+    """
+
+    values = sorted(values)
+    n = len(values)
+    return values[n // 2] if n % 2 else (values[n // 2 - 1] + values[n // 2]) / 2
+
+
+
+def format_duration(seconds):
+    """Human readable duration
+    """
+
+    seconds = int(round(seconds))
+    return '%d:%02d:%02d' % (seconds // 3600, seconds % 3600 // 60, seconds % 60)
+
+
+
+def step_of(job):
+    """Step of the pipeline of a job (from the prefix of its name), 'other' if none
+    """
+
+    step = job_step(job)
+
+    return STEP_NAMES[STEPS.index(step)] if step is not None else 'other'
+
+
+
+def collect_jobs(events):
+    """Gathers the events of each job. A job submitted again (e.g. after a failure) is
+    described by its last attempt.
+    Returns a list of jobs: name, step, node, times of the events, exit code and peak memory.
+    """
+
+    jobs = dict()
+    for event in events:
+        name = event.get('job', '')
+        if event.get('event') == 'submit' or name not in jobs:
+            jobs[name] = {'name': name, 'step': step_of(name), 'node': '', 'id': '', 'exit': None, 'max_rss': 0,
+                          'submit': None, 'queued': None, 'start': None, 'end': None}
+        job = jobs[name]
+        if event.get('event') in ['submit', 'queued', 'start', 'end']:
+            job[event['event']] = event['time']
+        if event.get('event') == 'rejected':
+            job['exit'] = 'rejected'
+        for k in ['id', 'node', 'exit', 'max_rss']:
+            if k in event:
+                job[k] = event[k]
+
+    return list(jobs.values())
+
+
+
+def critical_path(jobs):
+    """Critical path of the finished jobs, walked back from the job that ended last.
+    The pipeline controller submits a job once its dependencies are done, so the predecessor
+    of a job is taken as the job that ended last before it was submitted (the graph of the
+    dependencies being held by PSOM only).
+    """
+
+    done = sorted([x for x in jobs if x['end'] is not None and x['start'] is not None and x['submit'] is not None],
+                  key=lambda x: x['end'])
+    if not done:
+        return []
+
+    ends = [x['end'] for x in done]
+    i = len(done) - 1
+    path = [done[i]]
+    while True:
+        i = bisect_right(ends, done[i]['submit'], hi=i)
+        if i == 0:
+            break
+        i -= 1
+        path.append(done[i])
+
+    return path[::-1]
+
+
+
+def summarize(jobs):
+    """Per step: number of jobs (finished, failed), queue wait and run time (total, median,
+    maximum) and peak memory
+    """
+
+    steps = dict()
+    for job in jobs:
+        step = steps.setdefault(job['step'], {'jobs': 0, 'failed': 0, 'waits': [], 'runs': [], 'max_rss': 0})
+        step['jobs'] += 1
+        if job['exit'] not in [0, None]:
+            step['failed'] += 1
+        if job['submit'] is not None and job['start'] is not None:
+            step['waits'].append(job['start'] - job['submit'])
+        if job['start'] is not None and job['end'] is not None:
+            step['runs'].append(job['end'] - job['start'])
+        step['max_rss'] = max(step['max_rss'], job['max_rss'] or 0)
+
+    order = STEP_NAMES + ['other']
+    return sorted(steps.items(), key=lambda x: order.index(x[0]))
+
+
+
+def stragglers(jobs):
+    """Jobs whose run time exceeds STRAGGLER_FACTOR times the median of their step, slowest first
+    """
+
+    runs = dict()
+    for job in jobs:
+        if job['start'] is not None and job['end'] is not None:
+            runs.setdefault(job['step'], []).append(job['end'] - job['start'])
+    medians = dict([(k, median(v)) for (k, v) in runs.items()])
+
+    slow = [x for x in jobs if x['start'] is not None and x['end'] is not None and
+            x['end'] - x['start'] > STRAGGLER_FACTOR * medians[x['step']] > 0]
+    return sorted(slow, key=lambda x: (x['end'] - x['start']) / medians[x['step']], reverse=True), medians
+
+
+
+def setup_report(jobs):
+    """Text report: time per step, critical path and stragglers
+    """
+
+    times = [x[k] for x in jobs for k in ['submit', 'end'] if x[k] is not None]
+    if not times:
+        return 'No job was recorded'
+    wall = max(times) - min(times)
+
+    lines = ['Wall time: ' + format_duration(wall) + ' (from the first submission to the last end), ' +
+             str(len(jobs)) + ' jobs', '',
+             '%-30s %8s %8s %12s %10s %10s %12s %10s %10s %10s' % (
+                 'step', 'jobs', 'failed', 'queue total', 'median', 'max', 'run total', 'median', 'max', 'peak mem')]
+    for (step, x) in summarize(jobs):
+        lines.append('%-30s %8d %8d %12s %10s %10s %12s %10s %10s %7.1f GB' % (
+            step, x['jobs'], x['failed'],
+            format_duration(sum(x['waits'])), format_duration(median(x['waits'])) if x['waits'] else '?',
+            format_duration(max(x['waits'] or [0])),
+            format_duration(sum(x['runs'])), format_duration(median(x['runs'])) if x['runs'] else '?',
+            format_duration(max(x['runs'] or [0])), x['max_rss'] / 2**30))
+
+    path = critical_path(jobs)
+    if path:
+        wait = sum(x['start'] - x['submit'] for x in path)
+        run = sum(x['end'] - x['start'] for x in path)
+        lines += ['', 'Critical path: ' + str(len(path)) + ' jobs, ' + format_duration(path[-1]['end'] - path[0]['submit']) +
+                  ' (queue: ' + format_duration(wait) + ', run: ' + format_duration(run) +
+                  ', between the jobs: ' + format_duration(path[-1]['end'] - path[0]['submit'] - wait - run) + ')']
+        for x in path:
+            lines.append('    %-60s queue %10s  run %10s  %s' % (
+                x['name'], format_duration(x['start'] - x['submit']), format_duration(x['end'] - x['start']), x['node']))
+
+    (slow, medians) = stragglers(jobs)
+    if slow:
+        lines += ['', 'Stragglers (run time over ' + str(STRAGGLER_FACTOR) + ' times the median of the step): ' + str(len(slow))]
+        for x in slow[:MAX_STRAGGLERS]:
+            lines.append('    %-60s run %10s  median %10s  %s' % (
+                x['name'], format_duration(x['end'] - x['start']), format_duration(medians[x['step']]), x['node']))
+
+    return '\n'.join(lines)
+
+
+
+def setup_metrics(jobs):
+    """Metrics in the text format of Prometheus
+    """
+
+    metrics = [
+        ('spark_step_jobs', 'Number of jobs of the step', []),
+        ('spark_step_failed_jobs', 'Number of jobs of the step that failed', []),
+        ('spark_step_queue_seconds', 'Total time spent by the jobs of the step in the queue', []),
+        ('spark_step_run_seconds', 'Total run time of the jobs of the step', []),
+        ('spark_step_max_rss_bytes', 'Peak memory of a job of the step', []),
+        ('spark_critical_path_seconds', 'Time spent on the critical path', []),
+        ('spark_stragglers', 'Number of jobs slower than ' + str(STRAGGLER_FACTOR) + ' times the median of their step', [])]
+
+    for (step, x) in summarize(jobs):
+        label = '{step="' + step + '"}'
+        metrics[0][2].append(label + ' ' + str(x['jobs']))
+        metrics[1][2].append(label + ' ' + str(x['failed']))
+        metrics[2][2].append(label + ' ' + '%.3f' % sum(x['waits']))
+        metrics[3][2].append(label + ' ' + '%.3f' % sum(x['runs']))
+        metrics[4][2].append(label + ' ' + str(x['max_rss']))
+
+    path = critical_path(jobs)
+    wait = sum(x['start'] - x['submit'] for x in path)
+    run = sum(x['end'] - x['start'] for x in path)
+    total = path[-1]['end'] - path[0]['submit'] if path else 0
+    for (part, value) in [('queue', wait), ('run', run), ('other', total - wait - run)]:
+        metrics[5][2].append('{part="' + part + '"} ' + '%.3f' % value)
+    metrics[6][2].append(' ' + str(len(stragglers(jobs)[0])))
+
+    lines = []
+    for (name, description, values) in metrics:
+        lines += ['# HELP ' + name + ' ' + description, '# TYPE ' + name + ' gauge'] + [name + x for x in values]
+
+    return '\n'.join(lines) + '\n'
+
+
+
+def save_metrics(path, metrics):
+    """Saves the metrics (atomically, the collector may read the file at any time)
+    """
+
+    try:
+        tmp_path = path + '.' + str(os.getpid())
+        with open(tmp_path, 'w', newline='\n') as file:
+            file.write(metrics)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print('--prometheus\n' +
+              'Failed to save the metrics:\n' + path + '\n' + str(e), file=stderr)
+        sys_exit(1)
+
+
+
+def check_iargs_parser(iargs):
+    """Defines the possible arguments of the program, generates help and usage messages,
+    and issues errors in case of invalid arguments.
+    """
+
+    parser = ArgumentParser(
+        prog='spark_report.py',
+        description='Reports where the time of a submission went, from the events of its jobs ' +
+                    '(in the directory \'tmp/events\' of the output directory).')
+    parser.add_argument('events_dir', help='Directory of the events of the jobs.')
+    parser.add_argument('--prometheus', default='',
+                        help='File where to write the metrics (for the textfile collector of the Prometheus node exporter, ' +
+                             'the file name must end with \'.prom\').')
+
+    return vars(parser.parse_args(iargs))
+
+
+
+def main(iargs):
+    """Main function, prints the report (and writes the metrics)
+    """
+
+    oargs = check_iargs_parser(iargs)
+
+    if not os.path.isdir(oargs['events_dir']):
+        print('Invalid or nonexistent directory:\n' + oargs['events_dir'], file=stderr)
+        sys_exit(1)
+
+    jobs = collect_jobs(read_events(oargs['events_dir']))
+    print(setup_report(jobs))
+
+    if oargs['prometheus']:
+        save_metrics(oargs['prometheus'], setup_metrics(jobs))
+
+
+
+############## Main
+if __name__ == "__main__":
+    main(argv[1:])
@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Generates in bulk the bootstrap resamplings (CBB, AR1B, AR1G) of the time series extracted
+# by spark_tseries.py, vectorized with NumPy (meant to be used by spark_setup.py)
+#
+# Last revision: October, 2026
+# Maintainer: Obai Bin Ka'b Ali @aliobaibk
+# License: In the app folder or check GNU GPL-3.0.
+
+
+
+from concurrent.futures import ProcessPoolExecutor
+import json
+import os
+from sys import stderr
+from zlib import crc32
+
+# Optional, the resamplings cannot be generated without it
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+
+# Maximum number of processes generating the resamplings
+MAX_WORKERS = 8
+
+# Maximum memory used by a batch of resamplings generated at once (bytes)
+BATCH_SIZE = 2**27
+
+# Version of the files, to be increased whenever their content changes
+RESAMPLING_VERSION = 1
+
+
+
+def cbb_indices(rng, nb_timepoints, window_lengths):
+    """Time indices of a circular-block-bootstrap sample: blocks of a window length randomly
+    selected, starting at random time points and wrapping around the end of the series
+    """
+
+    length = rng.choice(window_lengths)
+    starts = rng.integers(0, nb_timepoints, -(-nb_timepoints // length))
+    indices = (starts[:, None] + np.arange(length)[None, :]) % nb_timepoints
+
+    return indices.ravel()[:nb_timepoints]
+
+
+
+def ar1_fit(tseries):
+    """Fits a first-order auto-regressive model to each time series (column).
+    Returns the mean, the coefficient and the (centered) innovations of the series.
+    """
+
+    mean = tseries.mean(axis=0)
+    x = tseries - mean
+    phi = (x[1:] * x[:-1]).sum(axis=0) / np.maximum((x * x).sum(axis=0), np.finfo(x.dtype).tiny)
+    innovations = x[1:] - phi * x[:-1]
+    innovations -= innovations.mean(axis=0)
+
+    return (mean, phi, innovations)
+
+
+
+def ar1_series(phi, first, innovations):
+    """Runs the auto-regressive recursion of a batch of samples (resamplings x time points x
+    voxels), from their first time point and innovations
+    """
+
+    out = np.empty((innovations.shape[0], innovations.shape[1] + 1, innovations.shape[2]), dtype=innovations.dtype)
+    out[:, 0] = first
+    for t in range(innovations.shape[1]):
+        out[:, t+1] = phi * out[:, t] + innovations[:, t]
+
+    return out
+
+
+
+def sample_size(method, nb_timepoints, nb_voxels):
+    """Memory used to generate one resampling (bytes): the output sample, plus the time indices
+    (CBB), the drawn innovations (AR1B), or the Gaussian weights and the innovations they
+    combine (AR1G)
+    """
+
+    series = 4 * nb_timepoints * nb_voxels
+    if method == 'CBB':
+        return series + 8 * nb_timepoints
+    elif method == 'AR1B':
+        return 2 * series + 8 * nb_timepoints
+    else:
+        return 2 * series + 4 * nb_timepoints * (nb_timepoints - 1)
+
+
+
+def resample_batch(rng, tseries, method, window_lengths, model, nb):
+    """Generates a batch of nb resamplings of the time series of a run (time points x voxels).
+    The same time indices (or Gaussian weights) are used for all the voxels, so that the
+    spatial correlations are preserved.
+    """
+
+    nb_timepoints = tseries.shape[0]
+
+    if method == 'CBB':
+        indices = np.stack([cbb_indices(rng, nb_timepoints, window_lengths) for _ in range(nb)])
+        return tseries[indices]
+
+    (mean, phi, innovations) = model
+    scale = 1 / np.sqrt(np.maximum(1 - phi * phi, np.finfo(phi.dtype).eps))
+
+    if method == 'AR1B':
+        # I.i.d. bootstrap of the innovations, the first point drawn from the stationary law
+        draws = innovations[rng.integers(0, nb_timepoints - 1, (nb, nb_timepoints))]
+    else:
+        # Gaussian innovations with the spatial covariance of the observed ones: random
+        # combinations of the observed innovations (no voxels x voxels matrix is formed)
+        weights = rng.standard_normal((nb, nb_timepoints, nb_timepoints - 1), dtype=tseries.dtype)
+        weights *= 1 / np.sqrt(nb_timepoints - 2)
+        draws = weights @ innovations
+        del weights
+
+    series = ar1_series(phi, draws[:, 0] * scale, draws[:, 1:])
+    series += mean
+
+    return series
+
+
+
+def resample_run(ipath, opath, method, nb_resamplings, window_lengths):
+    """Generates the resamplings of a run into a float32 (resamplings x time points x voxels)
+    .npy file, by batches bounded in memory (see sample_size). The random generator is seeded from the name of
+    the run, for the resamplings to be reproducible.
+    """
+
+    tseries = np.load(ipath, mmap_mode='r')
+    tseries = np.array(tseries, dtype=np.float32)
+    (nb_timepoints, nb_voxels) = tseries.shape
+
+    rng = np.random.default_rng(crc32(os.path.basename(ipath).encode()))
+    model = ar1_fit(tseries) if method != 'CBB' else None
+
+    tmp_path = opath + '.' + str(os.getpid())
+    out = np.lib.format.open_memmap(tmp_path, mode='w+', dtype='<f4', shape=(nb_resamplings, nb_timepoints, nb_voxels))
+    batch = max(1, BATCH_SIZE // sample_size(method, nb_timepoints, nb_voxels))
+    for i in range(0, nb_resamplings, batch):
+        nb = min(batch, nb_resamplings - i)
+        out[i:i+nb] = resample_batch(rng, tseries, method, window_lengths, model, nb)
+    out.flush()
+    del out
+    os.replace(tmp_path, opath)
+
+    return opath
+
+
+
+def setup_resamplings(tseries, out_dir, method, nb_resamplings, block_window_length):
+    """Generates in parallel the resamplings of the time series of every run (as extracted by
+    setup_tseries), into out_dir/resamplings/SUBJECT_SESSION_RUN.npy. The runs whose time
+    series and options did not change since their last generation are not generated again.
+    Returns the list of the generated files.
+    """
+
+    resamplings_dir = os.sep.join([out_dir, 'resamplings'])
+    os.makedirs(resamplings_dir, exist_ok=True)
+
+    (begin, step, end) = block_window_length
+    window_lengths = list(range(begin, end + 1, step))
+
+    jobs = []
+    opaths = []
+    for ipath in tseries:
+        opath = os.sep.join([resamplings_dir, os.path.basename(ipath)])
+        st = os.stat(ipath)
+        source = {'version': RESAMPLING_VERSION, 'tseries': [ipath, st.st_mtime_ns, st.st_size],
+                  'method': method, 'nb_resamplings': nb_resamplings,
+                  'window_lengths': window_lengths if method == 'CBB' else []}
+        try:
+            with open(opath + '.json', 'r') as file:
+                done = json.load(file) == source and os.path.isfile(opath)
+        except (OSError, ValueError):
+            done = False
+        opaths.append(opath)
+        if not done:
+            jobs.append((ipath, opath, source))
+
+    if jobs:
+        with ProcessPoolExecutor(max_workers=min(MAX_WORKERS, os.cpu_count() or 1, len(jobs))) as pool:
+            futures = [(pool.submit(resample_run, x[0], x[1], method, nb_resamplings, window_lengths), x) for x in jobs]
+            for (future, (ipath, opath, source)) in futures:
+                try:
+                    future.result()
+                except (OSError, ValueError, MemoryError) as e:
+                    print('Failed to generate the resamplings of:\n' + ipath + '\n' + str(e), file=stderr)
+                    opaths.remove(opath)
+                    continue
+                with open(opath + '.json', 'w') as file:
+                    json.dump(source, file)
+
+    return opaths
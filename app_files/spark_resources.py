@@ -0,0 +1,399 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Estimates the memory and the wall time of the pipeline jobs from the data, and calibrates
+# the estimates from the accounting of the previous submissions
+# (meant to be used by spark_setup.py)
+#
+# Last revision: October, 2026
+# Maintainer: Obai Bin Ka'b Ali @aliobaibk
+# License: In the app folder or check GNU GPL-3.0.
+
+
+
+import json
+import os
+import re
+import sqlite3
+import subprocess
+from sys import stderr
+from sys import exit as sys_exit
+
+from spark_headers import count_voxels
+from spark_jobs_store import all_jobids, log_path, open_store, read_log
+
+
+
+# Version of the resources file in the cache, to be increased whenever the model changes
+RESOURCES_VERSION = 2
+
+# Pipeline steps, as prefixes of the names of their jobs: the only definition, also written in
+# the pipeline options for GNU Octave/MATLAB (see setup_pipe_opt in spark_setup.py). A job
+# belongs to a step when its name starts with the prefix, the prefixes being short enough to
+# match the names shortened by PSOM for the scheduler (8 characters) as well.
+STEPS = ['tseries_', 'kmdl', 'global_d', 'kmap']
+
+# Units of the job graph of SPARK (approximation, the exact graph being built by NIAK):
+# the jobs of a step are per run and resampling, per run, resampling and network scale, or
+# per session (subject/session) and network scale
+UNITS = {
+    'tseries_': ('runs', 'resamplings'),
+    'kmdl': ('runs', 'resamplings', 'scales'),
+    'global_d': ('sessions', 'scales'),
+    'kmap': ('sessions', 'scales')}
+
+# Memory used by GNU Octave/MATLAB and SPARK before loading any data (bytes)
+BASE_MEMORY = 512 * 2**20
+
+# Seconds per elementary operation of each step (before calibration)
+TIME_COST = {
+    'tseries_': 2e-8,
+    'kmdl': 2e-9,
+    'global_d': 5e-8,
+    'kmap': 5e-8}
+
+# Relative cost of the sparse coding methods
+CODING_COST = {
+    'Thresholding': 1,
+    'OMP': 4}
+
+# Safety margins and minimum requests
+MEMORY_MARGIN = 1.25
+TIME_MARGIN = 1.5
+MIN_MEMORY = 2**30
+MIN_TIME = 600
+
+# Options of the memory and the wall time of the jobs (SLURM, '-t' being the array option of
+# SGE and TORQUE), and resources of their '-l' lists (SGE, TORQUE), replaced by the estimates
+SPEC_OPTIONS = ['--mem', '--mem-per-cpu', '--mem-per-gpu', '--time']
+SPEC_RESOURCES = ['h_rt', 'h_vmem', 'mem_free', 's_vmem', 'walltime', 'mem', 'vmem', 'pmem', 'pvmem']
+
+# Bounds of the calibration factors, and quantile of the observed/estimated ratios of the jobs
+# of a submission used
+FACTOR_BOUNDS = (0.05, 20)
+CALIBRATION_QUANTILE = 0.95
+
+# Number of submissions kept in the cache for the calibration
+MAX_RUNS = 50
+
+# Accounting of the jobs (SLURM only)
+ACCOUNTING_CMD = ['sacct', '-n', '-P', '-o', 'JobID,JobName,State,ElapsedRaw,MaxRSS', '-j']
+FINISHED_STATES = {'COMPLETED', 'FAILED', 'CANCELLED', 'TIMEOUT', 'OUT_OF_MEMORY', 'NODE_FAIL'}
+SIZE_UNITS = {'K': 2**10, 'M': 2**20, 'G': 2**30, 'T': 2**40}
+
+
+
+def job_step(name):
+    """Step of a job (see STEPS), None if none
+    """
+
+    return next((x for x in STEPS if name.startswith(x)), None)
+
+
+
+def count_jobs(step, units):
+    """Number of jobs of a step, from the numbers of runs, resamplings, network scales and
+    sessions (see UNITS)
+    """
+
+    nb_jobs = 1
+    for unit in UNITS[step]:
+        nb_jobs *= units[unit]
+
+    return nb_jobs
+
+
+
+def estimate_usage(nb_voxels, nb_timepoints, nb_resamplings, scale, nb_iterations, sparse_coding_method, factors,
+                   runs_per_session=1):
+    """Predicts the peak memory (bytes) and the run time (seconds) of a single job of each step
+    (see UNITS) at the network scale K, from the number of voxels inside the mask, the number of
+    time points of the run and the parameters of the analysis:
+    1. bootstrap resampling: a few copies of the run, for one resampling
+    2. sparse dictionary learning: the run plus the dictionary and the sparse codes of one
+       resampling at the scale K, for each of the I iterations
+    3. spatial clustering: the R dictionaries at the scale K of each run of the session
+    4. k-hubness maps: the R sparse codes at the scale K of each run of the session
+    """
+
+    (V, T, R, K, I) = (nb_voxels, nb_timepoints, nb_resamplings * runs_per_session, scale, nb_iterations)
+    coding = CODING_COST.get(sparse_coding_method, max(CODING_COST.values()))
+
+    model = {
+        'tseries_': (8 * V * T * 4, V * T),
+        'kmdl': (8 * (V * T + 2 * V * K + T * K) * 2, I * V * T * K * coding),
+        'global_d': (8 * V * K * R * 2, R * V * K * I),
+        'kmap': (8 * V * K * R * 2, R * V * K)}
+
+    return dict([(step, [(BASE_MEMORY + mem) * factors[step][0], ops * TIME_COST[step] * factors[step][1]])
+                 for (step, (mem, ops)) in model.items()])
+
+
+
+def estimate_storage(nb_voxels, nb_timepoints, nb_resamplings, network_scales):
+    """Predicts the size (bytes) of the outputs of each step for a run, or a session for the
+    steps per session (double precision):
+    1. bootstrap resampling: the R resampled runs
+    2. sparse dictionary learning: the dictionary and the sparse codes of each resampling at
+       each network scale
+    3. spatial clustering: a dictionary at each network scale
+    4. k-hubness maps: a map at each network scale
+    """
+
+    (V, T, R) = (nb_voxels, nb_timepoints, nb_resamplings)
+    scales = list(range(network_scales[0], network_scales[2] + 1, max(1, network_scales[1])))
+
+    return {
+        'tseries_': 8 * R * V * T,
+        'kmdl': 8 * R * sum(scales) * (T + V),
+        'global_d': 8 * V * sum(scales),
+        'kmap': 8 * V * len(scales)}
+
+
+
+def format_spec(scheduler, memory, time):
+    """Scheduler specifications requesting the given memory (bytes) and wall time (seconds),
+    with safety margins
+    """
+
+    memory = int(max(MIN_MEMORY, memory * MEMORY_MARGIN) + 2**20 - 1) // 2**20 # MB
+    time = int(max(MIN_TIME, time * TIME_MARGIN) + 59) // 60 # Minutes
+    walltime = '%d:%02d:00' % (time // 60, time % 60)
+
+    if scheduler == 'SLURM':
+        return '--time=' + walltime + ' --mem=' + str(memory) + 'M'
+    elif scheduler == 'SGE':
+        # Not h_vmem: a limit of the virtual memory, far above the resident memory of Octave/MATLAB
+        return '-l h_rt=' + walltime + ' -l mem_free=' + str(memory) + 'M'
+    elif scheduler == 'TORQUE':
+        return '-l walltime=' + walltime + ' -l mem=' + str(memory) + 'mb'
+    else:
+        return '--mem=' + str(memory) + 'M' # Local executor (only the memory is used)
+
+
+
+def strip_spec(scheduler, options):
+    """Scheduler specifications (e.g. from --jobs-spec) without their memory and wall time, to
+    be replaced by those of format_spec (sbatch rejecting e.g. --mem with --mem-per-cpu)
+    """
+
+    ooptions = []
+    options = iter(options)
+    for option in options:
+        if option.split('=')[0] in SPEC_OPTIONS or (scheduler == 'SLURM' and option.startswith('-t')):
+            if '=' not in option and option in SPEC_OPTIONS + ['-t']:
+                next(options, None)
+        elif option.startswith('-l'):
+            resources = [x for x in (option[2:] or next(options, '')).split(',')
+                         if x and x.split('=')[0] not in SPEC_RESOURCES]
+            ooptions += ['-l', ','.join(resources)] if resources else []
+        else:
+            ooptions.append(option)
+
+    return tuple(ooptions)
+
+
+
+def spec_memory(options):
+    """Memory (bytes) requested by scheduler specifications (e.g. from format_spec or --jobs-spec),
+    0 if none (a memory per CPU being multiplied by the number of CPUs of the job)
+    """
+
+    options = ' '.join(options)
+    match = re.search(r'(--mem-per-cpu|--mem|h_vmem|mem_free|s_vmem|vmem|pmem|mem)[= ]([0-9.]+)([KMGTkmgt]?)', options)
+    if not match:
+        return 0
+
+    memory = int(float(match.group(2)) * SIZE_UNITS.get(match.group(3).upper(), 2**20))
+    if match.group(1) == '--mem-per-cpu':
+        cpus = re.search(r'(?:--cpus-per-task[= ]|-c ?)([0-9]+)', options)
+        memory *= int(cpus.group(1)) if cpus else 1
+
+    return memory
+
+
+
+def load_resources(cache_dir):
+    """Loads the calibration factors (memory, time) of each step and the estimates of the
+    previous submissions
+    """
+
+    try:
+        with open(os.sep.join([cache_dir, 'resources.json']), 'r') as file:
+            resources = json.load(file)
+        if resources.get('version') == RESOURCES_VERSION:
+            return resources
+    except (OSError, ValueError):
+        pass
+
+    return {'version': RESOURCES_VERSION, 'factors': dict([(x, [1.0, 1.0]) for x in STEPS]), 'runs': []}
+
+
+
+def save_resources(cache_dir, resources):
+    """Saves the calibration factors and the estimates (atomically, as for the headers index)
+    """
+
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = os.sep.join([cache_dir, 'resources.json.' + str(os.getpid())])
+        with open(tmp_path, 'w') as file:
+            json.dump(resources, file)
+        os.replace(tmp_path, os.sep.join([cache_dir, 'resources.json']))
+    except OSError as e:
+        print('Failed to save the resources estimates in the cache directory:\n' + cache_dir + '\n' + str(e), file=stderr)
+
+
+
+def parse_memory(value):
+    """Bytes from a memory reported by sacct (e.g. '1024K', '1.5G')
+    """
+
+    match = re.match(r'([0-9.]+)([KMGT]?)', value.strip())
+    if not match:
+        return 0
+
+    return float(match.group(1)) * SIZE_UNITS.get(match.group(2), 1)
+
+
+
+def query_usage(jobids):
+    """Queries the accounting of finished jobs with a single call to sacct.
+    Returns a list of (job name, peak memory in bytes, elapsed time in seconds) of the
+    completed jobs, or None if the query failed or some jobs are not finished yet.
+    """
+
+    cmd = ACCOUNTING_CMD + [','.join(sorted(jobids))]
+    try:
+        out = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                             universal_newlines=True, check=True).stdout
+    except (OSError, subprocess.CalledProcessError) as e:
+        print('Failed to query the accounting of the jobs:\n' + ' '.join(cmd[:-1]) + '\n' + str(e), file=stderr)
+        return None
+
+    # The name and the state are on the line of the job, the peak memory on the lines of its steps
+    jobs = dict()
+    for line in out.splitlines():
+        cols = line.split('|')
+        if len(cols) < 5:
+            continue
+        (jobid, _, step) = cols[0].partition('.')
+        job = jobs.setdefault(jobid, {'name': '', 'state': '', 'elapsed': 0, 'memory': 0})
+        if not step:
+            job['name'] = cols[1]
+            job['state'] = cols[2].split()[0] if cols[2] else ''
+            job['elapsed'] = int(cols[3]) if cols[3].isdigit() else 0
+        job['memory'] = max(job['memory'], parse_memory(cols[4]))
+
+    if any(x['state'] not in FINISHED_STATES for x in jobs.values()):
+        return None
+
+    return [(x['name'], x['memory'], x['elapsed']) for x in jobs.values() if x['state'] == 'COMPLETED']
+
+
+
+def calibrate(resources):
+    """Updates the calibration factors of each step from the accounting of the jobs of the
+    previous submissions (once all their jobs are finished).
+    Each submission measures the factors it should have been submitted with: its own factors
+    times a high quantile of the ratios between the observed and the estimated usage of its
+    jobs. A factor is then the median of the measures of the submissions kept in the cache (a
+    submission is never accounted twice, whatever the order of the calibrations).
+    """
+
+    for run in resources['runs']:
+        if run['calibrated']:
+            continue
+
+        try:
+            if not os.path.isfile(run.get('jobs_store', '')):
+                raise sqlite3.OperationalError('Nonexistent file: ' + run.get('jobs_store', ''))
+            store = open_store(run['jobs_store'])
+            jobids = all_jobids(store)
+            store.close()
+        except sqlite3.Error:
+            jobids = None
+        try:
+            if jobids is None:
+                jobids = set(x['base'] for x in read_log(log_path(run.get('jobs_store', ''))) if x['base'])
+        except OSError:
+            run['calibrated'] = True # Removed by the user (or recorded by a former version), nothing to learn from
+            continue
+
+        usage = query_usage(jobids) if jobids else None
+        if usage is None:
+            continue
+
+        ratios = dict([(x, ([], [])) for x in STEPS])
+        for (name, memory, elapsed) in usage:
+            step = job_step(name)
+            if step is not None and memory > 0 and elapsed > 0:
+                ratios[step][0].append(memory / run['estimates'][step][0])
+                ratios[step][1].append(elapsed / run['estimates'][step][1])
+
+        run['measures'] = dict()
+        for (step, values) in ratios.items():
+            run['measures'][step] = [run['factors'][step][i] * sorted(x)[min(len(x) - 1, int(CALIBRATION_QUANTILE * len(x)))]
+                                     if x else None for (i, x) in enumerate(values)]
+        run['calibrated'] = True
+
+    for step in STEPS:
+        for i in range(2):
+            measures = sorted(x['measures'][step][i] for x in resources['runs']
+                              if 'measures' in x and x['measures'][step][i] is not None)
+            if measures:
+                resources['factors'][step][i] = min(FACTOR_BOUNDS[1], max(FACTOR_BOUNDS[0], measures[len(measures) // 2]))
+
+    return resources
+
+
+
+def setup_resources(iargs, jobs_store, tmp_dir):
+    """Estimates the resources of the jobs of each step and writes their scheduler
+    specifications, to be added by the jobs manager to the jobs of the step (matched by name).
+    The estimates are recorded in the cache, for calibrating the next submissions.
+    """
+
+    mask = iargs['headers'][iargs['mask']]
+    nb_timepoints = max([x['nb_timepoints'] for x in iargs['headers'].values()
+                         if x is not None and x['nb_timepoints'] > 1] or [0])
+    if mask is None or not nb_timepoints:
+        print('--jobs-spec-auto\n' +
+              'The headers of the fMRI data or of the mask could not be read (e.g. MINC2), ' +
+              'the resources of the jobs are not estimated', file=stderr)
+        return ''
+    nb_voxels = count_voxels(iargs['mask'], mask)
+
+    resources = load_resources(iargs['cache_dir'])
+    if iargs['jobs_spec_calibrate'] and iargs['scheduler'] == 'SLURM':
+        resources = calibrate(resources)
+
+    # The jobs of a step share their specifications: those of its largest job
+    sessions = dict()
+    for data in iargs['fmri_data']:
+        sessions[(data[0], data[1])] = sessions.get((data[0], data[1]), 0) + 1
+    scales = iargs['network_scales']
+    estimates = estimate_usage(nb_voxels, nb_timepoints, iargs['nb_resamplings'], max(range(scales[0], scales[2] + 1, max(1, scales[1]))),
+                               iargs['nb_iterations'], iargs['sparse_coding_method'], resources['factors'],
+                               max(sessions.values()))
+
+    jobs_spec_steps = os.sep.join([tmp_dir, 'jobs_spec_steps.opt'])
+    with open(jobs_spec_steps, 'w', newline='\n') as file:
+        for step in STEPS:
+            file.write(step + ' ' + format_spec(iargs['scheduler'], *estimates[step]) + '\n')
+
+    if iargs['verbose']:
+        print('Estimated resources of the jobs (' + str(nb_voxels) + ' voxels, ' + str(nb_timepoints) + ' time points):\n' +
+              '\n'.join([x + ' ' + format_spec(iargs['scheduler'], *estimates[x]) for x in STEPS]), file=stderr)
+
+    # A new submission in the same output directory replaces the previous one
+    resources['runs'] = [x for x in resources['runs'] if x.get('jobs_store') != jobs_store][-(MAX_RUNS - 1):] + [
+        {'jobs_store': jobs_store, 'estimates': estimates, 'factors': resources['factors'],
+         'calibrated': iargs['scheduler'] != 'SLURM'}]
+    save_resources(iargs['cache_dir'], resources)
+
+    if not os.path.isfile(jobs_spec_steps):
+        print('Failed to create/edit the jobs specifications file:\n' + jobs_spec_steps, file=stderr)
+        sys_exit(1)
+
+    return jobs_spec_steps
@@ -3,21 +3,54 @@
 # 
 # Sets up SPARK
 # 
-# Last revision: August, 2019
+# Last revision: October, 2026
 # Maintainer: Obai Bin Ka'b Ali @aliobaibk
 # License: In the app folder or check GNU GPL-3.0.
 
 
 
 from argparse import ArgumentParser, RawTextHelpFormatter
+import csv
 from errno import EEXIST
+from itertools import product
+import json
 import os
 from shutil import copyfile
+import sqlite3
 from sys import argv, stderr
 from sys import exit as sys_exit
 from textwrap import dedent
 from tempfile import mkdtemp, mkstemp
 
+from spark_bids import discover
+from spark_headers import get_headers
+from spark_jobs_store import create_store, log_path
+from spark_plan import setup_plan
+from spark_resampling import np, setup_resamplings
+from spark_resources import STEPS, setup_resources
+from spark_stage import PER_JOB_DIRS
+from spark_steps import remove_lists, setup_steps, step_keys
+from spark_tseries import setup_tseries
+
+
+
+# Accepted names of the columns of a cohort manifest (--fmri-manifest)
+MANIFEST_COLUMNS = {
+    'subject': ['subject', 'subject_id', 'subjectid', 'sub'],
+    'session': ['session', 'session_id', 'sessionid', 'ses'],
+    'run': ['run', 'run_id', 'runid'],
+    'path': ['path', 'file', 'fmri', 'fmri_data']}
+
+# Parameters of the analysis accepted by a sweep (--sweep)
+SWEEP_OPTIONS = [
+    'nb-resamplings', 'resampling-method', 'block-window-length', 'network-scales', 'nb-iterations',
+    'dict-init-method', 'sparse-coding-method', 'p-value']
+
+# Directories never bound as a whole in the Singularity container (see setup_sing_binds)
+UNSAFE_BINDS = [
+    '/', '/bin', '/boot', '/dev', '/etc', '/home', '/lib', '/lib64', '/opt', '/proc', '/root', '/run',
+    '/sbin', '/srv', '/sys', '/tmp', '/usr', '/var']
+
 
 
 def setup_entrypoint_opt(main_job, interactive, scheduler, jobs_ctrl_spec, tmp_dir):
@@ -41,53 +74,135 @@ def setup_entrypoint_opt(main_job, interactive, scheduler, jobs_ctrl_spec, tmp_d
 
 
 
-def setup_main_job_sing(cmd_template, spark_exe, scheduler, pipe_opt, app_spec, tmp_dir):
-    """Sets up the main job for running SPARK Singularity version
+def setup_frame(frame, cmd_template, bash_var, stages, main_job, hooks=()):
+    """Writes the main job from a frame: the command template is split around the frame,
+    its last line (the command) being completed by the Bash command of each controller.
+    The stages of controllers are run one after the other, the controllers of a stage in
+    parallel (the main job stopping if one of them fails), a final stage made of a single
+    controller running in the foreground.
+    A stage can be preceded by a Bash command (hook), the main job stopping if it fails.
     """
 
-    main_job = os.sep.join([tmp_dir, 'main_job.bash'])
-    if os.path.isfile(main_job):
-        os.remove(main_job)
-        
-    bash_var = '\n\n\n'\
-        'scheduler="' + scheduler + '"\n' + \
-        'tmp_dir="' + tmp_dir + '"\n' + \
-        'fifo="' + app_spec['fifo'] + '"\n' + \
-        'sing_binds="' + app_spec['sing_binds'] + '"\n' + \
-        'sing_home="' + app_spec['sing_home'] + '"\n' + \
-        'jobs_log="' + app_spec['jobs_log'] + '"\n'
-    
-    bash_cmd = ' \\\n' + \
-        'exec -B "' + app_spec['sing_binds'] + '" -H "' + app_spec['sing_home'] + '":"' + app_spec['sing_home'] + '" "' + \
-        spark_exe + '" ' + \
-        '/bin/bash -c "' + \
-        'export PSOM_FIFO=\'' + app_spec['fifo'] + '\' && ' + \
-        'octave --no-gui -q --persist --eval \\"spark(\'' + pipe_opt + '\')\\""'
-
-    ipath = os.sep.join([os.path.dirname(__file__), 'frames', 'sing.bash'])
+    frames_dir = os.sep.join([os.path.dirname(os.path.abspath(__file__)), 'frames'])
+
+    with open(cmd_template, 'r', newline='\n') as file:
+        template = file.readlines()
+
+    ipath = os.sep.join([frames_dir, frame])
     with open(ipath, 'r', newline='\n') as ifile:
         with open(main_job, 'w+', newline='\n') as ofile:
-            num_lines = sum(1 for line in open(cmd_template, 'r', newline='\n'))
             for line in ifile:
-                if not line.startswith('VAR_INS'):
-                    ofile.write(line)
-                else:
+                if line.startswith('VAR_INS'):
                     # Append the beginning of the command file
-                    with open(cmd_template, 'r', newline='\n') as tmp_file:
-                        c = 0
-                        for line in tmp_file:
-                            c += 1
-                            if c != num_lines:
-                                ofile.write(line)
+                    ofile.writelines(template[:-1])
                     ofile.write(bash_var)
-            # Append the end of the command file
-            with open(cmd_template, 'r', newline='\n') as tmp_file:
-                c = 0
-                for line in tmp_file:
-                    c += 1
-                    if c == num_lines:
-                        ofile.write(line)
-            ofile.write(bash_cmd)
+                elif line.startswith('JOBS_INS'):
+                    with open(os.sep.join([frames_dir, 'jobs.bash']), 'r', newline='\n') as jobs_file:
+                        ofile.write(jobs_file.read())
+                else:
+                    ofile.write(line)
+            # Append the end of the command file, once per controller
+            command = ''.join(template[-1:]).rstrip('\n')
+            for (i, stage) in enumerate(stages):
+                if i < len(hooks) and hooks[i]:
+                    ofile.write(hooks[i] + ' || exit 1\n\n')
+                if i == len(stages) - 1 and len(stage) == 1:
+                    ofile.write(command + stage[0])
+                else:
+                    # The next stage runs only if all the controllers of the stage succeeded
+                    ofile.write('pids=()\n')
+                    for bash_cmd in stage:
+                        ofile.write(command + bash_cmd + ' &\n' + 'pids+=($!)\n')
+                    ofile.write('for pid in "${pids[@]}"; do\n' +
+                                '    wait $pid || { kill "${pids[@]}" >/dev/null 2>&1; exit 1; }\n' +
+                                'done\n\n')
+
+    return main_job
+
+
+
+def setup_bash_var(scheduler, jobs_array_window, app_spec, tmp_dir):
+    """Bash variables used by the frames of the main job (the staging directory is expanded
+    by the jobs, on the compute nodes)
+    """
+
+    return '\n\n\n'\
+        'scheduler="' + scheduler + '"\n' + \
+        'tmp_dir="' + tmp_dir + '"\n' + \
+        'app_dir="' + os.path.dirname(os.path.abspath(__file__)) + '"\n' + \
+        'fifo="' + app_spec.get('fifo', '') + '"\n' + \
+        'sing_binds="' + app_spec.get('sing_binds', '') + '"\n' + \
+        'sing_home="' + app_spec.get('sing_home', '') + '"\n' + \
+        'job_wrapper="' + app_spec.get('job_wrapper', '') + '"\n' + \
+        'jobs_store="' + app_spec.get('jobs_store', '') + '"\n' + \
+        'events_dir="' + app_spec.get('events_dir', '') + '"\n' + \
+        'jobs_spec_steps="' + app_spec.get('jobs_spec_steps', '') + '"\n' + \
+        'jobs_array_window="' + str(jobs_array_window) + '"\n' + \
+        'stage_dir=\'' + app_spec.get('stage_dir', '').replace('\'', '') + '\'\n' + \
+        'stage_tables="' + app_spec.get('stage_tables', '') + '"\n' + \
+        'queued_jobs=(' + app_spec.get('queued_jobs', '0 0 0') + ')\n' + \
+        'submit_rate="' + app_spec.get('submit_rate', '0') + '"\n' + \
+        'pilot_workers="' + app_spec.get('pilot_workers', '0') + '"\n' + \
+        'pilot_spec="' + app_spec.get('pilot_spec', '') + '"\n'
+
+
+
+def setup_job_wrapper(app_spec, tmp_dir):
+    """Writes the wrapper of the pipeline jobs (Singularity version), once per submission: the
+    jobs only give it their Singularity options, instead of one script per job (see
+    spark_jobs_manager.py). The staging directory is expanded by the jobs, on the compute nodes.
+    """
+
+    job_wrapper = os.sep.join([tmp_dir, 'job_wrapper.bash'])
+    bash_var = \
+        'app_dir="' + os.path.dirname(os.path.abspath(__file__)) + '"\n' + \
+        'sing_binds="' + app_spec['sing_binds'] + '"\n' + \
+        'sing_home="' + app_spec['sing_home'] + '"\n' + \
+        'stage_dir="' + app_spec.get('stage_dir', '').replace('"', '') + '"\n' + \
+        'warm_instances="' + app_spec.get('warm_instances', '0') + '"\n'
+
+    try:
+        frame = os.sep.join([os.path.dirname(os.path.abspath(__file__)), 'frames', 'job_wrapper.bash'])
+        with open(frame, 'r', newline='\n') as ifile:
+            with open(job_wrapper, 'w', newline='\n') as ofile:
+                for line in ifile:
+                    ofile.write(bash_var if line.startswith('VAR_INS') else line)
+        os.chmod(job_wrapper, 0o755)
+    except OSError as e:
+        print('Failed to create the wrapper of the jobs (Singularity):\n' + job_wrapper + '\n' + str(e), file=stderr)
+        sys_exit(1)
+
+    return job_wrapper
+
+
+
+def setup_main_job_sing(cmd_template, spark_exe, scheduler, jobs_array_window, controllers, app_spec, tmp_dir, hooks=()):
+    """Sets up the main job for running SPARK Singularity version (and the wrapper of its
+    pipeline jobs, with a scheduler or the local executor)
+    """
+
+    main_job = os.sep.join([tmp_dir, 'main_job.bash'])
+    if os.path.isfile(main_job):
+        os.remove(main_job)
+
+    if app_spec['fifo']:
+        app_spec['job_wrapper'] = setup_job_wrapper(app_spec, tmp_dir)
+        
+    bash_var = setup_bash_var(scheduler, jobs_array_window, app_spec, tmp_dir)
+
+    stages = []
+    for (i, stage) in enumerate(controllers):
+        # Only a final (single) controller stays open for monitoring the pipeline
+        persist = '--persist ' if i == len(controllers) - 1 and len(stage) == 1 else ''
+        stages.append([' \\\n' + \
+            'exec -B "' + app_spec['sing_binds'] + '" -H "' + app_spec['sing_home'] + '":"' + app_spec['sing_home'] + '" "' + \
+            spark_exe + '" ' + \
+            '/bin/bash -c "' + \
+            'export PSOM_FIFO=\'' + app_spec['fifo'] + '\' && ' + \
+            'octave --no-gui -q ' + persist + '--eval \\"spark(\'' + pipe_opt + '\')\\""'
+            for pipe_opt in stage])
+
+    setup_frame('sing.bash', cmd_template, bash_var, stages, main_job, hooks)
 
     if not os.path.isfile(main_job):
         print('Failed to create/edit the main job to run SPARK (Singularity):\n' + main_job, file=stderr)
@@ -97,7 +212,7 @@ def setup_main_job_sing(cmd_template, spark_exe, scheduler, pipe_opt, app_spec,
 
 
 
-def setup_main_job_matlab(cmd_template, spark_exe, pipe_opt, tmp_dir):
+def setup_main_job_matlab(cmd_template, spark_exe, scheduler, jobs_array_window, controllers, app_spec, tmp_dir, hooks=()):
     """Sets up the main job for running SPARK MATLAB version
     """
 
@@ -105,21 +220,17 @@ def setup_main_job_matlab(cmd_template, spark_exe, pipe_opt, tmp_dir):
     if os.path.isfile(main_job):
         os.remove(main_job)
         
-    matlab_cmd = ' \\\n-nodisplay -nosplash -r ' + \
-        '"addpath(genpath(\'' + spark_exe + '\')), spark(\'' + pipe_opt + '\')"'
+    bash_var = setup_bash_var(scheduler, jobs_array_window, app_spec, tmp_dir)
 
-    ipath = os.sep.join([os.path.dirname(__file__), 'frames', 'matlab.bash'])
-    with open(ipath, 'r', newline='\n') as ifile:
-        with open(main_job, 'w+', newline='\n') as ofile:
-            for line in ifile:
-                if not line.startswith('VAR_INS'):
-                    ofile.write(line)
-                else:
-                    # Append the command file
-                    with open(cmd_template, 'r', newline='\n') as tmp_file:
-                        for line in tmp_file:
-                            ofile.write(line)
-                        ofile.write(matlab_cmd)
+    stages = []
+    for (i, stage) in enumerate(controllers):
+        # Only a final (single) controller stays open for monitoring the pipeline
+        close = '' if i == len(controllers) - 1 and len(stage) == 1 else ', exit'
+        stages.append([' \\\n-nodisplay -nosplash -r ' + \
+            '"addpath(genpath(\'' + spark_exe + '\')), spark(\'' + pipe_opt + '\')' + close + '"'
+            for pipe_opt in stage])
+
+    setup_frame('matlab.bash', cmd_template, bash_var, stages, main_job, hooks)
 
     if not os.path.isfile(main_job):
         print('Failed to create/edit the main job to run SPARK (MATLAB):\n' + main_job, file=stderr)
@@ -129,32 +240,57 @@ def setup_main_job_matlab(cmd_template, spark_exe, pipe_opt, tmp_dir):
 
 
 
-def setup_main_job(version, cmd_template, spark_exe, scheduler, pipe_opt, app_spec, tmp_dir):
-    """Sets up the main job (pipeline controller)
+def setup_main_job(version, cmd_template, spark_exe, scheduler, jobs_array_window, controllers, app_spec, tmp_dir, hooks=()):
+    """Sets up the main job (pipeline controllers)
     """
 
     if 'matlab' in version:
-        main_job = setup_main_job_matlab(cmd_template, spark_exe, pipe_opt, tmp_dir)
+        main_job = setup_main_job_matlab(cmd_template, spark_exe, scheduler, jobs_array_window, controllers, app_spec, tmp_dir, hooks)
     elif 'singularity' in version:
-        main_job = setup_main_job_sing(cmd_template, spark_exe, scheduler, pipe_opt, app_spec, tmp_dir)
+        main_job = setup_main_job_sing(cmd_template, spark_exe, scheduler, jobs_array_window, controllers, app_spec, tmp_dir, hooks)
 
     return main_job
 
 
 
-def setup_jobs_log(tmp_dir):
-    """Creates a temporary file for keeping the ID of submitted jobs
+def setup_jobs_store(tmp_dir, fmri_data):
+    """Creates the store of the submitted jobs (see spark_jobs_store.py), with the subjects of
+    the fMRI data, and its flat log (enough without the store)
     """
 
-    jobs_log = os.sep.join([tmp_dir, 'jobs.log'])
-    with open(jobs_log, 'w+', newline='\n') as file:
-        pass
-        
-    if not os.path.isfile(jobs_log):
-        print('Failed to create the jobs ID file:\n' + jobs_log, file=stderr)
+    jobs_store = os.sep.join([tmp_dir, 'jobs.db'])
+    try:
+        open(log_path(jobs_store), 'w', newline='\n').close()
+    except OSError as e:
+        print('Failed to create the flat log of the jobs:\n' + log_path(jobs_store) + '\n' + str(e), file=stderr)
         sys_exit(1)
-    
-    return jobs_log
+
+    try:
+        create_store(jobs_store, set(x[0] for x in fmri_data))
+    except (OSError, sqlite3.Error) as e:
+        print('Failed to create the store of the jobs, only the flat log is kept:\n' + jobs_store + '\n' + str(e),
+              file=stderr)
+
+    return jobs_store
+
+
+
+def setup_events_dir(tmp_dir):
+    """Creates the directory of the events of the jobs (see spark_events.py), without the
+    events of a previous submission
+    """
+
+    events_dir = os.sep.join([tmp_dir, 'events'])
+    try:
+        os.makedirs(events_dir, exist_ok=True)
+        for name in os.listdir(events_dir):
+            if name.endswith('.jsonl'):
+                os.remove(os.sep.join([events_dir, name]))
+    except OSError as e:
+        print('Failed to create the directory of the events of the jobs:\n' + events_dir + '\n' + str(e), file=stderr)
+        sys_exit(1)
+
+    return events_dir
 
 
 
@@ -166,15 +302,48 @@ def setup_sing_home(out_dir):
 
 
 
-def setup_sing_binds(fmri_data, mask):
-    """Builds the binding paths for the Singularity command
+def cover_paths(paths, min_depth, unsafe):
+    """Minimal set of directories covering the given directories: their deepest common
+    ancestor, unless it is shallower than the minimum depth or unsafe, in which case the
+    directories are split by their next component (recursively)
     """
-    
-    paths = set(
-        [os.path.dirname(x[-1]) for x in fmri_data] + 
-        [os.path.dirname(mask)])
 
-    return ','.join(paths)
+    common = os.path.commonpath(paths)
+    depth = len([x for x in common.split(os.sep) if x])
+    if len(paths) == 1 or (depth >= min_depth and common not in unsafe):
+        return [common]
+
+    groups = dict()
+    for path in paths:
+        groups.setdefault(os.sep.join(path.split(os.sep)[:depth + 2]), []).append(path)
+
+    return [x for group in groups.values() for x in cover_paths(group, min_depth, unsafe)]
+
+
+
+def setup_sing_binds(fmri_data, mask, min_depth=2, exclude=()):
+    """Builds the binding paths for the Singularity command: a minimal set of directories
+    covering the directories of the fMRI data and of the mask (see cover_paths), so that the
+    command stays short whatever the size of the cohort
+    """
+
+    paths = cover_paths(sorted(set(
+        [os.path.dirname(x[-1]) for x in fmri_data] +
+        [os.path.dirname(mask)])), min_depth, set(UNSAFE_BINDS) | set(exclude))
+
+    # Directories already covered by one of their ancestors are dropped
+    paths = set(paths)
+    binds = []
+    for path in paths:
+        parent = path
+        while parent != os.path.dirname(parent):
+            parent = os.path.dirname(parent)
+            if parent in paths:
+                break
+        else:
+            binds.append(path)
+
+    return ','.join(sorted(binds))
 
 
 
@@ -195,36 +364,61 @@ def setup_fifo(tmp_dir):
 
 def setup_app_spec(iargs, tmp_dir):
     """Application specific options (depending on the SPARK version to use)
-    For the Singularity version: sets up directories and files and builds the arguments of the Singularity command
-    For the MATLAB version: nothing for now
+    With a scheduler: sets up the FIFO, the store of the jobs and the events directory used by
+    the jobs manager, the specifications of the jobs of each step if they are estimated (--jobs-spec-auto), and
+    the throttling of the submissions (--max-queued-jobs, --submit-rate), and the pilot workers
+    (--pilot-workers, submitted with the jobs specifications)
+    For the Singularity version: builds the arguments of the Singularity command (and the
+    idle time of the warm instances, with a scheduler)
     """
 
     app_spec = dict()
-    if not 'singularity' in iargs['version']:
-        return app_spec
+    if 'scheduler' in iargs['version']:
+        app_spec['fifo'] = setup_fifo(tmp_dir)
+        app_spec['jobs_store'] = setup_jobs_store(tmp_dir, iargs['fmri_data'])
+        app_spec['events_dir'] = setup_events_dir(tmp_dir)
+        if iargs['jobs_spec_auto']:
+            app_spec['jobs_spec_steps'] = setup_resources(iargs, app_spec['jobs_store'], tmp_dir)
+        if iargs['stage_dir']:
+            app_spec['stage_dir'] = iargs['stage_dir']
+            app_spec['stage_tables'] = setup_stage_tables(tmp_dir)
+        if iargs['max_queued_jobs']:
+            app_spec['queued_jobs'] = ' '.join([str(x) for x in iargs['max_queued_jobs']]) + ' ' + \
+                str(iargs['max_parallel_jobs'])
+        app_spec['submit_rate'] = str(iargs['submit_rate'])
+        if iargs['pilot_workers']:
+            app_spec['pilot_workers'] = str(iargs['pilot_workers'])
+            app_spec['pilot_spec'] = ('--export=ALL ' if iargs['scheduler'] == 'SLURM' else '-V ') + iargs['jobs_spec']
     else:
-        app_spec['sing_binds'] = setup_sing_binds(iargs['fmri_data'], iargs['mask'])
+        app_spec['fifo'] = ''
+        app_spec['jobs_store'] = ''
+
+    if 'singularity' in iargs['version']:
+        app_spec['sing_binds'] = setup_sing_binds(iargs['fmri_data'], iargs['mask'], iargs['bind_depth'],
+                                                  iargs['bind_exclude'])
         app_spec['sing_home'] = setup_sing_home(iargs['out_dir'])
         if 'scheduler' in iargs['version']:
-            app_spec['fifo'] = setup_fifo(tmp_dir)
-            app_spec['jobs_log'] = setup_jobs_log(tmp_dir)
-        else:
-            app_spec['fifo'] = ''
-            app_spec['jobs_log'] = ''
+            app_spec['warm_instances'] = str(iargs['warm_instances'])
 
     return app_spec
 
 
 
-def setup_pipe_opt(iargs, tmp_dir):
+def setup_pipe_opt(iargs, tmp_dir, steps=(1, 2, 3, 4), controller='', rerun=()):
     """Builds the list of options for running the SPARK analyses with GNU Octave/MATLAB
-    The options will be read by the GNU Octave/MATLAB SPARK main function
+    The options will be read by the GNU Octave/MATLAB SPARK main function, the fMRI data
+    being written one run per row in a table next to the options file
     """
 
+    fmri_data = os.sep.join([tmp_dir, 'fmri_data.tsv'])
+    with open(fmri_data, 'w', newline='\n') as file:
+        for data in iargs['fmri_data']:
+            file.write('\t'.join(data) + '\n')
+
     pipe_opt = os.sep.join([tmp_dir, 'pipe.opt'])
     with open(pipe_opt, 'w', newline='\n') as file:
         file.write(
-            'fmri_data ' + ' , '.join([' '.join(data) for data in iargs['fmri_data']]) + '\n' +
+            'fmri_data ' + fmri_data + '\n' +
             'mask ' + iargs['mask'] + '\n' +
             'out_dir ' + iargs['out_dir'] + '\n' +
             'nb_resamplings ' + str(iargs['nb_resamplings']) + '\n' +
@@ -237,7 +431,13 @@ def setup_pipe_opt(iargs, tmp_dir):
             'sparse_coding_method ' + iargs['sparse_coding_method'] + '\n' +
             'preserve_dc_atom ' + str(int(iargs['preserve_dc_atom'])) + '\n' +
             'verbose ' + str(int(iargs['verbose'])) + '\n' +
-            'psom_gb ' + iargs['psom_gb'] + '\n'
+            'psom_gb ' + iargs['psom_gb'] + '\n' +
+            'steps ' + ' '.join([str(x) for x in steps]) + '\n' +
+            'step_prefixes ' + ' '.join(STEPS) + '\n' +
+            'controller ' + controller + '\n' +
+            'stage_table ' + iargs.get('stage_table', '') + '\n' +
+            'rerun_steps ' + ' '.join([str(x) for x in rerun]) + '\n' +
+            'steps_outputs ' + iargs.get('steps_outputs', '') + '\n'
             )
         
     if not os.path.isfile(pipe_opt):
@@ -248,7 +448,24 @@ def setup_pipe_opt(iargs, tmp_dir):
 
 
 
-def setup_psom_gb(ipsom_gb, version, spark_exe, scheduler, jobs_spec, max_parallel_jobs, tmp_dir):
+def setup_stage_tables(tmp_dir):
+    """Creates the directory of the tables of the inputs of the jobs, written by the pipeline
+    controllers and read by the jobs manager for staging the inputs of the jobs
+    """
+
+    stage_tables = os.sep.join([tmp_dir, 'stage'])
+    try:
+        os.mkdir(stage_tables)
+    except OSError as e:
+        if e.errno != EEXIST:
+            print('Failed to create the directory of the tables of the inputs of the jobs:\n' + stage_tables + '\n' + str(e), file=stderr)
+            sys_exit(1)
+
+    return stage_tables
+
+
+
+def setup_psom_gb(ipsom_gb, version, spark_exe, scheduler, jobs_spec, max_parallel_jobs, tmp_dir, blocking=False):
     """Appropriately copies the PSOM configuration file into a folder that will be added to GNU Octave/MATLAB path and edits it
     """
 
@@ -290,6 +507,10 @@ def setup_psom_gb(ipsom_gb, version, spark_exe, scheduler, jobs_spec, max_parall
             elif scheduler == 'SLURM':
                 file.write("\ngb_psom_qsub_options = '--export=ALL " + jobs_spec + "';")
 
+        if blocking:
+            # The controller returns only once the pipeline is done
+            file.write("\ngb_psom_mode_deamon = 'session';")
+
         file.write("\ngb_psom_max_queued = " + str(max_parallel_jobs) + ";" +
                    "\ngb_psom_tmp = ['" + tmp_dir + "', filesep];")
 
@@ -301,11 +522,146 @@ def setup_psom_gb(ipsom_gb, version, spark_exe, scheduler, jobs_spec, max_parall
 
 
 
-def setup_tmp_dir(out_dir):
+def setup_shards(fmri_data, nb_shards):
+    """Partitions the fMRI data into shards of whole subjects, balancing the number of runs
+    """
+
+    subjects = dict()
+    for data in fmri_data:
+        subjects.setdefault(data[0], []).append(data)
+
+    shards = [[] for _ in range(min(nb_shards, len(subjects)))]
+    for runs in sorted(subjects.values(), key=len, reverse=True):
+        min(shards, key=len).extend(runs)
+
+    return shards
+
+
+
+def setup_controller(iargs, tmp_dir, steps=(1, 2, 3, 4), controller='', blocking=False, stage_tables='',
+                     rerun=(), steps_dir=''):
+    """Sets up the files of a pipeline controller (PSOM configuration and pipeline options)
+    and returns its pipeline options file. With staging, the controller writes the inputs of
+    its jobs in a table of the given directory. The controller runs again from scratch the
+    given steps, and writes the lists of the outputs of its steps in the given directory.
+    """
+
+    # With --max-queued-jobs, PSOM may queue up to the maximum, the jobs manager holding the jobs back
+    max_queued = iargs['max_queued_jobs'][1] if iargs['max_queued_jobs'] else iargs['max_parallel_jobs']
+    psom_gb = setup_psom_gb(iargs['psom_gb'], iargs['version'], iargs['spark_exe'], iargs['scheduler'],
+                            iargs['jobs_spec'], max_queued, tmp_dir, blocking)
+    stage_table = os.sep.join([stage_tables, (controller or 'pipeline') + '.tsv']) if stage_tables else ''
+    steps_outputs = os.sep.join([steps_dir, controller or 'pipeline']) if steps_dir else ''
+
+    return setup_pipe_opt(dict(iargs, psom_gb=psom_gb, stage_table=stage_table, steps_outputs=steps_outputs),
+                          tmp_dir, steps, controller, [x for x in rerun if x in steps])
+
+
+
+def setup_controllers(iargs, tmp_dir, steps=(1, 2, 3, 4), rerun=(), steps_dir=''):
+    """Sets up the pipeline controllers, as a list of stages run one after the other, the
+    controllers of a stage running in parallel.
+    Without shards, a single controller runs the given steps of the pipeline. Otherwise, one
+    controller per shard runs the steps 1-2 for the subjects of the shard (with its own
+    temporary directory and PSOM logs), then a merge controller runs the steps 3-4 over all
+    subjects (only the given steps are run, see setup_steps).
+    """
+
+    stage_tables = setup_stage_tables(tmp_dir) if iargs['stage_dir'] else ''
+    options = {'stage_tables': stage_tables, 'rerun': rerun, 'steps_dir': steps_dir}
+
+    if iargs['shards'] <= 1:
+        return [[setup_controller(iargs, tmp_dir, tuple(steps), **options)]]
+
+    shards = setup_shards(iargs['fmri_data'], iargs['shards'])
+    max_parallel_jobs = max(1, iargs['max_parallel_jobs'] // len(shards))
+
+    stage = []
+    for (k, data) in enumerate(shards if [x for x in steps if x <= 2] else []):
+        controller = 'shard-' + str(k + 1)
+        shard_dir = setup_tmp_dir(tmp_dir, controller)
+        stage.append(setup_controller(dict(iargs, fmri_data=data, max_parallel_jobs=max_parallel_jobs),
+                                      shard_dir, tuple(x for x in steps if x <= 2), controller, blocking=True, **options))
+
+    merge = setup_controller(iargs, tmp_dir, tuple(x for x in steps if x > 2), 'merge', **options)
+
+    return [stage, [merge]] if stage else [[merge]]
+
+
+
+def setup_sweep_controllers(iargs, tmp_dir, sweep, dry_run=False):
+    """Sets up the pipeline controllers of a sweep of parameters, as a single graph of stages.
+    Each configuration has its output directory: OUT_DIR/sweep/NAME. The outputs of a step
+    that are the same for several configurations (same key, see spark_steps.py) are computed
+    once, in the directory of the first of them, then linked into the directories of the
+    others before the stage running their next steps (hook of the stage).
+    Returns the stages of controllers and their hooks. A dry run leaves the lists of the
+    outputs of the steps untouched.
+    """
+
+    sweep_dir = setup_tmp_dir(iargs['out_dir'], 'sweep')
+    stage_tables = setup_stage_tables(tmp_dir) if iargs['stage_dir'] else ''
+
+    configs = []
+    for point in sweep:
+        cargs = dict(iargs, out_dir=setup_tmp_dir(sweep_dir, point['name']), **point['params'])
+        configs.append((point['name'], cargs, step_keys(cargs)))
+
+    # Owner of the outputs of a step of a configuration: the first configuration with the same key
+    owners = [[[y[2][k] for y in configs].index(x[2][k]) for k in range(4)] for x in configs]
+
+    # Steps computed by each configuration, split where the configurations sharing them change
+    plan = dict()
+    computed = dict()
+    for (i, config) in enumerate(configs):
+        segments = []
+        for step in [k + 1 for k in range(4) if owners[i][k] == i]:
+            sharing = [c for c in range(len(configs)) if owners[c][step-1] == i]
+            if segments and segments[-1][1] == sharing:
+                segments[-1][0].append(step)
+            else:
+                segments.append(([step], sharing))
+        for (steps, _) in segments:
+            stage = computed[(owners[i][steps[0]-2], steps[0]-1)] + 1 if steps[0] > 1 else 0
+            computed.update({(i, x): stage for x in steps})
+            links = [(x, configs[owners[i][x-1]][1]['out_dir']) for x in range(1, steps[0]) if owners[i][x-1] != i]
+            plan.setdefault(stage, []).append((config, steps, links))
+
+    stages = []
+    hooks = []
+    for stage in range(len(plan)):
+        controllers = []
+        links = []
+        for ((name, cargs, _), steps, config_links) in plan[stage]:
+            controller = name + '_steps' + ''.join([str(x) for x in steps])
+            steps_dir = setup_tmp_dir(cargs['out_dir'], 'steps')
+            for x in steps if not dry_run else []:
+                remove_lists(steps_dir, x)
+            max_parallel_jobs = max(1, iargs['max_parallel_jobs'] // len(plan[stage]))
+            blocking = stage < len(plan) - 1 or len(plan[stage]) > 1
+            controllers.append(setup_controller(dict(cargs, max_parallel_jobs=max_parallel_jobs),
+                                                setup_tmp_dir(tmp_dir, controller), tuple(steps), controller, blocking,
+                                                stage_tables, steps_dir=steps_dir))
+            links += [str(x) + '\t' + src_dir + '\t' + cargs['out_dir'] + '\n' for (x, src_dir) in config_links]
+        stages.append(controllers)
+
+        hook = ''
+        if links:
+            table = os.sep.join([tmp_dir, 'links-' + str(stage + 1) + '.tsv'])
+            with open(table, 'w', newline='\n') as file:
+                file.writelines(links)
+            hook = 'python3 "$app_dir"/spark_steps.py link "' + table + '"'
+        hooks.append(hook)
+
+    return (stages, hooks)
+
+
+
+def setup_tmp_dir(out_dir, name='tmp'):
     """Creates the temporary directory
     """
 
-    tmp_dir = os.sep.join([out_dir, 'tmp'])
+    tmp_dir = os.sep.join([out_dir, name])
     try:
         os.mkdir(tmp_dir)
     except OSError as e:
@@ -334,8 +690,9 @@ def setup_out_dir(out_dir):
 
 
 
-def setup_version(spark_exe, scheduler):
-    """Gets the SPARK version to use
+def setup_version(spark_exe, scheduler, local_executor=False):
+    """Gets the SPARK version to use (the local executor being run as a scheduler by the
+    jobs manager)
     """
 
     version = ''
@@ -344,7 +701,7 @@ def setup_version(spark_exe, scheduler):
     else:
         version += 'singularity'
 
-    if scheduler != 'NONE':
+    if scheduler != 'NONE' or local_executor:
         version += '+scheduler'
     
     return version
@@ -355,19 +712,24 @@ def check_iargs_integrity(iargs):
     """Integrity of the input arguments
     """
 
-    # fMRI data
+    # fMRI data and grey-matter mask: files stats and headers (in parallel, and cached)
     fmri_data = [x[-1] for x in iargs['fmri_data']]
-    if any(not os.path.isfile(x) for x in fmri_data):
+    (stats, headers) = get_headers(fmri_data + [iargs['mask']], iargs['cache_dir'])
+
+    # fMRI data
+    invalid = [x for x in fmri_data if stats[x] is None]
+    if invalid:
         print('--fmri-data\n' +
-              'One file does not exist or is not valid:\n' + str(fmri_data), file=stderr)
+              'Some files do not exist or are not valid:\n' + '\n'.join(invalid), file=stderr)
         sys_exit(1)
-    elif any(not (x.endswith('.mnc') or x.endswith('.nii')) for x in fmri_data):
+    invalid = [x for x in fmri_data if not (x.endswith('.mnc') or x.endswith('.nii'))]
+    if invalid:
         print('--fmri-data\n' +
-              'One file is not MINC (.mnc) or NIfTI (.nii):\n' + str(fmri_data), file=stderr)
+              'Some files are not MINC (.mnc) or NIfTI (.nii):\n' + '\n'.join(invalid), file=stderr)
         sys_exit(1)
 
     # Grey-matter mask
-    if not os.path.isfile(iargs['mask']):
+    if stats[iargs['mask']] is None:
         print('--mask\n' +
               'Invalid or nonexistent file:\n' + iargs['mask'], file=stderr)
         sys_exit(1)
@@ -375,6 +737,26 @@ def check_iargs_integrity(iargs):
         print('--mask\n' +
               'File is not MINC (.mnc) or NIfTI (.nii):\n' + iargs['mask'], file=stderr)
         sys_exit(1)
+
+    # Headers (the files whose header could not be read, e.g. MINC2, are not checked)
+    mask = headers[iargs['mask']]
+    if mask is not None and mask['nb_timepoints'] > 1:
+        print('--mask\n' +
+              'File is not a 3D volume (' + str(mask['nb_timepoints']) + ' time points):\n' + iargs['mask'], file=stderr)
+        sys_exit(1)
+    invalid = [x for x in fmri_data if headers[x] is not None and headers[x]['nb_timepoints'] < 2]
+    if invalid:
+        print('--fmri-data\n' +
+              'Some files are not 4D volumes (fMRI time series):\n' + '\n'.join(invalid), file=stderr)
+        sys_exit(1)
+    invalid = [x for x in fmri_data if headers[x] is not None and mask is not None and not same_grid(headers[x], mask)]
+    if invalid:
+        print('--fmri-data\n' +
+              'The grid of some files does not match the one of the mask (dimensions ' + str(mask['dims']) +
+              ', voxel size ' + str(mask['voxel_size']) + '):\n' +
+              '\n'.join([x + ' (dimensions ' + str(headers[x]['dims']) + ', voxel size ' + str(headers[x]['voxel_size']) + ')'
+                         for x in invalid]), file=stderr)
+        sys_exit(1)
         
     # SPARK executable
     if not os.path.isfile(iargs['spark_exe']) and not os.path.isdir(iargs['spark_exe']):
@@ -388,6 +770,121 @@ def check_iargs_integrity(iargs):
               'Invalid or nonexistent file:\n' + iargs['cmd_template'], file=stderr)
         sys_exit(1)
 
+    # Parameters of the analysis
+    check_params(iargs)
+
+    # Maximum number of parallel jobs
+    if iargs['max_parallel_jobs'] < 1:
+        print('--max-parallel-jobs\n' +
+              'Maximum number of parallel jobs smaller than 1:\n' + str(iargs['max_parallel_jobs']), file=stderr)
+        sys_exit(1)
+
+    # Bounds of the number of queued jobs
+    if iargs['max_queued_jobs'] and not 1 <= iargs['max_queued_jobs'][0] <= iargs['max_queued_jobs'][1]:
+        print('--max-queued-jobs\n' +
+              'Invalid bounds, expected 1 <= minimum <= maximum:\n' + str(iargs['max_queued_jobs']), file=stderr)
+        sys_exit(1)
+    elif iargs['max_queued_jobs'] and iargs['scheduler'] == 'NONE':
+        print('--max-queued-jobs\n' +
+              'Adapting the number of queued jobs requires a scheduler (--scheduler):\n' + iargs['scheduler'], file=stderr)
+        sys_exit(1)
+
+    # Rate of the submissions
+    if iargs['submit_rate'] < 0:
+        print('--submit-rate\n' +
+              'Rate smaller than 0:\n' + str(iargs['submit_rate']), file=stderr)
+        sys_exit(1)
+
+    # Bound directories
+    if iargs['bind_depth'] < 1:
+        print('--bind-depth\n' +
+              'Minimum depth smaller than 1:\n' + str(iargs['bind_depth']), file=stderr)
+        sys_exit(1)
+    if any(not os.path.isabs(x) for x in iargs['bind_exclude']):
+        print('--bind-exclude\n' +
+              'The directories must be absolute:\n' + ' '.join(iargs['bind_exclude']), file=stderr)
+        sys_exit(1)
+
+    # Number of shards
+    if iargs['shards'] < 1:
+        print('--shards\n' +
+              'Number of shards smaller than 1:\n' + str(iargs['shards']), file=stderr)
+        sys_exit(1)
+
+    # Time window for grouping jobs into job arrays
+    if iargs['jobs_array_window'] < 0:
+        print('--jobs-array-window\n' +
+              'Time window smaller than 0:\n' + str(iargs['jobs_array_window']), file=stderr)
+        sys_exit(1)
+        
+    # Staging of the inputs
+    if iargs['stage_dir'] and (os.path.isdir(iargs['spark_exe']) or iargs['scheduler'] == 'NONE'):
+        print('--stage-dir\n' +
+              'Staging the inputs requires the SPARK Singularity version and a scheduler (--scheduler):\n' +
+              iargs['spark_exe'], file=stderr)
+        sys_exit(1)
+    elif iargs['stage_dir'] and any('$' + x in iargs['stage_dir'] or '${' + x + '}' in iargs['stage_dir']
+                                    for x in PER_JOB_DIRS[iargs['scheduler']]):
+        print('--stage-dir\n' +
+              'The directory is created for each job by the scheduler, the staged inputs are not shared between ' +
+              'the jobs of a node (each job copies its inputs):\n' + iargs['stage_dir'], file=stderr)
+
+    # Local executor
+    if iargs['local_executor'] and iargs['scheduler'] != 'NONE':
+        print('--local-executor\n' +
+              'The local executor requires no scheduler (--scheduler NONE):\n' + iargs['scheduler'], file=stderr)
+        sys_exit(1)
+
+    # Pilot workers
+    if iargs['pilot_workers'] < 0:
+        print('--pilot-workers\n' +
+              'Number of workers smaller than 0:\n' + str(iargs['pilot_workers']), file=stderr)
+        sys_exit(1)
+    elif iargs['pilot_workers'] and iargs['scheduler'] == 'NONE':
+        print('--pilot-workers\n' +
+              'Pilot workers require a scheduler (--scheduler):\n' + iargs['scheduler'], file=stderr)
+        sys_exit(1)
+
+    # Warm Singularity instances
+    if iargs['warm_instances'] < 0:
+        print('--warm-instances\n' +
+              'Idle time smaller than 0:\n' + str(iargs['warm_instances']), file=stderr)
+        sys_exit(1)
+    elif iargs['warm_instances'] and (os.path.isdir(iargs['spark_exe']) or iargs['scheduler'] == 'NONE'):
+        print('--warm-instances\n' +
+              'Warm instances require the SPARK Singularity version and a scheduler (--scheduler):\n' +
+              iargs['spark_exe'], file=stderr)
+        sys_exit(1)
+    elif iargs['warm_instances'] and not iargs['pilot_workers']:
+        print('--warm-instances\n' +
+              'Warm instances require pilot workers (--pilot-workers), an instance started by a job ' +
+              'submitted on its own being stopped with it', file=stderr)
+        sys_exit(1)
+
+    # Resamplings of the time series
+    if iargs['resample_tseries'] and not iargs['extract_tseries']:
+        print('--resample-tseries\n' +
+              'Generating the resamplings requires the extraction of the time series (--extract-tseries)', file=stderr)
+        sys_exit(1)
+    elif iargs['resample_tseries'] and np is None:
+        print('--resample-tseries\n' +
+              'Generating the resamplings requires NumPy, which could not be imported', file=stderr)
+        sys_exit(1)
+
+    # PSOM configuration file
+    if iargs['psom_gb'] and not os.path.isfile(iargs['psom_gb']):
+        print('--psom-gb\n' +
+              'Invalid or nonexistent file:\n' + iargs['psom_gb'], file=stderr)
+        sys_exit(1)
+
+    return headers
+
+
+
+def check_params(iargs):
+    """Integrity of the parameters of the analysis (also checked for each point of a sweep)
+    """
+
     # Number of resamplings
     if iargs['nb_resamplings'] < 2:
         print('--nb-resamplings\n' +
@@ -426,19 +923,25 @@ def check_iargs_integrity(iargs):
               '[begin] is greather than [end]:\n' + str(iargs['block_window_length']), file=stderr)
         sys_exit(1)
 
-    # Maximum number of parallel jobs
-    if iargs['max_parallel_jobs'] < 1:
-        print('--max-parallel-jobs\n' +
-              'Maximum number of parallel jobs smaller than 1:\n' + str(iargs['max_parallel_jobs']), file=stderr)
-        sys_exit(1)
-        
-    # PSOM configuration file
-    if iargs['psom_gb'] and not os.path.isfile(iargs['psom_gb']):
-        print('--psom-gb\n' +
-              'Invalid or nonexistent file:\n' + iargs['psom_gb'], file=stderr)
-        sys_exit(1)
 
-    return None
+
+def same_grid(header, ref_header):
+    """Checks that two volumes share the same grid (dimensions and voxel size)
+    """
+
+    return header['dims'] == ref_header['dims'] and \
+        all(abs(a - b) <= 1e-3 * max(abs(a), abs(b)) for (a, b) in zip(header['voxel_size'], ref_header['voxel_size']))
+
+
+
+def setup_cache_dir(cache_dir):
+    """Gets the cache directory (shared by the submissions), in the user cache by default
+    """
+
+    if cache_dir:
+        return os.path.abspath(cache_dir)
+
+    return os.sep.join([os.environ.get('XDG_CACHE_HOME', os.path.expanduser(os.sep.join(['~', '.cache']))), 'spark-hpc'])
 
 
 
@@ -454,6 +957,7 @@ def setup_abspath(iargs):
     iargs['cmd_template'] = os.path.abspath(iargs['cmd_template'])
     if iargs['psom_gb']:
         iargs['psom_gb'] = os.path.abspath(iargs['psom_gb'])
+    iargs['cache_dir'] = setup_cache_dir(iargs['cache_dir'])
     
     return iargs
 
@@ -494,13 +998,201 @@ def setup_fmri_data(idata):
 
 
 
+def read_json_array(file, chunk_size=2**16):
+    """Yields the elements of a JSON array one by one, without loading the whole file
+    """
+
+    decoder = json.JSONDecoder()
+    (buf, pos, started) = ('', 0, False)
+    while True:
+        while pos < len(buf) and (buf[pos].isspace() or (started and buf[pos] == ',')):
+            pos += 1
+        if pos < len(buf) and not started:
+            if buf[pos] != '[':
+                raise ValueError('Expecting a JSON array')
+            (pos, started) = (pos + 1, True)
+            continue
+        if pos < len(buf) and buf[pos] == ']':
+            return
+
+        try:
+            if pos == len(buf):
+                raise ValueError('Need more data')
+            (element, end) = decoder.raw_decode(buf, pos)
+        except ValueError:
+            more = file.read(chunk_size)
+            if not more:
+                raise ValueError('Unterminated JSON array')
+            (buf, pos) = (buf[pos:] + more, 0)
+            continue
+
+        yield element
+        pos = end
+        if pos > chunk_size:
+            (buf, pos) = (buf[pos:], 0)
+
+
+
+def read_manifest(manifest):
+    """Yields the rows of a cohort manifest one by one, as (position in the file, row), a row
+    being a list of values or a dictionary of named values.
+    TSV (.tsv), CSV (.csv), JSON array (.json) and JSON Lines (.jsonl) are supported.
+    """
+
+    with open(manifest, 'r', newline='') as file:
+        if manifest.endswith('.json'):
+            for (i, row) in enumerate(read_json_array(file)):
+                yield ('element ' + str(i + 1), row)
+        elif manifest.endswith('.jsonl'):
+            for (i, line) in enumerate(file):
+                if line.strip():
+                    yield ('line ' + str(i + 1), json.loads(line))
+        else:
+            delimiter = ',' if manifest.endswith('.csv') else '\t'
+            for (i, row) in enumerate(csv.reader(file, delimiter=delimiter)):
+                if row and any(row) and not row[0].startswith('#'):
+                    yield ('line ' + str(i + 1), [x.strip() for x in row])
+
+
+
+def setup_fmri(iargs):
+    """Gets the fMRI data from the command line, a manifest or a BIDS dataset
+    """
+
+    if iargs['fmri_manifest']:
+        return setup_fmri_manifest(iargs['fmri_manifest'])
+    elif iargs['bids_root']:
+        return setup_fmri_bids(iargs['bids_root'], iargs['bids_subjects'], iargs['bids_sessions'],
+                               iargs['bids_tasks'], iargs['cache_dir'])
+    else:
+        return setup_fmri_data(iargs['fmri_data'])
+
+
+
+def setup_fmri_bids(bids_root, subjects, sessions, tasks, cache_dir):
+    """Discovers the fMRI data of a BIDS dataset (see spark_bids.py)
+    """
+
+    bids_root = os.path.abspath(bids_root)
+    if not os.path.isdir(bids_root):
+        print('--bids-root\n' +
+              'Invalid or nonexistent directory:\n' + bids_root, file=stderr)
+        sys_exit(1)
+
+    odata = discover(bids_root, subjects, sessions, tasks, setup_cache_dir(cache_dir))
+    if not odata:
+        print('--bids-root\n' +
+              'No fMRI data (*_bold.nii, *_bold.mnc) matching the filters in the directory:\n' + bids_root, file=stderr)
+        sys_exit(1)
+
+    return odata
+
+
+
+def setup_fmri_manifest(manifest):
+    """Reads the fMRI data from a cohort manifest (one run per row: subject, session, run and
+    path), row by row. The columns are taken in this order, unless the first row names them.
+    Relative paths are relative to the directory of the manifest.
+    """
+
+    manifest = os.path.abspath(manifest)
+    if not os.path.isfile(manifest):
+        print('--fmri-manifest\n' +
+              'Invalid or nonexistent file:\n' + manifest, file=stderr)
+        sys_exit(1)
+    manifest_dir = os.path.dirname(manifest)
+
+    names = dict([(alias, key) for (key, aliases) in MANIFEST_COLUMNS.items() for alias in aliases])
+    keys = ['subject', 'session', 'run', 'path']
+    columns = None
+
+    odata = []
+    try:
+        for (where, row) in read_manifest(manifest):
+            if isinstance(row, dict):
+                named = dict([(names.get(str(k).lower()), v) for (k, v) in row.items()])
+                data = [str(named.get(k, '')) for k in keys]
+            elif isinstance(row, list):
+                if columns is None and not odata:
+                    header = [names.get(str(x).lower()) for x in row]
+                    if all(k in header for k in keys):
+                        columns = [header.index(k) for k in keys]
+                        continue
+                data = [str(row[i]) if i < len(row) else '' for i in (columns or range(4))]
+                if columns is None and len(row) != 4:
+                    data = []
+            else:
+                data = []
+
+            if len(data) != 4 or not all(data) or any(len(x.split()) != 1 for x in data[:3]):
+                print('--fmri-manifest\n' +
+                      'Invalid row (' + where + '), expected:\n' + '[subjectid sessionid runid path]\n\n' +
+                      str(row), file=stderr)
+                sys_exit(1)
+            if not os.path.isabs(data[3]):
+                data[3] = os.sep.join([manifest_dir, data[3]])
+            odata.append(data)
+    except (OSError, ValueError, csv.Error) as e:
+        print('--fmri-manifest\n' +
+              'Failed to read the file:\n' + manifest + '\n' + str(e), file=stderr)
+        sys_exit(1)
+
+    if not odata:
+        print('--fmri-manifest\n' +
+              'No fMRI data in the file:\n' + manifest, file=stderr)
+        sys_exit(1)
+
+    return odata
+
+
+
+def setup_sweep(iargs, oargs):
+    """Expands the sweep of parameters (--sweep) into its configurations: a name and the
+    values of the swept parameters, each value being parsed and checked as if given by
+    command line
+    """
+
+    if not oargs['sweep']:
+        return []
+
+    options = [x[0] for x in oargs['sweep']]
+    invalid = [x for x in oargs['sweep'] if x[0] not in SWEEP_OPTIONS or len(x) < 2]
+    if invalid:
+        print('--sweep\n' +
+              'Invalid option or no value (valid options: ' + ', '.join(SWEEP_OPTIONS) + '):\n' +
+              '\n'.join([' '.join(x) for x in invalid]), file=stderr)
+        sys_exit(1)
+    elif len(set(options)) < len(options):
+        print('--sweep\n' +
+              'Some options are swept more than once:\n' + '\n'.join(options), file=stderr)
+        sys_exit(1)
+    elif oargs['sweep'] and oargs['shards'] > 1:
+        print('--sweep\n' +
+              'A sweep of parameters cannot be run with shards (--shards):\n' + str(oargs['shards']), file=stderr)
+        sys_exit(1)
+
+    sweep = []
+    for values in product(*[x[1:] for x in oargs['sweep']]):
+        cmd = []
+        for (option, value) in zip(options, values):
+            cmd += ['--' + option] + value.split(':')
+        sargs = check_iargs_parser(iargs + cmd)
+        params = {x.replace('-', '_'): sargs[x.replace('-', '_')] for x in options}
+        check_params(dict(oargs, **params))
+        sweep.append({'name': '_'.join([x + '-' + y.replace(':', '-') for (x, y) in zip(options, values)]),
+                      'params': params})
+
+    return sweep
+
+
+
 def check_iargs_parser(iargs):
     """Defines the possible arguments of the program, generates help and usage messages,
     and issues errors in case of invalid arguments.
     """
     
     parser = ArgumentParser(
-        prog='spark_run.bash (or spark_setup.py)',
+        prog='spark-hpc run',
         description=dedent('''\
         SParsity-based Analysis of Reliable K-hubness (SPARK) for brain fMRI functional
         connectivity
@@ -524,29 +1216,81 @@ def check_iargs_parser(iargs):
         description=dedent('''\
         __________________________________________________________________________________
         '''))
-    required.add_argument('--fmri-data', nargs='+', type=str,
-                          required=True,
-                          help=dedent('''\
-                          The fMRI data to analyze.
-                           
-                          The data is specified as follows (see example below):
-                          'subject_id session_id run_id path'.
-                          subject_id, session_id and run_id begin with a letter and
-                          are alphanumeric strings, and path can be absolute or
-                          relative.
-                          To seperate data, insert ' , ' (see example below).
-                          Don't forget the simple whitespace before and after the
-                          comma.
-                           
-                          Example:
-                          sb1 ss1 run1 path_1_1_1.nii , sb1 ss2 run1 path_1_2_1.mnc
-                           
-                          (file formats: MINC, NIfTI)
-                          (type: %(type)s)
-                          ____________________________________________________________
-                          '''),
-                          metavar='XXX',
-                          dest='fmri_data')
+    fmri_data = required.add_mutually_exclusive_group(required=True)
+    fmri_data.add_argument('--fmri-data', nargs='+', type=str,
+                           help=dedent('''\
+                           The fMRI data to analyze (or use --fmri-manifest or
+                           --bids-root).
+                            
+                           The data is specified as follows (see example below):
+                           'subject_id session_id run_id path'.
+                           subject_id, session_id and run_id begin with a letter and
+                           are alphanumeric strings, and path can be absolute or
+                           relative.
+                           To seperate data, insert ' , ' (see example below).
+                           Don't forget the simple whitespace before and after the
+                           comma.
+                            
+                           Example:
+                           sb1 ss1 run1 path_1_1_1.nii , sb1 ss2 run1 path_1_2_1.mnc
+                            
+                           (file formats: MINC, NIfTI)
+                           (type: %(type)s)
+                           ____________________________________________________________
+                           '''),
+                           metavar='XXX',
+                           dest='fmri_data')
+    fmri_data.add_argument('--fmri-manifest', nargs=1, type=str,
+                           help=dedent('''\
+                           Path (absolute or relative) to a manifest of the fMRI data
+                           to analyze, instead of --fmri-data for large cohorts.
+                            
+                           The manifest has one row per run: 'subject_id session_id
+                           run_id path', as a TSV (.tsv), CSV (.csv), JSON array
+                           (.json) or JSON Lines (.jsonl) file. The first row of a
+                           TSV/CSV file can name the columns (subject, session, run,
+                           path), and the rows of a JSON file can be objects with
+                           these keys. Relative paths are relative to the directory of
+                           the manifest. Lines beginning with '#' are ignored.
+                            
+                           The rows are validated and passed on to the pipeline one by
+                           one, through a table per pipeline controller, but the setup
+                           still holds all of them in memory (integrity checks, shards).
+                            
+                           Example (CSV):
+                           subject,session,run,path
+                           sb1,ss1,run1,path_1_1_1.nii
+                           sb1,ss2,run1,path_1_2_1.mnc
+                            
+                           (file formats: MINC, NIfTI)
+                           (type: %(type)s)
+                           ____________________________________________________________
+                           '''),
+                           metavar='XXX',
+                           dest='fmri_manifest')
+    fmri_data.add_argument('--bids-root', nargs=1, type=str,
+                           help=dedent('''\
+                           Path (absolute or relative) to a BIDS dataset whose fMRI
+                           data is to analyze, instead of --fmri-data.
+                            
+                           The functional data (sub-*/[ses-*/]func/*_bold.nii and
+                           *_bold.mnc) is discovered and mapped to subject, session and
+                           run IDs from its BIDS entities, for instance:
+                           sub-01_ses-02_task-rest_run-1_bold.nii gives
+                           sub01 ses02 taskrestrun1.
+                           The subjects, sessions and tasks can be filtered with
+                           --bids-subjects, --bids-sessions and --bids-tasks.
+                            
+                           The directories of the dataset are indexed in the cache
+                           directory (--cache-dir), so that only the directories that
+                           changed are scanned again.
+                            
+                           (file formats: MINC, NIfTI, compressed files are ignored)
+                           (type: %(type)s)
+                           ____________________________________________________________
+                           '''),
+                           metavar='XXX',
+                           dest='bids_root')
     required.add_argument('--mask', nargs=1, type=str,
                           required=True,
                           help=dedent('''\
@@ -615,6 +1359,42 @@ def check_iargs_parser(iargs):
                           Shows this help message and exits.
                           ____________________________________________________________
                           '''))
+    optional.add_argument('--bids-subjects', nargs='+', type=str,
+                          default=[],
+                          help=dedent('''\
+                          Labels of the subjects to analyze in the BIDS dataset
+                          (--bids-root), without the prefix 'sub-'.
+                           
+                          (default: all)
+                          (type: %(type)s)
+                          ____________________________________________________________
+                          '''),
+                          metavar='X',
+                          dest='bids_subjects')
+    optional.add_argument('--bids-sessions', nargs='+', type=str,
+                          default=[],
+                          help=dedent('''\
+                          Labels of the sessions to analyze in the BIDS dataset
+                          (--bids-root), without the prefix 'ses-'.
+                           
+                          (default: all)
+                          (type: %(type)s)
+                          ____________________________________________________________
+                          '''),
+                          metavar='X',
+                          dest='bids_sessions')
+    optional.add_argument('--bids-tasks', nargs='+', type=str,
+                          default=[],
+                          help=dedent('''\
+                          Labels of the tasks to analyze in the BIDS dataset
+                          (--bids-root), without the prefix 'task-'.
+                           
+                          (default: all)
+                          (type: %(type)s)
+                          ____________________________________________________________
+                          '''),
+                          metavar='X',
+                          dest='bids_tasks')
     optional.add_argument('--nb-resamplings', nargs=1, type=int,
                           default=100,
                           help=dedent('''\
@@ -767,6 +1547,61 @@ def check_iargs_parser(iargs):
                           ____________________________________________________________
                           '''),
                           dest='preserve_dc_atom')
+    optional.add_argument('--sweep', nargs='+', type=str,
+                          action='append',
+                          default=[],
+                          help=dedent('''\
+                          A sweep of parameters of the analysis: the name of an option
+                          followed by the values to try. The option can be repeated,
+                          for sweeping a grid of parameters (all the combinations of
+                          the values).
+                          The options requiring three numbers take them separated by
+                          colons, as: begin:step:end.
+                           
+                          The configurations run as one pipeline, each one with its
+                          output directory: OUT_DIR/sweep/NAME (e.g.
+                          p-value-0.05_network-scales-10-2-30). The steps that are the
+                          same for several configurations (for instance the bootstrap
+                          resampling, when only --p-value and --network-scales are
+                          swept) are run once, and their outputs are linked into the
+                          directories of the other configurations.
+                           
+                          Example:
+                          --sweep p-value 0.01 0.05 --sweep network-scales 10:2:30 6:2:20
+                           
+                          Note:
+                          - Not compatible with --shards.
+                           
+                          (valid options: nb-resamplings, resampling-method,
+                          block-window-length, network-scales, nb-iterations,
+                          dict-init-method, sparse-coding-method, p-value)
+                          (default: none)
+                          (type: %(type)s)
+                          ____________________________________________________________
+                          '''),
+                          metavar='XXX',
+                          dest='sweep')
+    optional.add_argument('--dry-run',
+                          action='store_true',
+                          help=dedent('''\
+                          If set, nothing is run: the pipeline options and the PSOM
+                          configuration files of the pipeline controllers are written
+                          (in OUT_DIR/tmp), then the planned pipeline is reported: the
+                          steps run by each controller, their number of jobs and
+                          dependency fan-in, the estimated memory per job, core-hours
+                          and storage (from the data and the parameters, as with
+                          --jobs-spec-auto), and the number of submissions to the
+                          scheduler.
+                           
+                          Note:
+                          - The job graph is approximated (runs, sessions,
+                          resamplings and network scales), the actual one being built
+                          by SPARK when the pipeline starts.
+                           
+                          (default: %(default)s)
+                          ____________________________________________________________
+                          '''),
+                          dest='dry_run')
     optional.add_argument('-v', '--verbose',
                           action='store_true',
                           help=dedent('''\
@@ -827,6 +1662,31 @@ def check_iargs_parser(iargs):
                               ____________________________________________________________
                               '''),
                               dest='interactive')
+    machine_conf.add_argument('--local-executor',
+                              action='store_true',
+                              help=dedent('''\
+                              If set, the pipeline jobs run on the local machine are
+                              scheduled by the jobs manager instead of being all started
+                              at once: as many jobs run at once as the cores and the free
+                              memory of the machine allow, the jobs that do not fit wait
+                              in a queue (instead of being killed for lack of memory), and
+                              each job is limited to one thread of the BLAS/LAPACK
+                              libraries (OMP_NUM_THREADS, OPENBLAS_NUM_THREADS,
+                              MKL_NUM_THREADS).
+                              The memory of the jobs is taken from the estimates of their
+                              step (--jobs-spec-auto), unknown otherwise (the cores only
+                              then count).
+                               
+                              Note:
+                              - The scheduler (--scheduler) must be 'NONE'.
+                              - The maximum number of parallel jobs (--max-parallel-jobs)
+                              still bounds the jobs handed to the executor at once.
+                              - MATLAB ignores the variables of the BLAS/LAPACK threads.
+                               
+                              (default: %(default)s)
+                              ____________________________________________________________
+                              '''),
+                              dest='local_executor')
     machine_conf.add_argument('--jobs-ctrl-spec', nargs=1, type=str,
                               default='',
                               help=dedent('''\
@@ -889,6 +1749,51 @@ def check_iargs_parser(iargs):
                               '''),
                               metavar='X',
                               dest='jobs_spec')
+    machine_conf.add_argument('--jobs-spec-auto',
+                              action='store_true',
+                              help=dedent('''\
+                              If set, the memory and the wall time requested for the
+                              pipeline jobs are estimated for each step of the pipeline,
+                              from the number of voxels inside the mask, the number of
+                              time points of the fMRI data, and the parameters of the
+                              analysis (--nb-resamplings, --network-scales,
+                              --nb-iterations, --sparse-coding-method). The estimated
+                              specifications are added to the ones set with --jobs-spec,
+                              which then should not request any memory nor wall time.
+                               
+                              Note:
+                              - The scheduler (--scheduler) must not be 'NONE'.
+                              - Only the data of NIfTI masks is read, for MINC masks all
+                              the voxels of the grid are counted.
+                               
+                              To set this flag permanently, specify the option
+                              'DEFAULT_JOBS_SPEC_AUTO' in the file 'DEFAULT-CONF' (set
+                              with --default-conf).
+                               
+                              (default: %(default)s)
+                              ____________________________________________________________
+                              '''),
+                              dest='jobs_spec_auto')
+    machine_conf.add_argument('--jobs-spec-calibrate',
+                              action='store_true',
+                              help=dedent('''\
+                              If set, the estimates of --jobs-spec-auto are first
+                              calibrated from the accounting (sacct) of the jobs of the
+                              previous submissions, once they are finished: the peak
+                              memory and the elapsed time of the jobs of each step are
+                              compared with their estimates. The calibration is kept in
+                              the cache directory (--cache-dir).
+                               
+                              Note: only for the scheduler 'SLURM'.
+                               
+                              To set this flag permanently, specify the option
+                              'DEFAULT_JOBS_SPEC_CALIBRATE' in the file 'DEFAULT-CONF'
+                              (set with --default-conf).
+                               
+                              (default: %(default)s)
+                              ____________________________________________________________
+                              '''),
+                              dest='jobs_spec_calibrate')
     machine_conf.add_argument('--max-parallel-jobs', nargs=1, type=int,
                               default=12,
                               help=dedent('''\
@@ -901,6 +1806,225 @@ def check_iargs_parser(iargs):
                               '''),
                               metavar='X',
                               dest='max_parallel_jobs')
+    machine_conf.add_argument('--max-queued-jobs', nargs=2, type=int,
+                              default=[],
+                              help=dedent('''\
+                              Bounds (minimum, maximum) of the number of jobs queued at
+                              once (pending or running). If set, the jobs manager adapts
+                              the number of jobs it keeps queued, starting from
+                              --max-parallel-jobs: every few seconds, the jobs of the user
+                              are read with one bulk query, as well as the account limits
+                              (MaxSubmitJobs for SLURM, max_u_jobs for SGE,
+                              max_user_queuable for TORQUE). The number is lowered when the jobs
+                              wait in the queue or when submissions fail, raised when the
+                              queue runs dry, and always kept below the account limits.
+                              If not set, at most --max-parallel-jobs jobs are queued.
+                               
+                              Note: the scheduler (--scheduler) must not be 'NONE'.
+                               
+                              (valid values: 1<=[minimum]<=[maximum])
+                              (default: none)
+                              (type: %(type)s)
+                              ____________________________________________________________
+                              '''),
+                              metavar=('X'),
+                              dest='max_queued_jobs')
+    machine_conf.add_argument('--submit-rate', nargs=1, type=float,
+                              default=0,
+                              help=dedent('''\
+                              Maximum rate (submissions per second) of the submissions to
+                              the scheduler, with bursts of at most 10 submissions (token
+                              bucket). A job array counts as one submission.
+                              If 0 is chosen, then the rate is not limited.
+                               
+                              Note: the scheduler (--scheduler) must not be 'NONE'.
+                               
+                              (valid values: %(metavar)s>=0)
+                              (default: %(default)s)
+                              (type: %(type)s)
+                              ____________________________________________________________
+                              '''),
+                              metavar='X',
+                              dest='submit_rate')
+    machine_conf.add_argument('--jobs-array-window', nargs=1, type=int,
+                              default=0,
+                              help=dedent('''\
+                              Time window (in seconds) used to group the jobs into job
+                              arrays. The jobs requested by the pipeline within the same
+                              window, and with the same specifications, are submitted to
+                              the scheduler as a single job array (of at most 1000 jobs),
+                              which reduces the load on the scheduler for large analyses.
+                              If 0 is chosen, then every job is submitted on its own.
+                               
+                              Note: the scheduler (--scheduler) must not be 'NONE'.
+                               
+                              To set the time window permanently, specify the option
+                              'DEFAULT_JOBS_ARRAY_WINDOW' in the file 'DEFAULT-CONF' (set
+                              with --default-conf).
+                              But if you choose to do so, do not specify again
+                              --jobs-array-window by command line for it would take
+                              precedence.
+                               
+                              (valid values: %(metavar)s>=0)
+                              (default: %(default)s)
+                              (type: %(type)s)
+                              ____________________________________________________________
+                              '''),
+                              metavar='X',
+                              dest='jobs_array_window')
+    machine_conf.add_argument('--stage-dir', nargs=1, type=str,
+                              default='',
+                              help=dedent('''\
+                              Storage local to the compute nodes where the inputs (fMRI
+                              data and mask) of the pipeline jobs are staged, for instance
+                              '/dev/shm' or '/local/scratch' (environment variables are
+                              expanded on the compute nodes, use single quotation marks).
+                              Each input is copied once per node, under a lock, into a
+                              cache shared by the jobs of the node, and is only used once
+                              its checksum is verified (again whenever it is reused). The
+                              jobs then read the local copies, bound onto the original
+                              paths in the container. The least recently used copies
+                              that no job uses are evicted to make room, the cache taking
+                              at most half of the storage. An input that cannot be staged
+                              (e.g. no space left) is read from its original path.
+                               
+                              Note:
+                              - Only for the SPARK Singularity version, and the scheduler
+                              (--scheduler) must not be 'NONE'.
+                              - A directory created for each job by the scheduler (e.g.
+                              '$SLURM_TMPDIR', or '$TMPDIR' with SGE and TORQUE) is
+                              removed with the job: nothing is shared, each job copies
+                              its inputs again.
+                               
+                              To set the storage permanently, specify the option
+                              'DEFAULT_STAGE_DIR' in the file 'DEFAULT-CONF' (set with
+                              --default-conf).
+                              But if you choose to do so, do not specify again
+                              --stage-dir by command line for it would take precedence.
+                               
+                              (default: no staging)
+                              (type: %(type)s)
+                              ____________________________________________________________
+                              '''),
+                              metavar='X',
+                              dest='stage_dir')
+    machine_conf.add_argument('--pilot-workers', nargs=1, type=int,
+                              default=0,
+                              help=dedent('''\
+                              Runs the pipeline jobs inside at most %(metavar)s long-lived
+                              worker allocations, instead of submitting each job to the
+                              scheduler (the queue wait being paid once per worker, not
+                              once per job).
+                              The workers are submitted with the jobs specifications
+                              (--jobs-spec), which should then request several cores, the
+                              memory and the wall time of a worker. Each worker pulls the
+                              jobs from the jobs manager and runs as many of them at once
+                              as its cores and memory allow (with --jobs-spec-auto, the
+                              memory estimated for the jobs of each step is taken into
+                              account), and leaves once no job is left. A job whose worker
+                              is lost (e.g. at its wall time) is run again by another one.
+                               
+                              Note: the scheduler (--scheduler) must not be 'NONE', and the
+                              compute nodes must be able to reach the node of the main job
+                              over the network. The maximum number of parallel jobs
+                              (--max-parallel-jobs) should cover the jobs run by all the
+                              workers at once.
+                               
+                              (valid values: %(metavar)s>=0, 0 for no workers)
+                              (default: %(default)s)
+                              (type: %(type)s)
+                              ____________________________________________________________
+                              '''),
+                              metavar='X',
+                              dest='pilot_workers')
+    machine_conf.add_argument('--warm-instances', nargs=1, type=int,
+                              default=0,
+                              help=dedent('''\
+                              Runs the pipeline jobs in Singularity instances kept warm by
+                              the pilot workers, stopped after %(metavar)s seconds without
+                              jobs, or when their worker leaves.
+                              The first job of a worker starts an instance of the image
+                              with the bindings of the submission, the next jobs of the
+                              worker run in it, which saves the mount of the image and the
+                              setup of the container for each job. A job whose instance
+                              cannot be started runs in its own container, as do the jobs
+                              whose inputs are staged (see --stage-dir).
+                               
+                              Note: only for the SPARK Singularity version, the scheduler
+                              (--scheduler) must not be 'NONE', and pilot workers are
+                              required (see --pilot-workers): the instance belongs to the
+                              allocation of a worker, whereas a job submitted on its own
+                              would take its instance down when it ends (the scheduler
+                              killing all the processes of the job).
+                               
+                              (valid values: %(metavar)s>=0, 0 for no instances)
+                              (default: %(default)s)
+                              (type: %(type)s)
+                              ____________________________________________________________
+                              '''),
+                              metavar='X',
+                              dest='warm_instances')
+    machine_conf.add_argument('--bind-depth', nargs=1, type=int,
+                              default=2,
+                              help=dedent('''\
+                              Minimum depth of the directories bound in the Singularity
+                              container for reading the fMRI data and the mask (e.g. 2
+                              for '/project/lab').
+                              Instead of binding the directory of every run, a minimal
+                              set of common ancestors of the directories is bound: the
+                              deepest common ancestor of the directories, or, if it is
+                              shallower than %(metavar)s or unsafe (e.g. '/', '/home',
+                              '/tmp', or see --bind-exclude), the common ancestors of
+                              each group of directories sharing their next component,
+                              and so on.
+                               
+                              Note: only for the SPARK Singularity version.
+                               
+                              (valid values: %(metavar)s>=1)
+                              (default: %(default)s)
+                              (type: %(type)s)
+                              ____________________________________________________________
+                              '''),
+                              metavar='X',
+                              dest='bind_depth')
+    machine_conf.add_argument('--bind-exclude', nargs='+', type=str,
+                              default=[],
+                              help=dedent('''\
+                              Directories (absolute) never bound as a whole in the
+                              Singularity container (see --bind-depth), in addition to
+                              the system directories ('/', '/bin', '/boot', '/dev',
+                              '/etc', '/home', '/lib', '/lib64', '/opt', '/proc', '/root',
+                              '/run', '/sbin', '/srv', '/sys', '/tmp', '/usr', '/var').
+                              For instance, the root of a shared filesystem.
+                               
+                              Note: only for the SPARK Singularity version.
+                               
+                              (default: none)
+                              (type: %(type)s)
+                              ____________________________________________________________
+                              '''),
+                              metavar='XXX',
+                              dest='bind_exclude')
+    machine_conf.add_argument('--shards', nargs=1, type=int,
+                              default=1,
+                              help=dedent('''\
+                              Number of independent pipeline controllers the subjects are
+                              partitioned into, for large cohorts.
+                              Each shard runs the individual steps (bootstrap resampling
+                              and sparse dictionary learning) for its subjects, with its own
+                              controller, temporary directory and PSOM logs. Then, a final
+                              controller runs the group steps (spatial clustering and
+                              k-hubness maps) over the outputs of all the shards.
+                              The maximum number of parallel jobs (--max-parallel-jobs) is
+                              split between the shards.
+                               
+                              (valid values: %(metavar)s>=1)
+                              (default: %(default)s)
+                              (type: %(type)s)
+                              ____________________________________________________________
+                              '''),
+                              metavar='X',
+                              dest='shards')
 
     # Expert
     expert = parser.add_argument_group(
@@ -932,7 +2056,7 @@ def check_iargs_parser(iargs):
                         (refer to help above).
                         - Setting the variable 'gb_psom_max_queued' in the file
                         'PSOM-GB' is definitely ignored. Use --max-parallel-jobs
-                        instead (see help above).
+                        or --max-queued-jobs instead (see help above).
                         - Do not mess with other variables in the file 'PSOM-GB'
                         unless you know what you are doing.
                          
@@ -965,16 +2089,80 @@ def check_iargs_parser(iargs):
                         '''),
                         metavar='XXX',
                         dest='default_conf')
-    
+    expert.add_argument('--cache-dir', nargs=1, type=str,
+                        default='',
+                        help=dedent('''\
+                        Path (absolute or relative) to the cache directory, shared by
+                        the successive submissions. For instance, the headers of the
+                        fMRI data and of the mask are indexed in the cache, so that
+                        only the files that changed are read again.
+                         
+                        (default: $XDG_CACHE_HOME/spark-hpc or ~/.cache/spark-hpc)
+                        (type: %(type)s)
+                        ____________________________________________________________
+                        '''),
+                        metavar='XXX',
+                        dest='cache_dir')
+    expert.add_argument('--extract-tseries',
+                        action='store_true',
+                        help=dedent('''\
+                        If set, the time series of the voxels inside the mask are
+                        extracted once per run, before submitting the pipeline, as
+                        float32 arrays in the NumPy format (time points x voxels):
+                        OUT_DIR/tseries/SUBJECT_SESSION_RUN.npy. The linear indices
+                        of the voxels inside the mask are in
+                        OUT_DIR/tseries/mask_voxels.npy. The files can be memory-
+                        mapped (see readTseries.m). The runs that did not change
+                        since their last extraction are not extracted again.
+                         
+                        Note:
+                        - Only NIfTI data is extracted, with a NIfTI mask on the same
+                        grid.
+                        - The pipeline (NIAK) does not read these files yet, they
+                        are meant for the tools that can (e.g. readTseries.m).
+                        - The extraction runs on the submission host, much faster
+                        with NumPy installed.
+                         
+                        (default: %(default)s)
+                        ____________________________________________________________
+                        '''),
+                        dest='extract_tseries')
+    expert.add_argument('--resample-tseries',
+                        action='store_true',
+                        help=dedent('''\
+                        If set (with --extract-tseries), the bootstrap resamplings of
+                        the extracted time series are generated in bulk, before
+                        submitting the pipeline, with the method and the number of
+                        resamplings of the analysis (--resampling-method,
+                        --nb-resamplings, --block-window-length), as float32
+                        arrays in the NumPy format (resamplings x time points x
+                        voxels): OUT_DIR/resamplings/SUBJECT_SESSION_RUN.npy.
+                        The resamplings of a run are reproducible, and are not
+                        generated again unless its time series or these options
+                        changed.
+                         
+                        Note:
+                        - NumPy is required.
+                        - The pipeline (NIAK) does not read these files yet, they
+                        are meant for the tools that can.
+                        - The resamplings are generated on the submission host, and
+                        the pipeline is submitted once they are all written.
+                        - A file takes 4 x resamplings x time points x voxels bytes.
+                         
+                        (default: %(default)s)
+                        ____________________________________________________________
+                        '''),
+                        dest='resample_tseries')
+
     oargs = vars(parser.parse_args(iargs))
 
     # Hack: when (nargs=1) a list should not be returned
     for k in [
-        'mask', 'out_dir', 'spark_exe', 'cmd_template',
+        'fmri_manifest', 'bids_root', 'mask', 'out_dir', 'spark_exe', 'cmd_template',
         'nb_resamplings', 'nb_iterations', 'p_value',
         'resampling_method', 'dict_init_method', 'sparse_coding_method', 'preserve_dc_atom', 'verbose',
-        'scheduler', 'interactive', 'jobs_ctrl_spec', 'jobs_spec', 'max_parallel_jobs',
-        'psom_gb']:
+        'scheduler', 'interactive', 'jobs_ctrl_spec', 'jobs_spec', 'max_parallel_jobs', 'submit_rate', 'jobs_array_window', 'stage_dir', 'pilot_workers', 'warm_instances', 'bind_depth', 'shards',
+        'psom_gb', 'cache_dir']:
         if type(oargs[k]) is list:
             oargs[k] = oargs[k][0]
 
@@ -987,10 +2175,11 @@ def check_iargs(iargs):
     """
     
     oargs = check_iargs_parser(iargs)
-    oargs['fmri_data'] = setup_fmri_data(oargs['fmri_data'])
+    oargs['fmri_data'] = setup_fmri(oargs)
     oargs = setup_abspath(oargs)
-    check_iargs_integrity(oargs)
-    oargs['version'] = setup_version(oargs['spark_exe'], oargs['scheduler'])
+    oargs['headers'] = check_iargs_integrity(oargs)
+    oargs['sweep'] = setup_sweep(iargs, oargs)
+    oargs['version'] = setup_version(oargs['spark_exe'], oargs['scheduler'], oargs['local_executor'])
     return oargs
 
 
@@ -1022,6 +2211,10 @@ def default_cmd(iargs):
         'DEFAULT_INTERACTIVE', 
         'DEFAULT_JOBS_CTRL_SPEC', 
         'DEFAULT_JOBS_SPEC', 
+        'DEFAULT_JOBS_SPEC_AUTO', 
+        'DEFAULT_JOBS_SPEC_CALIBRATE', 
+        'DEFAULT_JOBS_ARRAY_WINDOW', 
+        'DEFAULT_STAGE_DIR', 
         'DEFAULT_PSOM_GB'
         ]
     with open(default_conf, 'r', newline='\n') as file:
@@ -1036,8 +2229,10 @@ def default_cmd(iargs):
 
 
 
-def main(iargs):
-    """Main function, checks the inputs, makes the necessary files to run SPARK
+def setup(iargs):
+    """Checks the inputs and makes the necessary files to run SPARK.
+    Returns the options of the application entrypoint (see setup_entrypoint_opt), or None if
+    there is nothing to run (dry run, or all the steps up to date).
     """
 
     oargs = check_iargs(default_cmd(iargs) + iargs)
@@ -1046,18 +2241,51 @@ def main(iargs):
     
     tmp_dir = setup_tmp_dir(oargs['out_dir'])
 
-    oargs['psom_gb'] = setup_psom_gb(oargs['psom_gb'], oargs['version'], oargs['spark_exe'], oargs['scheduler'],
-                                     oargs['jobs_spec'], oargs['max_parallel_jobs'], tmp_dir)
+    if oargs['extract_tseries'] and not oargs['dry_run']:
+        tseries = setup_tseries(oargs['fmri_data'], oargs['mask'], oargs['headers'], oargs['out_dir'])
+        if oargs['resample_tseries']:
+            setup_resamplings(tseries, oargs['out_dir'], oargs['resampling_method'], oargs['nb_resamplings'],
+                              oargs['block_window_length'])
 
-    pipe_opt = setup_pipe_opt(oargs, tmp_dir)
+    if oargs['sweep']:
+        (controllers, hooks) = setup_sweep_controllers(oargs, tmp_dir, oargs['sweep'], oargs['dry_run'])
+    else:
+        (steps, rerun, steps_dir) = setup_steps(oargs, oargs['dry_run'])
+        if not steps:
+            print('All the steps of the pipeline are up to date in the output directory:\n' + oargs['out_dir'], file=stderr)
+            return None
+        controllers = setup_controllers(oargs, tmp_dir, steps, rerun, steps_dir)
+        hooks = ()
+
+    if oargs['dry_run']:
+        print(setup_plan(oargs, controllers))
+        return None
 
     app_spec = setup_app_spec(oargs, tmp_dir)
 
-    main_job = setup_main_job(oargs['version'], oargs['cmd_template'], oargs['spark_exe'], oargs['scheduler'], pipe_opt, app_spec, tmp_dir)
+    main_job = setup_main_job(oargs['version'], oargs['cmd_template'], oargs['spark_exe'], oargs['scheduler'],
+                              oargs['jobs_array_window'], controllers, app_spec, tmp_dir, hooks)
     
     entrypoint_opt = setup_entrypoint_opt(main_job, oargs['interactive'], oargs['scheduler'], oargs['jobs_ctrl_spec'], tmp_dir)
 
-    print(entrypoint_opt)
+    return {
+        'entrypoint_opt': entrypoint_opt,
+        'main_job': main_job,
+        'interactive': oargs['interactive'],
+        'scheduler': oargs['scheduler'],
+        'jobs_ctrl_spec': oargs['jobs_ctrl_spec']}
+
+
+
+def main(iargs):
+    """Main function, checks the inputs, makes the necessary files to run SPARK and prints
+    the options file of the application entrypoint (nothing if there is nothing to run)
+    """
+
+    entrypoint = setup(iargs)
+
+    if entrypoint is not None:
+        print(entrypoint['entrypoint_opt'])
 
     return sys_exit(0)
 
@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Stages the input files of a pipeline job into a cache local to the compute node, shared by
+# the jobs running on the node (meant to be run by the wrapper of the jobs, see
+# frames/job_wrapper.bash)
+#
+# Usage:
+#     spark_stage.py STAGE_DIR FILE [FILE ...]
+# Prints the Singularity bindings of the staged copies onto the original paths
+# (local_copy:original_path,...), the files that could not be staged being left out.
+# The least recently used copies are evicted to make room, except those in use: the wrapper
+# holds a shared lock on LOCAL_COPY.use until its job ends.
+#
+# Last revision: October, 2026
+# Maintainer: Obai Bin Ka'b Ali @aliobaibk
+# License: In the app folder or check GNU GPL-3.0.
+
+
+
+import fcntl
+from getpass import getuser
+import hashlib
+import os
+import shutil
+from sys import argv, stderr
+from sys import exit as sys_exit
+from time import time
+
+
+
+# Size of the chunks read when copying and hashing the files
+CHUNK_SIZE = 2**22
+
+# Space left free on the local storage (bytes)
+MIN_FREE_SPACE = 2**30
+
+# Largest part of the local storage taken by the cache (e.g. '/dev/shm' is memory)
+MAX_CACHE_FRACTION = 0.5
+
+# Copies used more recently than that (seconds) are not evicted, their job may be starting
+MIN_EVICTION_AGE = 300
+
+# Environment variables of the directories created for each job by the schedulers (removed
+# with the job, nothing is shared between the jobs of a node)
+PER_JOB_DIRS = {'SGE': ['TMPDIR'], 'SLURM': ['SLURM_TMPDIR'], 'TORQUE': ['TMPDIR', 'PBS_TMPDIR']}
+
+
+
+def hash_file(path):
+    """SHA-256 of a file
+    """
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+
+def copy_file(src, dst):
+    """Copies a file and returns the SHA-256 of the data read from the source.
+    The partial copy is removed if the copy fails.
+    """
+
+    digest = hashlib.sha256()
+    try:
+        with open(src, 'rb') as ifile:
+            with open(dst, 'wb') as ofile:
+                for chunk in iter(lambda: ifile.read(CHUNK_SIZE), b''):
+                    digest.update(chunk)
+                    ofile.write(chunk)
+    except BaseException:
+        if os.path.exists(dst):
+            os.remove(dst)
+        raise
+
+    return digest.hexdigest()
+
+
+
+def lock_free(path):
+    """Whether no other process holds a lock on a file (the lock is released right away)
+    """
+
+    try:
+        with open(path, 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        return False
+
+    return True
+
+
+
+def evict(cache_dir, size):
+    """Removes the least recently used copies of the cache (the modification time of their
+    checksum being their last use) until a file of the given size fits: MIN_FREE_SPACE left
+    free on the storage, and the cache within MAX_CACHE_FRACTION of it. The copies being
+    staged, in use by a job or recently used are kept.
+    Returns whether the file fits.
+    """
+
+    entries = []
+    for name in os.listdir(cache_dir):
+        if name.endswith('.sha256'):
+            local = os.sep.join([cache_dir, name[:-len('.sha256')]])
+            try:
+                entries.append((os.path.getmtime(local + '.sha256'), local, os.path.getsize(local)))
+            except OSError:
+                continue
+
+    usage = shutil.disk_usage(cache_dir)
+    (free, used) = (usage.free, sum(x[2] for x in entries))
+    for (last_use, local, nbytes) in sorted(entries):
+        if free >= size + MIN_FREE_SPACE and used + size <= MAX_CACHE_FRACTION * usage.total:
+            break
+        if last_use > time() - MIN_EVICTION_AGE or not lock_free(local + '.lock') or not lock_free(local + '.use'):
+            continue
+        for path in [local + '.sha256', local]:
+            if os.path.exists(path):
+                os.remove(path)
+        (free, used) = (free + nbytes, used - nbytes)
+
+    return free >= size + MIN_FREE_SPACE and used + size <= MAX_CACHE_FRACTION * usage.total
+
+
+
+def stage_file(cache_dir, path):
+    """Returns the local copy of a file, copying it first if no other job of the node did.
+    The cache entry depends on the path, the modification time and the size of the file (a
+    modified file is copied again). The copy is made under a lock of the entry, and is only
+    used once its checksum matches the one of the source, checked again whenever the copy is
+    reused (a corrupted copy is replaced). Room is made by evicting the least recently used
+    copies (see evict).
+    Returns None if the file could not be staged.
+    """
+
+    st = os.stat(path)
+    key = hashlib.sha1((path + ':' + str(st.st_mtime_ns) + ':' + str(st.st_size)).encode()).hexdigest()[:16]
+    local = os.sep.join([cache_dir, key + '-' + os.path.basename(path)])
+    checksum = local + '.sha256'
+
+    with open(local + '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+
+        if os.path.isfile(checksum) and os.path.isfile(local) and os.path.getsize(local) == st.st_size:
+            with open(checksum, 'r') as file:
+                if file.read().strip() == hash_file(local):
+                    os.utime(checksum) # Last use, for the eviction
+                    return local
+            os.remove(checksum)
+            print('The staged copy of the file is corrupted, copied again:\n' + path, file=stderr)
+
+        if not evict(cache_dir, st.st_size):
+            print('Not enough space for staging the file:\n' + path, file=stderr)
+            return None
+
+        tmp_local = local + '.tmp'
+        digest = copy_file(path, tmp_local)
+        if hash_file(tmp_local) != digest:
+            os.remove(tmp_local)
+            print('The staged copy of the file is corrupted:\n' + path, file=stderr)
+            return None
+        os.replace(tmp_local, local)
+        with open(local + '.use', 'a'):
+            pass
+        with open(checksum, 'w') as file:
+            file.write(digest + '\n')
+
+    return local
+
+
+
+def main(iargs):
+    """Main function, stages the files and prints their bindings
+    """
+
+    if len(iargs) < 2:
+        print('Usage: spark_stage.py STAGE_DIR FILE [FILE ...]', file=stderr)
+        return sys_exit(1)
+
+    # Shared by the jobs of the user on the node
+    stage_dir = os.path.expandvars(iargs[0])
+    cache_dir = os.sep.join([stage_dir, 'spark-stage-' + getuser()])
+
+    binds = []
+    try:
+        if not stage_dir or '$' in stage_dir or not os.path.isdir(stage_dir):
+            raise OSError('Nonexistent directory (or undefined environment variable): ' + iargs[0])
+        os.makedirs(cache_dir, exist_ok=True)
+    except OSError as e:
+        print('Failed to create the staging directory:\n' + cache_dir + '\n' + str(e), file=stderr)
+        iargs = iargs[:1]
+
+    for path in iargs[1:]:
+        try:
+            local = stage_file(cache_dir, path)
+        except OSError as e:
+            print('Failed to stage the file:\n' + path + '\n' + str(e), file=stderr)
+            local = None
+        if local is not None:
+            binds.append(local + ':' + path)
+
+    print(','.join(binds))
+
+    return sys_exit(0)
+
+
+
+############## Main
+if __name__ == "__main__":
+    main(argv[1:])
@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Keys the outputs of the steps of the pipeline by a hash of their inputs, so that only the
+# steps invalidated since the last submission are run again (meant to be used by
+# spark_setup.py). With a sweep of parameters, also links the outputs of the steps shared
+# between configurations into the output directories of the configurations:
+#
+# Usage:
+#     spark_steps.py link TABLE
+# TABLE: one link per line, tab separated: step, source output directory, destination output
+# directory.
+#
+# Last revision: October, 2026
+# Maintainer: Obai Bin Ka'b Ali @aliobaibk
+# License: In the app folder or check GNU GPL-3.0.
+
+
+
+import glob
+import hashlib
+import json
+import os
+from sys import argv, stderr
+from sys import exit as sys_exit
+import time
+
+
+
+# Version of the keys, to be increased whenever the outputs of a step change for the same inputs
+STEPS_VERSION = 1
+
+# Parameters consumed by each step (1: bootstrap resampling, 2: sparse dictionary learning,
+# 3: spatial clustering, 4: k-hubness maps), a step also depending on the previous one
+STEPS_PARAMS = [
+    ['nb_resamplings', 'resampling_method', 'block_window_length'],
+    ['network_scales', 'nb_iterations', 'dict_init_method', 'sparse_coding_method', 'preserve_dc_atom'],
+    [],
+    ['p_value']
+    ]
+
+
+
+def file_key(path):
+    """Identity of a file: path, modification time and size
+    """
+
+    st = os.stat(path)
+    return [path, st.st_mtime_ns, st.st_size]
+
+
+
+def step_keys(iargs):
+    """Keys of the steps of the pipeline: the hash of the parameters consumed by a step and of
+    the key of the previous step, the first step depending on the fMRI data and the mask
+    """
+
+    keys = []
+    content = {'version': STEPS_VERSION,
+               'fmri_data': [data[:3] + file_key(data[-1]) for data in iargs['fmri_data']],
+               'mask': file_key(iargs['mask'])}
+    for params in STEPS_PARAMS:
+        content.update({k: iargs[k] for k in params})
+        if content.get('resampling_method', 'CBB') != 'CBB':
+            # The window length is only used by the circular block bootstrap
+            content.pop('block_window_length', None)
+        keys.append(hashlib.sha256(json.dumps(content, sort_keys=True).encode()).hexdigest())
+        content = {'previous': keys[-1]}
+
+    return keys
+
+
+
+def load_record(steps_dir):
+    """Loads the record of the steps of the last submissions (step -> key, time since when the
+    key is used, and number of lists of outputs expected)
+    """
+
+    try:
+        with open(os.sep.join([steps_dir, 'steps.json']), 'r') as file:
+            record = json.load(file)
+        if record.get('version') == STEPS_VERSION:
+            return record
+    except (OSError, ValueError):
+        pass
+
+    return {'version': STEPS_VERSION, 'steps': dict()}
+
+
+
+def save_record(steps_dir, record):
+    """Saves the record of the steps (atomically, as for the headers index)
+    """
+
+    try:
+        tmp_path = os.sep.join([steps_dir, 'steps.json.' + str(os.getpid())])
+        with open(tmp_path, 'w') as file:
+            json.dump(record, file)
+        os.replace(tmp_path, os.sep.join([steps_dir, 'steps.json']))
+    except OSError as e:
+        print('Failed to save the record of the steps of the pipeline:\n' + steps_dir + '\n' + str(e), file=stderr)
+
+
+
+def remove_lists(steps_dir, step):
+    """Removes the lists of the outputs of a step, before the step is run again
+    """
+
+    for path in glob.glob(os.sep.join([glob.escape(steps_dir), '*.' + str(step) + '.txt'])):
+        os.remove(path)
+
+
+
+def step_done(steps_dir, step, entry):
+    """Whether a step is complete: all the lists of its outputs (written by the pipeline
+    controllers) are there, and all the listed outputs exist and were written since its key
+    is used
+    """
+
+    lists = glob.glob(os.sep.join([glob.escape(steps_dir), '*.' + str(step) + '.txt']))
+    if len(lists) != entry['nb_lists']:
+        return False
+
+    for path in lists:
+        with open(path, 'r') as file:
+            for line in file:
+                try:
+                    if os.stat(line.rstrip('\n')).st_mtime_ns < entry['since']:
+                        return False
+                except OSError:
+                    return False
+
+    return True
+
+
+
+def setup_steps(iargs, dry_run=False):
+    """Finds the steps of the pipeline to run: from the first step whose key changed or that
+    is not complete, to the last one. The steps whose key changed are run again from scratch.
+    The lists of the outputs of the steps to run are removed, and the controllers write them
+    again in out_dir/steps.
+    Returns the steps to run, the steps to run again from scratch, and the directory of the
+    lists of the outputs. A dry run leaves the record and the lists untouched.
+    """
+
+    steps_dir = os.sep.join([iargs['out_dir'], 'steps'])
+    os.makedirs(steps_dir, exist_ok=True)
+
+    record = load_record(steps_dir)
+    keys = step_keys(iargs)
+    now = time.time_ns()
+
+    # As partitioned by setup_shards, for the steps 1-2
+    nb_shards = min(iargs['shards'], len({data[0] for data in iargs['fmri_data']})) if iargs['shards'] > 1 else 1
+
+    steps = []
+    rerun = []
+    for (k, key) in enumerate(keys):
+        step = k + 1
+        entry = record['steps'].get(str(step))
+        same = entry is not None and entry['key'] == key
+        try:
+            if not steps and same and step_done(steps_dir, step, entry):
+                continue
+        except OSError:
+            pass
+
+        steps.append(step)
+        if not same:
+            rerun.append(step)
+            entry = {'key': key, 'since': now}
+        entry['nb_lists'] = nb_shards if step <= 2 else 1
+        record['steps'][str(step)] = entry
+
+        if not dry_run:
+            remove_lists(steps_dir, step)
+
+    if not dry_run:
+        save_record(steps_dir, record)
+
+    return (steps, rerun, steps_dir)
+
+
+
+def link_outputs(step, src_dir, dst_dir):
+    """Links the outputs of a step listed in a source output directory into a destination
+    output directory, at the same relative paths (the files already in the destination are
+    kept, the links replaced)
+    """
+
+    src_dir = src_dir.rstrip(os.sep) + os.sep
+    lists = glob.glob(os.sep.join([glob.escape(src_dir.rstrip(os.sep)), 'steps', '*.' + str(step) + '.txt']))
+    if not lists:
+        raise OSError('No list of the outputs of the step ' + str(step) + ' in: ' + src_dir)
+
+    nb = 0
+    for path in lists:
+        with open(path, 'r') as file:
+            for line in file:
+                src = line.rstrip('\n')
+                if not src.startswith(src_dir):
+                    continue
+                dst = os.sep.join([dst_dir, src[len(src_dir):]])
+                os.makedirs(os.path.dirname(dst), exist_ok=True)
+                if os.path.islink(dst):
+                    os.remove(dst)
+                elif os.path.exists(dst):
+                    continue
+                os.symlink(src, dst)
+                nb += 1
+
+    return nb
+
+
+
+def main(iargs):
+    """Main function, links the outputs of the steps shared between the configurations of a
+    sweep
+    """
+
+    if len(iargs) != 2 or iargs[0] != 'link':
+        print('Usage: spark_steps.py link TABLE', file=stderr)
+        return sys_exit(1)
+
+    failed = False
+    with open(iargs[1], 'r') as file:
+        for line in file:
+            (step, src_dir, dst_dir) = line.rstrip('\n').split('\t')
+            try:
+                link_outputs(int(step), src_dir, dst_dir)
+            except OSError as e:
+                print('Failed to link the outputs of the step ' + step + ' into:\n' + dst_dir + '\n' + str(e), file=stderr)
+                failed = True
+
+    return sys_exit(int(failed))
+
+
+
+############## Main
+if __name__ == "__main__":
+    main(argv[1:])
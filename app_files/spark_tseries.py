@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Extracts once per run the time series of the voxels inside the mask, as float32 arrays that
+# can be memory-mapped (.npy) (meant to be used by spark_setup.py)
+#
+# Last revision: October, 2026
+# Maintainer: Obai Bin Ka'b Ali @aliobaibk
+# License: In the app folder or check GNU GPL-3.0.
+
+
+
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from itertools import compress
+import json
+from operator import itemgetter
+import os
+from sys import byteorder, stderr
+
+from spark_headers import NIFTI_TYPES
+
+# Optional, the volumes are gathered and scaled by whole arrays with it
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+
+# Maximum number of processes extracting the time series
+MAX_WORKERS = 8
+
+# Version of the files, to be increased whenever their content changes
+TSERIES_VERSION = 1
+
+
+
+def read_volume(file, header, t):
+    """Reads the t-th 3D volume of an opened NIfTI file (unscaled)
+    """
+
+    nb_voxels = header['dims'][0] * header['dims'][1] * header['dims'][2]
+    data = array(NIFTI_TYPES[header['datatype']])
+    file.seek(header['vox_offset'] + t * nb_voxels * data.itemsize)
+    data.frombytes(file.read(nb_voxels * data.itemsize))
+    if len(data) < nb_voxels:
+        raise ValueError('Truncated data')
+    if data.itemsize > 1 and header['endian'] != {'little': '<', 'big': '>'}[byteorder]:
+        data.byteswap()
+
+    return data
+
+
+
+def npy_header(dtype, shape):
+    """Header of a .npy file (format 1.0), padded so that the data is aligned on 64 bytes
+    """
+
+    header = "{'descr': '" + dtype + "', 'fortran_order': False, 'shape': (" + \
+        ''.join([str(x) + ', ' for x in shape]).rstrip(' ') + "), }"
+    header += ' ' * (63 - (10 + len(header)) % 64) + '\n'
+
+    return b'\x93NUMPY\x01\x00' + len(header).to_bytes(2, 'little') + header.encode('latin1')
+
+
+
+def write_npy(path, dtype, shape, rows):
+    """Writes a little-endian .npy file row by row (atomically)
+    """
+
+    tmp_path = path + '.' + str(os.getpid())
+    with open(tmp_path, 'wb') as file:
+        file.write(npy_header(dtype, shape))
+        for row in rows:
+            if byteorder != 'little':
+                row.byteswap()
+            row.tofile(file)
+    os.replace(tmp_path, path)
+
+
+
+def extract_run(fmri, header, voxels, opath):
+    """Extracts the time series of the voxels inside the mask of a run, one volume at a time,
+    as a float32 (time points x voxels) array (scaled as specified by the header). With numpy,
+    the voxels of a volume are gathered and scaled as a whole, without looping over them.
+    """
+
+    getter = itemgetter(*voxels)
+    (slope, inter) = (header['scl_slope'] or 1, header['scl_inter'])
+
+    def np_rows():
+        nb_voxels = header['dims'][0] * header['dims'][1] * header['dims'][2]
+        dtype = np.dtype(NIFTI_TYPES[header['datatype']]).newbyteorder(header['endian'])
+        indices = np.asarray(voxels)
+        with open(fmri, 'rb') as file:
+            for t in range(header['nb_timepoints']):
+                file.seek(header['vox_offset'] + t * nb_voxels * dtype.itemsize)
+                data = np.fromfile(file, dtype=dtype, count=nb_voxels)
+                if data.size < nb_voxels:
+                    raise ValueError('Truncated data')
+                data = data[indices]
+                if slope != 1 or inter != 0:
+                    data = data * slope + inter
+                row = array('f')
+                row.frombytes(data.astype('=f4').tobytes())
+                yield row
+
+    def rows():
+        with open(fmri, 'rb') as file:
+            for t in range(header['nb_timepoints']):
+                row = getter(read_volume(file, header, t))
+                row = array('f', row if len(voxels) > 1 else [row])
+                if slope != 1 or inter != 0:
+                    row = array('f', [x * slope + inter for x in row])
+                yield row
+
+    write_npy(opath, '<f4', (header['nb_timepoints'], len(voxels)), rows() if np is None else np_rows())
+
+    return opath
+
+
+
+def source_key(path):
+    """What the extracted time series depend on: path, modification time and size of a file
+    """
+
+    st = os.stat(path)
+    return [path, st.st_mtime_ns, st.st_size]
+
+
+
+def setup_tseries(fmri_data, mask, headers, out_dir):
+    """Extracts in parallel the time series of the voxels inside the mask, for every run whose
+    file is NIfTI (MINC data is left out), into out_dir/tseries/SUBJECT_SESSION_RUN.npy.
+    The linear indices (in the order of the NIfTI data) of the voxels inside the mask are in
+    out_dir/tseries/mask_voxels.npy. The runs that did not change since their last extraction
+    are not extracted again.
+    Returns the list of the extracted files.
+    """
+
+    tseries_dir = os.sep.join([out_dir, 'tseries'])
+    os.makedirs(tseries_dir, exist_ok=True)
+
+    mask_header = headers[mask]
+    if mask_header is None or not mask_header['format'].startswith('nifti') or mask_header['datatype'] not in NIFTI_TYPES:
+        print('--extract-tseries\n' +
+              'The mask is not a NIfTI file, the time series are not extracted:\n' + mask, file=stderr)
+        return []
+
+    with open(mask, 'rb') as file:
+        volume = read_volume(file, mask_header, 0)
+    voxels = array('q', compress(range(len(volume)), volume))
+    if not voxels:
+        print('--extract-tseries\n' +
+              'The mask is empty, the time series are not extracted:\n' + mask, file=stderr)
+        return []
+    write_npy(os.sep.join([tseries_dir, 'mask_voxels.npy']), '<i8', (len(voxels),), [voxels])
+    mask_key = source_key(mask)
+
+    jobs = []
+    opaths = []
+    for data in fmri_data:
+        header = headers[data[-1]]
+        if header is None or not header['format'].startswith('nifti') or header['datatype'] not in NIFTI_TYPES or \
+                header['dims'] != mask_header['dims']:
+            continue
+
+        opath = os.sep.join([tseries_dir, '_'.join(data[:3]) + '.npy'])
+        source = {'version': TSERIES_VERSION, 'fmri': source_key(data[-1]), 'mask': mask_key}
+        try:
+            with open(opath + '.json', 'r') as file:
+                done = json.load(file) == source and os.path.isfile(opath)
+        except (OSError, ValueError):
+            done = False
+        opaths.append(opath)
+        if not done:
+            jobs.append((data[-1], header, opath, source))
+
+    if jobs:
+        with ProcessPoolExecutor(max_workers=min(MAX_WORKERS, os.cpu_count() or 1, len(jobs))) as pool:
+            futures = [(pool.submit(extract_run, x[0], x[1], voxels, x[2]), x) for x in jobs]
+            for (future, (fmri, _, opath, source)) in futures:
+                try:
+                    future.result()
+                except (OSError, ValueError) as e:
+                    print('Failed to extract the time series of:\n' + fmri + '\n' + str(e), file=stderr)
+                    opaths.remove(opath)
+                    continue
+                with open(opath + '.json', 'w') as file:
+                    json.dump(source, file)
+
+    return opaths
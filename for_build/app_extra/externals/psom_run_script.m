@@ -408,7 +408,23 @@ switch opt.mode
                 fprintf(opt.file_handle,'%s',msg);
             end
         end
-        [flag_failed,msg] = system(instr_qsub);
+        if ~isempty(getenv('SPARK_JOBS_FIFO'))
+            % SPARK: the submission is handed to the jobs manager (spark_jobs_manager.py)
+            % through its FIFO, which avoids forking the Matlab process for every job
+            instr_fifo = sprintf('qsub_options -N %s %s SPLIT_LINE shell_exec_options /bin/sh "%s"',name_job,opt.qsub_options,script);
+            if ~isempty(logs)
+                instr_fifo = sprintf('%s >"%s" 2>"%s" SPLIT_LINE failed_tag %s',instr_fifo,logs.oqsub,logs.eqsub,logs.failed);
+            end
+            [hf_fifo,msg] = fopen(getenv('SPARK_JOBS_FIFO'),'a');
+            flag_failed = (hf_fifo == -1);
+            if ~flag_failed
+                fprintf(hf_fifo,'%s\n',instr_fifo);
+                fclose(hf_fifo);
+                msg = '';
+            end
+        else
+            [flag_failed,msg] = system(instr_qsub);
+        end
 end
 
 if (flag_failed~=0)&&exist('msg','var')
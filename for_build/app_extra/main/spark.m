@@ -6,7 +6,8 @@ try
         'nb_resamplings'; 'network_scales'; 'nb_iterations'; 'p_value'; ...
         'resampling_method'; 'block_window_length'; 'dict_init_method'; ...
         'sparse_coding_method'; 'preserve_dc_atom'; ...
-        'verbose'; 'psom_gb'};
+        'verbose'; 'psom_gb'; 'steps'; 'step_prefixes'; 'controller'; 'stage_table'; ...
+        'rerun_steps'; 'steps_outputs'};
     
     p = struct();
     [fid, msg] = fopen(varargin{1}, 'r');
@@ -34,6 +35,27 @@ try
     end
     fclose(fid);
     
+    % Optional parameters (sub-pipelines, see spark_setup.py --shards)
+    if ~isfield(p, 'steps')
+        p.steps = '1 2 3 4';
+    end
+    if ~isfield(p, 'controller')
+        p.controller = '';
+    end
+    
+    % Optional parameter (staging of the inputs, see spark_setup.py --stage-dir)
+    if ~isfield(p, 'stage_table')
+        p.stage_table = '';
+    end
+    
+    % Optional parameters (steps to run again, see spark_setup.py and spark_steps.py)
+    if ~isfield(p, 'rerun_steps')
+        p.rerun_steps = '';
+    end
+    if ~isfield(p, 'steps_outputs')
+        p.steps_outputs = '';
+    end
+    
     if str2double(p.verbose)
         fprintf('\n\n     ***** \nUsing the following public parameters:\n')
         disp(p)
@@ -54,6 +76,13 @@ try
     % p.out_size = 'quality_control'; % useless...
     p.test = '0';
     
+    % The steps whose inputs changed since the last submission are run again from scratch
+    for s = str2double(strsplit(strtrim(p.rerun_steps), ' '))
+        if ~isnan(s)
+            p.(['rerun_step', num2str(s)]) = '1';
+        end
+    end
+    
     % Be safe, some code may forget to append filesep...
     p.out_dir = [p.out_dir, filesep];
     
@@ -62,12 +91,29 @@ try
     opt = struct();
     
     % Subjects
-    data = strsplit(p.fmri_data, ' , ');
-    for k = 1:numel(data)
-        sep = strfind(data{k}, ' ');
-        files_in.(data{k}(1:sep(1)-1)).fmri.(data{k}(sep(1)+1:sep(2)-1)).(data{k}(sep(2)+1:sep(3)-1)) = data{k}(sep(3)+1:end);
+    % (one run per row: subject session run path, tab-separated, see spark_setup.py)
+    [fid, msg] = fopen(p.fmri_data, 'r');
+    if fid == -1
+        fprintf('\n     - Could not open the fMRI data table:\n%s', msg);
+        exit(1)
+    end
+    inputs = {};
+    while true
+        s = fgetl(fid);
+        if ((numel(s) == 1) && (s == -1))
+            break
+        end
+        
+        sep = strfind(s, sprintf('\t'));
+        if numel(sep) < 3
+            continue
+        end
+        files_in.(s(1:sep(1)-1)).fmri.(s(sep(1)+1:sep(2)-1)).(s(sep(2)+1:sep(3)-1)) = s(sep(3)+1:end);
+        inputs{end+1} = s(sep(3)+1:end);
     end
-    clear data k sep
+    fclose(fid);
+    inputs{end+1} = p.mask;
+    clear s sep
     
     
     % Step 1: Bootstrap resampling
@@ -124,8 +170,42 @@ try
     
     
     %% Runs SPARK
-    [pipeline, opt] = spark_pipeline_fmri_kmap(files_in, opt); %#ok
-    save([p.out_dir, filesep, 'pipeline', '.mat'], 'pipeline', 'opt')
+    steps = str2double(strsplit(p.steps, ' '));
+    stepPrefixes = strsplit(p.step_prefixes, ' ');
+    if isempty(p.controller) && isequal(sort(steps), 1:4) && isempty(p.stage_table)
+        [pipeline, opt] = spark_pipeline_fmri_kmap(files_in, opt); %#ok
+        pipeline_name = 'pipeline';
+        if ~isempty(p.steps_outputs)
+            writeStepsOutputs(pipeline, steps, stepPrefixes, p.steps_outputs);
+        end
+    else
+        % Sub-pipeline: only the jobs of some steps, with its own PSOM logs,
+        % and/or the inputs of the jobs written for staging them before the jobs start
+        flag_test = opt.flag_test;
+        opt.flag_test = 1;
+        [pipeline, opt] = spark_pipeline_fmri_kmap(files_in, opt);
+        pipeline = selectPipelineSteps(pipeline, steps, stepPrefixes);
+        if ~isfield(opt, 'psom')
+            opt.psom = struct();
+        end
+        if isempty(p.controller)
+            opt.psom.path_logs = [p.out_dir, 'logs', filesep];
+            pipeline_name = 'pipeline';
+        else
+            opt.psom.path_logs = [p.out_dir, 'logs', filesep, p.controller, filesep];
+            pipeline_name = ['pipeline_', p.controller];
+        end
+        if ~isempty(p.stage_table)
+            writeJobsInputs(pipeline, inputs, p.stage_table);
+        end
+        if ~isempty(p.steps_outputs)
+            writeStepsOutputs(pipeline, steps, stepPrefixes, p.steps_outputs);
+        end
+        if ~flag_test
+            psom_run_pipeline(pipeline, opt.psom);
+        end
+    end
+    save([p.out_dir, filesep, pipeline_name, '.mat'], 'pipeline', 'opt')
 
     fprintf('\n\n\n     - To terminate the program, type ''exit''\n');
 catch err
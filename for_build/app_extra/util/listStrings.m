@@ -0,0 +1,17 @@
+function strs = listStrings(x)
+% All the strings held by a (nested) structure or cell array (e.g. the files_in, files_out
+% or opt of a PSOM job)
+
+if ischar(x)
+    strs = {x};
+elseif iscell(x) || isstruct(x)
+    if isstruct(x)
+        x = struct2cell(x);
+    end
+    strs = cellfun(@listStrings, x(:)', 'UniformOutput', false);
+    strs = [{}, strs{:}];
+else
+    strs = {};
+end
+
+end
@@ -0,0 +1,47 @@
+function [tseries, voxels] = readTseries(file)
+% Reads the time series of the voxels inside the mask extracted for a run by
+% spark_setup.py --extract-tseries (float32 .npy file, time points x voxels), and the
+% linear indices of the voxels inside the mask (mask_voxels.npy, in the same folder).
+% The file is memory-mapped with MATLAB, and read in a single pass with GNU Octave.
+
+[offset, shape] = readNpyHeader(file);
+if exist('memmapfile', 'file') == 2
+    m = memmapfile(file, 'Offset', offset, 'Format', {'single', fliplr(shape), 'x'});
+    tseries = m.Data.x.';
+else
+    fid = fopen(file, 'r', 'ieee-le');
+    fseek(fid, offset, 'bof');
+    tseries = fread(fid, fliplr(shape), 'single=>single').';
+    fclose(fid);
+end
+
+if nargout > 1
+    vfile = fullfile(fileparts(file), 'mask_voxels.npy');
+    [offset, shape] = readNpyHeader(vfile);
+    fid = fopen(vfile, 'r', 'ieee-le');
+    fseek(fid, offset, 'bof');
+    voxels = fread(fid, shape(1), 'int64=>double') + 1;
+    fclose(fid);
+end
+
+end
+
+
+function [offset, shape] = readNpyHeader(file)
+% Offset of the data and shape of the array of a .npy file (format 1.0)
+[fid, msg] = fopen(file, 'r', 'ieee-le');
+if fid == -1
+    error('Could not open the file %s:\n%s', file, msg);
+end
+fseek(fid, 8, 'bof');
+len = fread(fid, 1, 'uint16');
+header = fread(fid, [1, len], 'char=>char');
+fclose(fid);
+
+offset = 10 + len;
+shape = regexp(header, '''shape'': \(([^)]*)\)', 'tokens', 'once');
+shape = str2double(regexp(shape{1}, '\d+', 'match'));
+if numel(shape) == 1
+    shape = [shape, 1];
+end
+end
@@ -0,0 +1,15 @@
+function pipeline = selectPipelineSteps(pipeline, steps, stepPrefixes)
+% Keeps only the jobs of the given SPARK steps in a PSOM pipeline
+% (1: bootstrap resampling, 2: sparse dictionary learning, 3: spatial clustering,
+% 4: k-hubness maps), a job belonging to a step when its name starts with the prefix of
+% the step (given by spark_setup.py in the pipeline options, see STEPS in
+% spark_resources.py)
+
+jobNames = fieldnames(pipeline);
+keep = false(size(jobNames));
+for s = steps(:)'
+    keep = keep | strncmp(jobNames, stepPrefixes{s}, numel(stepPrefixes{s}));
+end
+pipeline = rmfield(pipeline, jobNames(~keep));
+
+end
@@ -0,0 +1,26 @@
+function writeJobsInputs(pipeline, inputs, file)
+% Writes, for each job of a PSOM pipeline, the given input files that the job reads
+% (found in its files_in and opt), one line per job: the job name then the files, tab
+% separated. The table is read by spark_jobs_manager.py for staging the inputs of the
+% jobs on the compute nodes (see spark_setup.py --stage-dir)
+
+[fid, msg] = fopen(file, 'w');
+if fid == -1
+    error('Could not open the table of the inputs of the jobs:\n%s', msg);
+end
+
+jobNames = fieldnames(pipeline);
+for k = 1:numel(jobNames)
+    job = pipeline.(jobNames{k});
+    strs = listStrings({job.files_in});
+    if isfield(job, 'opt')
+        strs = [strs, listStrings({job.opt})];
+    end
+    paths = intersect(strs, inputs);
+    if ~isempty(paths)
+        fprintf(fid, '%s\t%s\n', jobNames{k}, strjoin(paths, '\t'));
+    end
+end
+fclose(fid);
+
+end
@@ -0,0 +1,24 @@
+function writeStepsOutputs(pipeline, steps, stepPrefixes, prefix)
+% Writes, for each given SPARK step, the output files of the jobs of the step in a PSOM
+% pipeline (found in their files_out), one file per line in [prefix, '.STEP.txt'].
+% The jobs of a step are found from its prefix, as in selectPipelineSteps.
+% The lists are read by spark_setup.py for finding the steps that are complete (see
+% spark_steps.py)
+
+jobNames = fieldnames(pipeline);
+for s = steps(:)'
+    file = sprintf('%s.%d.txt', prefix, s);
+    [fid, msg] = fopen(file, 'w');
+    if fid == -1
+        error('Could not open the list of the outputs of the step %d:\n%s', s, msg);
+    end
+    jobs = jobNames(strncmp(jobNames, stepPrefixes{s}, numel(stepPrefixes{s})));
+    for k = 1:numel(jobs)
+        paths = listStrings({pipeline.(jobs{k}).files_out});
+        paths = paths(~cellfun(@isempty, paths) & ~strcmp(paths, 'gb_niak_omitted') & ~strcmp(paths, 'gb_psom_omitted'));
+        fprintf(fid, '%s\n', paths{:});
+    end
+    fclose(fid);
+end
+
+end
@@ -0,0 +1,341 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Benchmarks spark_setup.py on synthetic cohorts of increasing size, phase by phase
+#
+# Usage:
+#     python3 spark_setup_bench.py [--sizes 10 1000 10000 100000] [--report bench.json]
+#                                  [--compare previous_bench.json]
+#
+# Last revision: October, 2026
+# Maintainer: Obai Bin Ka'b Ali @aliobaibk
+# License: In the app folder or check GNU GPL-3.0.
+
+
+
+from argparse import ArgumentParser
+from contextlib import redirect_stdout
+import json
+from math import log
+import os
+import platform
+import resource
+import shlex
+import struct
+import subprocess
+from sys import argv, executable, path, stderr
+from sys import exit as sys_exit
+from tempfile import mkdtemp
+from time import perf_counter, strftime
+from types import FunctionType
+
+
+
+APP_DIR = os.path.abspath(os.sep.join([os.path.dirname(os.path.abspath(__file__)), '..', '..', 'app_files']))
+
+# Grid of the synthetic volumes, and number of runs per subject
+GRID = (4, 4, 4)
+NB_TIMEPOINTS = 50
+RUNS_PER_SUBJECT = 4
+
+# Maximum number of files per directory of the synthetic cohorts
+FILES_PER_DIR = 1000
+
+# Thresholds: growth exponent between two sizes above which a phase is flagged as
+# superlinear, ratio to a previous report above which a phase is flagged as slower,
+# and time under which a phase is too fast to be measured reliably
+MAX_EXPONENT = 1.2
+MAX_RATIO = 1.25
+MIN_TIME = 0.05
+
+
+
+def write_nifti(path, nb_timepoints, data=b''):
+    """Writes a minimal NIfTI-1 file (header only, unless some data is given)
+    """
+
+    header = bytearray(352)
+    struct.pack_into('<i', header, 0, 348)
+    struct.pack_into('<8h', header, 40, 4 if nb_timepoints > 1 else 3, *GRID, nb_timepoints, 1, 1, 1)
+    struct.pack_into('<2h', header, 70, 2, 8)
+    struct.pack_into('<8f', header, 76, 1, 2, 2, 2, 2, 1, 1, 1)
+    struct.pack_into('<f', header, 108, 352)
+    struct.pack_into('<2f', header, 112, 1, 0)
+    header[123] = 2 | 8
+    header[344:348] = b'n+1\0'
+    with open(path, 'wb') as file:
+        file.write(bytes(header) + data)
+
+
+
+def setup_cohort(work_dir, size):
+    """Generates (once) a synthetic cohort of the given number of runs, with a mask, a fake
+    SPARK executable and a command template. Returns the directory of the cohort.
+    """
+
+    cohort_dir = os.sep.join([work_dir, 'cohort-' + str(size)])
+    done = os.sep.join([cohort_dir, 'done'])
+    if os.path.isfile(done):
+        return cohort_dir
+
+    os.makedirs(os.sep.join([cohort_dir, 'data']), exist_ok=True)
+    write_nifti(os.sep.join([cohort_dir, 'mask.nii']), 1, b'\x01' * (GRID[0] * GRID[1] * GRID[2]))
+    with open(os.sep.join([cohort_dir, 'spark.simg']), 'w') as file:
+        pass
+    with open(os.sep.join([cohort_dir, 'cmd.template']), 'w', newline='\n') as file:
+        file.write('#!/bin/bash\nsingularity')
+
+    with open(os.sep.join([cohort_dir, 'cohort.tsv']), 'w', newline='\n') as file:
+        for i in range(size):
+            data_dir = os.sep.join([cohort_dir, 'data', str(i // FILES_PER_DIR)])
+            if i % FILES_PER_DIR == 0:
+                os.makedirs(data_dir, exist_ok=True)
+            fmri = os.sep.join([data_dir, 'run' + str(i) + '.nii'])
+            write_nifti(fmri, NB_TIMEPOINTS)
+            file.write('\t'.join(['sb' + str(i // RUNS_PER_SUBJECT), 'ss1', 'run' + str(i % RUNS_PER_SUBJECT + 1), fmri]) + '\n')
+
+    with open(done, 'w') as file:
+        pass
+
+    return cohort_dir
+
+
+
+def setup_argv(cohort_dir, run_dir, setup_args, manifest=False):
+    """Command line of spark_setup.py for a cohort, with the fMRI data by command line
+    or in a manifest
+    """
+
+    if manifest:
+        fmri_data = ['--fmri-manifest', os.sep.join([cohort_dir, 'cohort.tsv'])]
+    else:
+        fmri_data = []
+        with open(os.sep.join([cohort_dir, 'cohort.tsv']), 'r', newline='\n') as file:
+            for line in file:
+                fmri_data += (line.rstrip('\n').split('\t') + [','])
+        fmri_data = ['--fmri-data'] + fmri_data[:-1]
+
+    return fmri_data + [
+        '--mask', os.sep.join([cohort_dir, 'mask.nii']),
+        '--out-dir', os.sep.join([run_dir, 'out']),
+        '--spark-exe', os.sep.join([cohort_dir, 'spark.simg']),
+        '--cmd-template', os.sep.join([cohort_dir, 'cmd.template']),
+        '--cache-dir', os.sep.join([run_dir, 'cache'])] + setup_args
+
+
+
+def setup_phases(spark_setup):
+    """Phases of spark_setup.setup(): the functions it calls, those called by check_iargs()
+    replacing it (parsing, integrity, version...), in the order of the code. Derived from the
+    code, so that a new phase of the setup is benchmarked without editing this file.
+    """
+
+    names = []
+    for name in spark_setup.setup.__code__.co_names:
+        names += spark_setup.check_iargs.__code__.co_names if name == 'check_iargs' else (name,)
+
+    return [x for x in names if isinstance(getattr(spark_setup, x, None), FunctionType)]
+
+
+
+def run_phases(cohort_dir, run_dir, setup_args, manifest=False):
+    """Runs spark_setup.setup() (in this process), its phases being timed on the way, and
+    returns their durations (seconds, in the order they ran, the phases the options leave
+    out being absent), the total duration and the peak RSS (KB). The integrity checks are
+    then timed again, with the headers in the cache.
+    """
+
+    path.insert(0, APP_DIR)
+    import spark_setup
+
+    iargs = setup_argv(cohort_dir, run_dir, setup_args, manifest)
+    (times, last_args) = (dict(), dict())
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    def timed(phase, fun):
+        def wrapper(*args, **kwargs):
+            last_args[phase] = (args, kwargs)
+            start = perf_counter()
+            try:
+                return fun(*args, **kwargs)
+            finally:
+                times[phase] = times.get(phase, 0) + perf_counter() - start
+        return wrapper
+
+    originals = dict((x, getattr(spark_setup, x)) for x in setup_phases(spark_setup))
+    for (phase, fun) in originals.items():
+        setattr(spark_setup, phase, timed(phase, fun))
+
+    start = perf_counter()
+    with redirect_stdout(stderr): # The plan of a dry run
+        spark_setup.setup(iargs)
+    total = perf_counter() - start
+
+    if 'check_iargs_integrity' in last_args:
+        (args, kwargs) = last_args['check_iargs_integrity']
+        timed('check_iargs_integrity (cached)', originals['check_iargs_integrity'])(*args, **kwargs)
+
+    return {
+        'phases': times,
+        'total': total,
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'baseline_rss_kb': rss}
+
+
+
+def run_size(work_dir, size, setup_args, manifest=False):
+    """Benchmarks one cohort size in a new process, so that its peak RSS is its own
+    """
+
+    cohort_dir = setup_cohort(work_dir, size)
+    run_dir = mkdtemp(prefix='run-' + str(size) + '-', dir=work_dir)
+    cmd = [executable, os.path.abspath(__file__), '--child', cohort_dir, run_dir,
+           '--setup-args', ' '.join([shlex.quote(x) for x in setup_args])] + (['--manifest'] if manifest else [])
+
+    proc = subprocess.run(cmd, stdout=subprocess.PIPE, universal_newlines=True)
+    if proc.returncode != 0:
+        print('Failed to benchmark the cohort of ' + str(size) + ' runs:\n' + ' '.join(cmd), file=stderr)
+        sys_exit(1)
+
+    return json.loads(proc.stdout)
+
+
+
+def report_phases(report):
+    """Phases of a report, in the order they ran (the options of a size may leave some out)
+    """
+
+    phases = []
+    for size in sorted(report['sizes'], key=int):
+        phases += [x for x in report['sizes'][size]['phases'] if x not in phases]
+
+    return phases
+
+
+
+def growth(report):
+    """Growth exponents of the phases between consecutive sizes (1 for linear, 2 for quadratic),
+    for the phases slow enough to be measured
+    """
+
+    sizes = sorted(report['sizes'], key=int)
+    exponents = dict()
+    for (a, b) in zip(sizes, sizes[1:]):
+        for phase in report_phases(report) + ['total']:
+            (ta, tb) = (report['sizes'][x]['phases'].get(phase, 0) if phase != 'total' else report['sizes'][x]['total']
+                        for x in [a, b])
+            if ta > 0 and tb >= MIN_TIME:
+                exponents.setdefault(phase, dict())[b] = log(tb / ta) / log(int(b) / int(a))
+
+    return exponents
+
+
+
+def print_report(report, previous=None):
+    """Prints the durations of the phases per size, the growth exponents and, if any, the
+    ratios to a previous report. Returns the list of regressions.
+    """
+
+    sizes = sorted(report['sizes'], key=int)
+    exponents = growth(report)
+    regressions = []
+
+    print('%-32s' % 'phase (s)' + ''.join(['%12s' % x for x in sizes]))
+    for phase in report_phases(report) + ['total']:
+        row = '%-32s' % phase
+        for size in sizes:
+            t = report['sizes'][size]['total'] if phase == 'total' else report['sizes'][size]['phases'].get(phase, 0)
+            flags = ''
+            if exponents.get(phase, dict()).get(size, 0) > MAX_EXPONENT:
+                flags += '^'
+                regressions.append(phase + ' grows superlinearly up to ' + size + ' runs (exponent ' +
+                                   '%.2f' % exponents[phase][size] + ')')
+            if previous and size in previous['sizes']:
+                t0 = previous['sizes'][size]['total'] if phase == 'total' else \
+                    previous['sizes'][size]['phases'].get(phase, 0)
+                if t >= MIN_TIME and t0 > 0 and t / t0 > MAX_RATIO:
+                    flags += '!'
+                    regressions.append(phase + ' is ' + '%.2f' % (t / t0) + 'x slower at ' + size + ' runs')
+            row += '%12s' % ('%.3f' % t + flags)
+        print(row)
+    print('%-32s' % 'peak RSS (MB)' + ''.join(['%12.1f' % (report['sizes'][x]['peak_rss_kb'] / 1024) for x in sizes]))
+
+    print('\n^: superlinear growth (exponent > ' + str(MAX_EXPONENT) + ')' +
+          ('\n!: slower than the previous report (ratio > ' + str(MAX_RATIO) + ')' if previous else ''))
+    if regressions:
+        print('\nRegressions:\n' + '\n'.join(regressions))
+
+    return regressions
+
+
+
+def check_iargs_parser(iargs):
+    """Defines the possible arguments of the program, generates help and usage messages,
+    and issues errors in case of invalid arguments.
+    """
+
+    parser = ArgumentParser(
+        prog='spark_setup_bench.py',
+        description='Benchmarks spark_setup.py on synthetic cohorts of increasing size.')
+    parser.add_argument('--sizes', nargs='+', type=int, default=[10, 1000, 10000, 100000],
+                        help='Numbers of runs of the synthetic cohorts.')
+    parser.add_argument('--work-dir', default='', dest='work_dir',
+                        help='Directory of the synthetic cohorts, reused between benchmarks (default: temporary).')
+    parser.add_argument('--setup-args', default='', dest='setup_args',
+                        help='Additional arguments of spark_setup.py, e.g. "--shards 8 --scheduler SLURM".')
+    parser.add_argument('--manifest', action='store_true',
+                        help='Passes the fMRI data to spark_setup.py in a manifest (--fmri-manifest).')
+    parser.add_argument('--report', default='',
+                        help='Path of the JSON report to write.')
+    parser.add_argument('--compare', default='',
+                        help='Path of a previous JSON report to compare with (e.g. of the previous release).')
+    parser.add_argument('--child', nargs=2, default=None,
+                        help='(Internal) Benchmarks one cohort: COHORT_DIR RUN_DIR.')
+
+    return vars(parser.parse_args(iargs))
+
+
+
+def main(iargs):
+    """Main function, benchmarks every size and reports
+    """
+
+    oargs = check_iargs_parser(iargs)
+    setup_args = shlex.split(oargs['setup_args'])
+
+    if oargs['child']:
+        print(json.dumps(run_phases(oargs['child'][0], oargs['child'][1], setup_args, oargs['manifest'])))
+        return sys_exit(0)
+
+    work_dir = os.path.abspath(oargs['work_dir']) if oargs['work_dir'] else mkdtemp(prefix='spark-bench-')
+    os.makedirs(work_dir, exist_ok=True)
+
+    report = {
+        'date': strftime('%Y-%m-%d %H:%M:%S'),
+        'python': platform.python_version(),
+        'machine': platform.platform(),
+        'setup_args': setup_args,
+        'manifest': oargs['manifest'],
+        'sizes': dict()}
+    for size in sorted(set(oargs['sizes'])):
+        print('Benchmarking a cohort of ' + str(size) + ' runs...', file=stderr)
+        report['sizes'][str(size)] = run_size(work_dir, size, setup_args, oargs['manifest'])
+
+    previous = None
+    if oargs['compare']:
+        with open(oargs['compare'], 'r') as file:
+            previous = json.load(file)
+
+    report['regressions'] = print_report(report, previous)
+
+    if oargs['report']:
+        with open(oargs['report'], 'w') as file:
+            json.dump(report, file, indent=2)
+
+    return sys_exit(1 if report['regressions'] else 0)
+
+
+
+############## Main
+if __name__ == "__main__":
+    main(argv[1:])
@@ -3,7 +3,7 @@
 # 
 # Checks the inputs for installing SPARK (meant to be used with the SPARK installer Bash script)
 # 
-# Last revision: August, 2019
+# Last revision: October, 2026
 # Maintainer: Obai Bin Ka'b Ali @aliobaibk
 # License: In the app folder or check GNU GPL-3.0.
 
@@ -12,7 +12,7 @@
 from argparse import ArgumentParser, RawTextHelpFormatter
 from datetime import datetime
 import os
-from sys import argv
+from sys import argv, stderr
 from sys import exit as sys_exit
 from textwrap import dedent
 
@@ -31,11 +31,23 @@ def setup_versions(versions):
 
 
 
-def setup_abspath(output_dir):
+def setup_abspath(path):
     """Makes sure all paths are absolute.
     """
     
-    return os.path.abspath(output_dir)
+    return os.path.abspath(path) if path else path
+
+
+
+def check_artifacts_dir(oargs):
+    """Checks that the artifacts to install offline are available
+    """
+
+    artifacts_dir = oargs['mirror'] or oargs['cache_dir']
+    if oargs['offline'] and not os.path.isfile(os.sep.join([artifacts_dir, 'SHA256SUMS'])):
+        print('--mirror\n' +
+              'No artifacts (and their checksums file SHA256SUMS) found in the directory:\n' + artifacts_dir, file=stderr)
+        sys_exit(1)
 
 
 
@@ -78,8 +90,9 @@ def check_iargs_parser(iargs):
                         - If the output directory is non-existent, then it will
                         created.
                         - If the output directory already exist with existing
-                        version(s) of SPARK in it, then the existing version(s) of
-                        SPARK might get deleted.
+                        version(s) of SPARK in it, then only the files that changed
+                        are replaced, and the files that are no longer part of
+                        SPARK are deleted.
                          
                         (default: %(default)s)
                         (type: %(type)s)
@@ -106,12 +119,59 @@ def check_iargs_parser(iargs):
                         '''),
                         metavar=('X'),
                         dest='versions')
+    parser.add_argument('-c', '--cache-dir', nargs=1, type=str,
+                        default='',
+                        help=dedent('''\
+                        The directory (absolute or relative) where the downloaded
+                        artifacts (SPARK library, NIAK libraries, utilities and
+                        Singularity layers) are kept, with their checksums in the
+                        file 'SHA256SUMS'. The artifacts are shared by the versions
+                        of SPARK, downloaded concurrently, and only downloaded again
+                        when they changed (or are corrupted).
+                        If not specified, then '.spark-artifacts' in the output
+                        directory will be used.
+                        The cache directory can be copied elsewhere for installing
+                        offline (see --mirror).
+                         
+                        (default: %(default)s)
+                        (type: %(type)s)
+                        ____________________________________________________________
+                        '''),
+                        metavar=('X'),
+                        dest='cache_dir')
+    parser.add_argument('--offline',
+                        action='store_true',
+                        help=dedent('''\
+                        If set, nothing is downloaded: SPARK is installed from the
+                        artifacts of the mirror (--mirror), or of the cache directory
+                        (--cache-dir) if there is no mirror, once their checksums are
+                        verified. For the Singularity version, the image
+                        'spark-hpc.simg' must be among the artifacts.
+                         
+                        (default: %(default)s)
+                        ____________________________________________________________
+                        '''),
+                        dest='offline')
+    parser.add_argument('--mirror', nargs=1, type=str,
+                        default='',
+                        help=dedent('''\
+                        A local directory holding the artifacts, as in the cache
+                        directory (--cache-dir) of another installation. Implies
+                        --offline.
+                         
+                        (default: %(default)s)
+                        (type: %(type)s)
+                        ____________________________________________________________
+                        '''),
+                        metavar=('X'),
+                        dest='mirror')
     
     oargs = vars(parser.parse_args(iargs))
 
     # Hack: when (nargs=1) a list should not be returned
-    if type(oargs['output_dir']) is list:
-        oargs['output_dir'] = oargs['output_dir'][0]
+    for k in ['output_dir', 'cache_dir', 'mirror']:
+        if type(oargs[k]) is list:
+            oargs[k] = oargs[k][0]
 
     return oargs
 
@@ -123,7 +183,11 @@ def check_iargs(iargs):
     
     oargs = check_iargs_parser(iargs)
     oargs['output_dir'] = setup_abspath(oargs['output_dir'])
+    oargs['cache_dir'] = setup_abspath(oargs['cache_dir'] or os.sep.join([oargs['output_dir'], '.spark-artifacts']))
+    oargs['mirror'] = setup_abspath(oargs['mirror'])
+    oargs['offline'] = oargs['offline'] or bool(oargs['mirror'])
     oargs['versions'] = setup_versions(oargs['versions'])
+    check_artifacts_dir(oargs)
     return oargs
 
 
@@ -134,7 +198,8 @@ def main(iargs):
 
     oargs = check_iargs(iargs)
 
-    print('"' + oargs['output_dir'] + '" "'  + oargs['versions'] + '"')
+    print('"' + oargs['output_dir'] + '" "'  + oargs['versions'] + '" "' + oargs['cache_dir'] + '" "' +
+          oargs['mirror'] + '" "' + str(int(oargs['offline'])) + '"')
 
     return sys_exit(0)
 
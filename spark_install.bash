@@ -2,51 +2,220 @@
 # 
 # Installs SPARK
 # 
-# Last revision: August, 2019
+# Last revision: October, 2026
 # Maintainer: Obai Bin Ka'b Ali @aliobaibk
 # License: In the app folder or check GNU GPL-3.0.
 
 
 
+############## Artifacts (downloaded once in the cache, shared by the versions)
+SPARK_LIB_API="https://api.github.com/repos/multifunkim/spark-matlab/releases/latest"
+NIAK_URL="https://github.com/SIMEXP/niak/releases/download"
+NIAK_MATLAB="v0.16.0"
+NIAK_OCTAVE="v1.1.4"
+HPC_URL="https://raw.githubusercontent.com/multifunkim/spark-hpc/master/for_build/app_extra"
+HPC_FILES=(
+    main/spark.m
+    util/prependFileToFile.m
+    util/str2RegSpacedVector.m
+    util/selectPipelineSteps.m
+    util/listStrings.m
+    util/writeJobsInputs.m
+    util/readTseries.m
+    util/writeStepsOutputs.m
+    util/psom_gb/spark_psom_gb.m
+    externals/psom_run_script.m
+)
+
+
+
+############## Function to download a file (atomically: a failed download leaves no file)
+function fetch() {
+    url="$1"
+    dest="$2"
+
+    mkdir -p "$(dirname "$dest")" && \
+    wget -q -O "$dest".part "$url" && \
+    mv -f "$dest".part "$dest" || \
+    { rm -f "$dest".part; echo " - Failed to download: $url" >&2; false; }
+}
+
+
+
+############## Function to record the checksums of files of the artifacts directory
+function record_checksums() {
+    artifacts_dir="$1"
+    shift
+
+    # Lines formatted as by sha256sum: the name of a file starts at the 67th character
+    pushd "$artifacts_dir" >/dev/null 2>&1 && \
+    touch SHA256SUMS && \
+    { awk 'NR == FNR {files[$0] = 1; next} !(substr($0, 67) in files)' <(printf '%s\n' "$@") SHA256SUMS; \
+      sha256sum "$@"; } > SHA256SUMS.part && \
+    mv -f SHA256SUMS.part SHA256SUMS
+    status=$?
+    popd >/dev/null 2>&1
+    return $status
+}
+
+
+
+############## Function to verify the checksums of files of the artifacts directory
+function verify_checksums() {
+    artifacts_dir="$1"
+    shift
+
+    sums="$(awk 'NR == FNR {files[$0] = 1; next} substr($0, 67) in files' <(printf '%s\n' "$@") \
+        "$artifacts_dir"/SHA256SUMS 2>/dev/null)"
+    if [[ $(printf '%s' "$sums" | grep -c '') != $# ]]; then
+        echo " - Missing checksums in: $artifacts_dir/SHA256SUMS" >&2
+        return 1
+    fi
+    (cd "$artifacts_dir" && printf '%s\n' "$sums" | sha256sum --quiet -c -)
+}
+
+
+
+############## Function to download the artifacts of the versions to install, concurrently
+function fetch_artifacts() {
+    artifacts_dir="$1"
+    versions="$2"
+
+    echo -e '\n\n\nDownloading SPARK artifacts...' && \
+    mkdir -p "$artifacts_dir" || return 1
+
+    files=()
+    pids=()
+    tag=""
+    if [[ "$versions" == *"matlab"* ]] || [[ "$versions" == *"octave"* ]] || [[ "$versions" == *"all"* ]]; then
+        # SPARK library: downloaded again only if a new release is out (or the cached one is corrupted)
+        if fetch "$SPARK_LIB_API" "$artifacts_dir"/spark.latest; then
+            tag="$(grep '"tag_name"' "$artifacts_dir"/spark.latest | cut -d '"' -f 4)"
+        elif verify_checksums "$artifacts_dir" spark-lib.zip 2>/dev/null; then
+            echo " - Could not check the latest release, using the SPARK library in the cache"
+            tag="$(cat "$artifacts_dir"/spark-lib.tag 2>/dev/null)"
+        else
+            return 1
+        fi
+        if [[ "$tag" != "$(cat "$artifacts_dir"/spark-lib.tag 2>/dev/null)" ]] || \
+            ! verify_checksums "$artifacts_dir" spark-lib.zip 2>/dev/null; then
+            echo " - SPARK library ($tag)..."
+            zip_url="$(grep zipball_url "$artifacts_dir"/spark.latest | cut -d '"' -f 4)"
+            fetch "$zip_url" "$artifacts_dir"/spark-lib.zip & pids+=($!)
+            files+=(spark-lib.zip)
+        fi
+
+        # Utilities of spark-hpc (small, always downloaded again)
+        echo " - SPARK main function and utilities..."
+        for file in "${HPC_FILES[@]}"; do
+            fetch "$HPC_URL"/"$file" "$artifacts_dir"/hpc/"$file" & pids+=($!)
+            files+=(hpc/"$file")
+        done
+    fi
+
+    # NIAK libraries: fixed releases, downloaded once
+    niak=()
+    if [[ "$versions" == *"matlab"* ]] || [[ "$versions" == *"all"* ]]; then
+        niak+=("$NIAK_MATLAB")
+    fi
+    if [[ "$versions" == *"octave"* ]] || [[ "$versions" == *"all"* ]]; then
+        niak+=("$NIAK_OCTAVE")
+    fi
+    for release in "${niak[@]}"; do
+        if ! verify_checksums "$artifacts_dir" niak-"$release".zip 2>/dev/null; then
+            echo " - NIAK library ($release)..."
+            fetch "$NIAK_URL"/"$release"/niak-with-dependencies.zip "$artifacts_dir"/niak-"$release".zip & pids+=($!)
+            files+=(niak-"$release".zip)
+        fi
+    done
+
+    status=0
+    for pid in "${pids[@]}"; do
+        wait "$pid" || status=1
+    done
+    if [[ $status != 0 ]]; then
+        return 1
+    fi
+
+    if [[ ${#files[@]} -gt 0 ]]; then
+        record_checksums "$artifacts_dir" "${files[@]}" || return 1
+    fi
+    if [[ -n "$tag" ]]; then
+        echo "$tag" > "$artifacts_dir"/spark-lib.tag
+    fi
+}
+
+
+
+############## Function to replace the changed files of a directory (incremental reinstall)
+function sync_dir() {
+    src="$1"
+    dst="$2"
+
+    mkdir -p "$dst" && \
+    changed=0 && \
+    while IFS= read -r -d '' file; do
+        if ! cmp -s "$src"/"$file" "$dst"/"$file"; then
+            mkdir -p "$(dirname "$dst"/"$file")" && \
+            cp -p "$src"/"$file" "$dst"/"$file".part && \
+            mv -f "$dst"/"$file".part "$dst"/"$file" || return 1
+            changed=$((changed + 1))
+        fi
+    done < <(cd "$src" && find . -type f -print0) && \
+    removed=0 && \
+    while IFS= read -r -d '' file; do
+        if [ ! -e "$src"/"$file" ]; then
+            rm -f "$dst"/"$file" || return 1
+            removed=$((removed + 1))
+        fi
+    done < <(cd "$dst" && find . -type f -print0) && \
+    find "$dst" -mindepth 1 -depth -type d -empty -delete && \
+    echo " - $changed file(s) replaced, $removed file(s) removed"
+}
+
+
+
+############## Function to assemble the MATLAB/GNU Octave version from the artifacts
+function stage_spark() {
+    artifacts_dir="$1"
+    niak_release="$2"
+    stage_dir="$3"
+
+    verify_checksums "$artifacts_dir" spark-lib.zip niak-"$niak_release".zip \
+        $(printf 'hpc/%s ' "${HPC_FILES[@]}") || \
+        { echo " - Corrupted or missing artifacts in: $artifacts_dir" >&2; return 1; }
+
+    unzip -q "$artifacts_dir"/spark-lib.zip -d "$stage_dir"/lib && \
+    mv "$stage_dir"/lib/multifunkim-spark-matlab*/ "$stage_dir"/app && \
+    rm -rf "$stage_dir"/lib && \
+    \
+    cp "$artifacts_dir"/hpc/main/spark.m "$stage_dir"/app && \
+    mkdir -p "$stage_dir"/app/util && \
+    cp -r "$artifacts_dir"/hpc/util/* "$stage_dir"/app/util && \
+    \
+    mkdir "$stage_dir"/app/externals && \
+    unzip -q "$artifacts_dir"/niak-"$niak_release".zip -d "$stage_dir"/app/externals
+}
+
+
+
 ############## Function to install the MATLAB version
 function install_spark_matlab() {
     output_dir="$1" && \
+    artifacts_dir="$2" && \
     \
     echo -e '\n\n\nInstalling SPARK for MATLAB...' && \
     \
     mkdir -p "$output_dir" && \
     app_dir="$output_dir"/spark-matlab && \
-    if [ -d "$app_dir" ]; then
-        echo ' - Found an existing MATLAB version of SPARK, deleting it...'
-        rm -rf "$app_dir"/*
-    else
-        mkdir "$app_dir"
-    fi && \
     tmp_dir="$(mktemp -d --tmpdir="$output_dir" tmp-XXXXX)" && \
     \
-    echo ' - Downloading SPARK library (latest)...' && \
-    wget -q "https://api.github.com/repos/multifunkim/spark-matlab/releases/latest" -O "$tmp_dir"/spark.latest && \
-    zip_url="$(grep zipball_url "$tmp_dir"/spark.latest | cut -d '"' -f 4)" && \
-    wget -q "$zip_url" -O "$tmp_dir"/spark-lib.zip && \
-    unzip -q "$tmp_dir"/spark-lib.zip -d "$tmp_dir" && \
-    mv "$tmp_dir"/multifunkim-spark-matlab*/* "$app_dir" && \
-    rm -rf "$tmp_dir"/spark.latest "$tmp_dir"/spark-lib.zip "$tmp_dir"/multifunkim-spark-matlab* && \
-    \
-    echo ' - Downloading SPARK main function...' && \
-    wget -q -P "$app_dir" "https://raw.githubusercontent.com/multifunkim/spark-hpc/master/for_build/app_extra/main/spark.m" && \
-    \
-    echo ' - Downloading SPARK utilities...' && \
-    wget -q -P "$app_dir"/util "https://raw.githubusercontent.com/multifunkim/spark-hpc/master/for_build/app_extra/util/prependFileToFile.m" && \
-    wget -q -P "$app_dir"/util "https://raw.githubusercontent.com/multifunkim/spark-hpc/master/for_build/app_extra/util/str2RegSpacedVector.m" && \
-    mkdir "$app_dir"/util/psom_gb && \
-    wget -q -P "$app_dir"/util/psom_gb "https://raw.githubusercontent.com/multifunkim/spark-hpc/master/for_build/app_extra/util/psom_gb/spark_psom_gb.m" && \
-    \
-    echo ' - Downloading NIAK library (v0.16.0)...' && \
-    wget -q -O "$tmp_dir"/niak-lib.zip "https://github.com/SIMEXP/niak/releases/download/v0.16.0/niak-with-dependencies.zip" && \
-    mkdir "$app_dir"/externals && \
-    unzip -q "$tmp_dir"/niak-lib.zip -d "$app_dir"/externals && \
-    rm -f "$tmp_dir"/niak-lib.zip && \
-    wget -q -O "$app_dir"/externals/niak*/extensions/psom*/psom_run_script.m "https://raw.githubusercontent.com/multifunkim/spark-hpc/master/for_build/app_extra/externals/psom_run_script.m" && \
+    echo " - Assembling SPARK library, utilities and NIAK library ($NIAK_MATLAB)..." && \
+    stage_spark "$artifacts_dir" "$NIAK_MATLAB" "$tmp_dir" && \
+    cp "$artifacts_dir"/hpc/externals/psom_run_script.m "$tmp_dir"/app/externals/niak*/extensions/psom*/psom_run_script.m && \
+    \
+    echo ' - Updating the installed files...' && \
+    sync_dir "$tmp_dir"/app "$app_dir" && \
     \
     rm -rf "$tmp_dir" && \
     \
@@ -58,41 +227,19 @@ function install_spark_matlab() {
 ############## Function to install the GNU Octave version
 function install_spark_octave() {
     output_dir="$1" && \
+    artifacts_dir="$2" && \
     \
     echo -e '\n\n\nInstalling SPARK for GNU Octave...' && \
     \
     mkdir -p "$output_dir" && \
     app_dir="$output_dir"/spark-octave && \
-    if [ -d "$app_dir" ]; then
-        echo ' - Found an existing GNU Octave version of SPARK, deleting it...'
-        rm -rf "$app_dir"/*
-    else
-        mkdir "$app_dir"
-    fi && \
     tmp_dir="$(mktemp -d --tmpdir="$output_dir" tmp-XXXXX)" && \
     \
-    echo ' - Downloading SPARK library (latest)...' && \
-    wget -q "https://api.github.com/repos/multifunkim/spark-matlab/releases/latest" -O "$tmp_dir"/spark.latest && \
-    zip_url="$(grep zipball_url "$tmp_dir"/spark.latest | cut -d '"' -f 4)" && \
-    wget -q "$zip_url" -O "$tmp_dir"/spark-lib.zip && \
-    unzip -q "$tmp_dir"/spark-lib.zip -d "$tmp_dir" && \
-    mv "$tmp_dir"/multifunkim-spark-matlab*/* "$app_dir" && \
-    rm -rf "$tmp_dir"/spark.latest "$tmp_dir"/spark-lib.zip "$tmp_dir"/multifunkim-spark-matlab* && \
-    \
-    echo ' - Downloading SPARK main function...' && \
-    wget -q -P "$app_dir" "https://raw.githubusercontent.com/multifunkim/spark-hpc/master/for_build/app_extra/main/spark.m" && \
-    \
-    echo ' - Downloading SPARK utilities...' && \
-    wget -q -P "$app_dir"/util "https://raw.githubusercontent.com/multifunkim/spark-hpc/master/for_build/app_extra/util/prependFileToFile.m" && \
-    wget -q -P "$app_dir"/util "https://raw.githubusercontent.com/multifunkim/spark-hpc/master/for_build/app_extra/util/str2RegSpacedVector.m" && \
-    mkdir "$app_dir"/util/psom_gb && \
-    wget -q -P "$app_dir"/util/psom_gb "https://raw.githubusercontent.com/multifunkim/spark-hpc/master/for_build/app_extra/util/psom_gb/spark_psom_gb.m" && \
-    \
-    echo ' - Downloading NIAK library (v1.1.4)...' && \
-    wget -q -O "$tmp_dir"/niak-lib.zip "https://github.com/SIMEXP/niak/releases/download/v1.1.4/niak-with-dependencies.zip" && \
-    mkdir "$app_dir"/externals && \
-    unzip -q "$tmp_dir"/niak-lib.zip -d "$app_dir"/externals && \
-    rm -f "$tmp_dir"/niak-lib.zip && \
+    echo " - Assembling SPARK library, utilities and NIAK library ($NIAK_OCTAVE)..." && \
+    stage_spark "$artifacts_dir" "$NIAK_OCTAVE" "$tmp_dir" && \
+    \
+    echo ' - Updating the installed files...' && \
+    sync_dir "$tmp_dir"/app "$app_dir" && \
     \
     rm -rf "$tmp_dir" && \
     \
@@ -104,28 +251,39 @@ function install_spark_octave() {
 ############## Function to install the Singularity version
 function install_spark_sing() {
     output_dir="$1" && \
+    artifacts_dir="$2" && \
+    offline="$3" && \
     \
     echo -e '\n\n\nInstalling SPARK for Singularity...' && \
     \
     mkdir -p "$output_dir" && \
     app_dir="$output_dir"/spark-singularity && \
-    if [ -d "$app_dir" ]; then
-        echo ' - Found an existing Singularity version of SPARK, deleting it...'
-        rm -rf "$app_dir"/*
+    mkdir -p "$app_dir" && \
+    \
+    if [[ $offline == 1 ]]; then
+        # The image is taken from the artifacts
+        verify_checksums "$artifacts_dir" spark-hpc.simg && \
+        if cmp -s "$artifacts_dir"/spark-hpc.simg "$app_dir"/spark-hpc.simg; then
+            echo ' - The image is up to date'
+        else
+            cp "$artifacts_dir"/spark-hpc.simg "$app_dir"/spark-hpc.simg.part && \
+            mv -f "$app_dir"/spark-hpc.simg.part "$app_dir"/spark-hpc.simg
+        fi
     else
-        mkdir "$app_dir"
+        # The layers of the image are kept in the cache, then the image joins the artifacts
+        tmp_dir="$(mktemp -d --tmpdir=/var/tmp tmp-XXXXX)" && \
+        mkdir -p "$artifacts_dir"/singularity && \
+        export SINGULARITY_CACHEDIR="$artifacts_dir"/singularity && \
+        export SINGULARITY_LOCALCACHEDIR="$tmp_dir" && \
+        export SINGULARITY_TMPDIR="$tmp_dir" && \
+        export SINGULARITY_PULLFOLDER="$tmp_dir" && \
+        singularity build "$tmp_dir"/spark-hpc.simg docker://multifunkim/spark-hpc && \
+        mv -f "$tmp_dir"/spark-hpc.simg "$artifacts_dir"/spark-hpc.simg && \
+        record_checksums "$artifacts_dir" spark-hpc.simg && \
+        cp "$artifacts_dir"/spark-hpc.simg "$app_dir"/spark-hpc.simg.part && \
+        mv -f "$app_dir"/spark-hpc.simg.part "$app_dir"/spark-hpc.simg && \
+        rm -rf "$tmp_dir"
     fi && \
-    tmp_dir="$(mktemp -d --tmpdir=/var/tmp tmp-XXXXX)" && \
-    \
-    pushd "$app_dir" >/dev/null 2>&1 && \
-    export SINGULARITY_CACHEDIR="$tmp_dir" && \
-    export SINGULARITY_LOCALCACHEDIR="$tmp_dir" && \
-    export SINGULARITY_TMPDIR="$tmp_dir" && \
-    export SINGULARITY_PULLFOLDER="$tmp_dir" && \
-    singularity build spark-hpc.simg docker://multifunkim/spark-hpc && \
-    popd >/dev/null 2>&1 && \
-    \
-    rm -rf "$tmp_dir" && \
     \
     echo -e '\n - All done, check:\n'"$app_dir"
 }
@@ -160,14 +318,14 @@ function is_ver_higher() {
 python3 - "$1" "$2" << END
 from sys import exit as sys_exit
 try:
-    from distutils.version import StrictVersion
     from re import compile
     from sys import argv
 
+    # Compared as tuples of integers (distutils is gone in Python 3.12)
     regex = compile('([0-9]+\.)+[0-9]+')
-    ver = regex.search(argv[1]).group(0)
-    ref_ver = regex.search(argv[2]).group(0)
-    if int(StrictVersion(ver) >= StrictVersion(ref_ver)):
+    ver = tuple(int(x) for x in regex.search(argv[1]).group(0).split('.'))
+    ref_ver = tuple(int(x) for x in regex.search(argv[2]).group(0).split('.'))
+    if ver >= ref_ver:
         sys_exit(0)
     else:
         sys_exit(1)
@@ -216,17 +374,35 @@ fi
 ############## Reading info
 output_dir="$(echo "$oargs" | cut -d '"' -f 2)"
 versions="$(echo "$oargs" | cut -d '"' -f 4)"
+cache_dir="$(echo "$oargs" | cut -d '"' -f 6)"
+mirror="$(echo "$oargs" | cut -d '"' -f 8)"
+offline="$(echo "$oargs" | cut -d '"' -f 10)"
+
+
+
+############## Getting the artifacts (downloaded in the cache, or taken from the mirror when offline)
+if [[ $offline == 1 ]]; then
+    artifacts_dir="${mirror:-$cache_dir}"
+    echo -e '\n\n\nInstalling offline from:\n'"$artifacts_dir"
+else
+    artifacts_dir="$cache_dir"
+    if [[ "$versions" != "singularity" ]] && ! fetch_artifacts "$artifacts_dir" "$versions"; then
+        echo -e "\n\n\n     ***** Failed to download the artifacts"
+        echo -e "\n     Closing the program\n"
+        exit 1
+    fi
+fi
 
 
 
 ############## Installing
 
 if [[ "$versions" == *"matlab"* ]] || [[ "$versions" == *"all"* ]]; then
-    install_spark_matlab "$output_dir"
+    install_spark_matlab "$output_dir" "$artifacts_dir"
 fi
 
 if [[ "$versions" == *"octave"* ]] || [[ "$versions" == *"all"* ]]; then
-    install_spark_octave "$output_dir"
+    install_spark_octave "$output_dir" "$artifacts_dir"
 fi
 
 if [[ "$versions" == *"singularity"* ]] || [[ "$versions" == *"all"* ]]; then
@@ -238,7 +414,7 @@ if [[ "$versions" == *"singularity"* ]] || [[ "$versions" == *"all"* ]]; then
         echo -e "\n         Closing the program\n"
         exit 1
     fi
-    install_spark_sing "$output_dir"
+    install_spark_sing "$output_dir" "$artifacts_dir" "$offline"
 fi
 
 